@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+def index_path_for(csv_path):
+    """Path of the id index stored next to a CSV file."""
+    return f"{csv_path}.ids.npy"
+
+class IdIndex(object):
+    """Set of integer ids (e.g. recommendation_id) with O(log n) lookups.
+
+    The ids loaded at startup are kept in a sorted int64 array, which can be
+    memory-mapped so that every worker process shares the same pages. Ids
+    added during a run are kept in a plain set until they are merged back.
+    """
+    def __init__(self, ids=None):
+        """Initializes an IdIndex.
+        Args:
+            ids: optional sorted, unique int64 array of known ids.
+        """
+        self._ids = ids if ids is not None else np.empty(0, dtype=np.int64)
+        self._new = set()
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Builds an index from any iterable of ids."""
+        return cls(np.unique(np.fromiter((int(x) for x in ids), dtype=np.int64)))
+
+    @classmethod
+    def load(cls, csv_path, column_index=0, mmap=True):
+        """Loads the index of a CSV column.
+
+        The saved index is used if it is at least as recent as the CSV file,
+        otherwise it is rebuilt from the column and saved.
+        Args:
+            csv_path: the CSV file the ids come from.
+            column_index: index of the id column.
+            mmap: whether to memory-map the saved index instead of reading it.
+        Returns:
+            An IdIndex.
+        """
+        index_path = index_path_for(csv_path)
+        if not os.path.exists(csv_path):
+            index = cls()
+        elif os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(csv_path):
+            return cls.open(index_path, mmap)
+        else:
+            column = pd.read_csv(csv_path, usecols=[column_index], dtype=np.int64).iloc[:, 0]
+            index = cls(np.unique(column.to_numpy()))
+
+        index.save(index_path)
+        return index
+
+    @classmethod
+    def open(cls, index_path, mmap=True):
+        """Opens a saved index without checking it against its CSV file."""
+        return cls(np.load(index_path, mmap_mode='r' if mmap else None))
+
+    def save(self, index_path):
+        """Writes the merged index to index_path.
+
+        The file is replaced atomically, so processes that memory-mapped the
+        previous version keep reading valid pages.
+        """
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.merged())
+        os.replace(tmp_path, index_path)
+
+    def merged(self):
+        """Returns the sorted array of every id, including the new ones."""
+        if not self._new:
+            return np.asarray(self._ids)
+        new_ids = np.fromiter(self._new, dtype=np.int64, count=len(self._new))
+        return np.union1d(self._ids, new_ids)
+
+    def add(self, id):
+        self._new.add(int(id))
+
+    def update(self, ids):
+        self._new.update(int(id) for id in ids)
+
+    @property
+    def new_ids(self):
+        """Ids added since the index was loaded."""
+        return self._new
+
+    def __contains__(self, id):
+        id = int(id)
+        if id in self._new:
+            return True
+        i = np.searchsorted(self._ids, id)
+        return i < len(self._ids) and self._ids[i] == id
+
+    def __len__(self):
+        return len(self._ids) + len(self._new)
@@ -1,27 +1,231 @@
 import csv
+import heapq
+import os
+import shutil
+import tempfile
 
+import numpy as np
 import pandas as pd
 
-def read_and_sort_csv(csv_path, column_index, as_number=False):
+# Default number of bytes of rows held in memory by read_and_sort_csv
+SORT_MEMORY_LIMIT = 64 * 1024 * 1024
+# Maximum number of sorted runs merged at once
+MERGE_FAN_IN = 64
+# Number of rows read at once by drop_duplicates_in_csv
+DEDUP_CHUNK_SIZE = 1000000
+# Rough per-row and per-field overhead of a csv row held as a list of str
+_ROW_OVERHEAD = 56
+_FIELD_OVERHEAD = 49
+
+def _sort_key(column_index, as_number):
+    if as_number:
+        return lambda row: int(row[column_index])
+    return lambda row: row[column_index]
+
+def _write_run(rows, directory):
+    """Writes sorted rows to a temporary file and returns its path."""
+    fd, run_path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with open(fd, 'w', newline='', encoding='utf-8') as run_file:
+        csv.writer(run_file).writerows(rows)
+    return run_path
+
+def _merge_runs(run_paths, key, writer):
+    """k-way merge of sorted run files into writer."""
+    run_files = [open(run_path, 'r', newline='', encoding='utf-8') for run_path in run_paths]
+    try:
+        # heapq.merge is stable, rows with equal keys keep their original order
+        writer.writerows(heapq.merge(*(csv.reader(f) for f in run_files), key=key))
+    finally:
+        for run_file in run_files:
+            run_file.close()
+        for run_path in run_paths:
+            os.remove(run_path)
+
+def read_and_sort_csv(csv_path, column_index, as_number=False, memory_limit=SORT_MEMORY_LIMIT):
+    """Sorts a CSV file in place by one of its columns using an external merge sort.
+
+    Rows are read in runs of about memory_limit bytes, each run is sorted and
+    spilled to a temporary file, then the runs are merged back into csv_path.
+    Files that fit in a single run are sorted in memory.
+    Args:
+        csv_path: the CSV file to sort.
+        column_index: index of the column to sort by.
+        as_number: whether to compare the column as integers instead of strings.
+        memory_limit: approximate number of bytes of rows held in memory.
+    """
+    key = _sort_key(column_index, as_number)
+    directory = os.path.dirname(os.path.abspath(csv_path))
+
+    run_paths = []
     with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file:
         reader = csv.reader(csv_file)
         header = next(reader)
-        data = list(reader)
-        
-    # Sort the data based on the 'steam_id' column (assuming it's the first column)
-    if as_number:
-        data.sort(key=lambda row: int(row[column_index]))
-    else:
-        data.sort(key=lambda row: row[column_index])
-    
-    # Write the sorted data back into the CSV file
-    with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+
+        rows = []
+        rows_size = 0
+        for row in reader:
+            rows.append(row)
+            rows_size += _ROW_OVERHEAD + sum(_FIELD_OVERHEAD + len(field) for field in row)
+            if rows_size >= memory_limit:
+                rows.sort(key=key)
+                run_paths.append(_write_run(rows, directory))
+                rows = []
+                rows_size = 0
+        rows.sort(key=key)
+
+    # Merge in passes so that at most MERGE_FAN_IN files are open at once
+    if run_paths:
+        run_paths.append(_write_run(rows, directory))
+        rows = []
+        while len(run_paths) > MERGE_FAN_IN:
+            merged_paths = []
+            for i in range(0, len(run_paths), MERGE_FAN_IN):
+                fd, merged_path = tempfile.mkstemp(suffix='.csv', dir=directory)
+                with open(fd, 'w', newline='', encoding='utf-8') as merged_file:
+                    _merge_runs(run_paths[i:i + MERGE_FAN_IN], key, csv.writer(merged_file))
+                merged_paths.append(merged_path)
+            run_paths = merged_paths
+
+    # Write the sorted data next to the CSV file, then replace it
+    fd, sorted_path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with open(fd, 'w', newline='', encoding='utf-8') as csv_file:
         writer = csv.writer(csv_file)
         writer.writerow(header)
-        writer.writerows(data)
+        if run_paths:
+            _merge_runs(run_paths, key, writer)
+        else:
+            writer.writerows(rows)
+    shutil.copymode(csv_path, sorted_path)
+    os.replace(sorted_path, csv_path)
+
+def _read_keys(csv_path, column_index, as_number, chunk_size):
+    """Reads a CSV column in chunks as a compact array of int64 keys
+    (or uint64 hashes of the values when as_number is False)."""
+    chunks = []
+    reader = pd.read_csv(csv_path, usecols=[column_index], dtype=str,
+                         keep_default_na=False, chunksize=chunk_size)
+    for chunk in reader:
+        column = chunk.iloc[:, 0]
+        if as_number:
+            chunks.append(column.to_numpy(dtype=np.int64))
+        else:
+            chunks.append(pd.util.hash_pandas_object(column, index=False).to_numpy())
+    if not chunks:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(chunks)
+
+def _read_values(csv_path, column_index, rows, chunk_size):
+    """Reads the values (as str) of a CSV column at sorted row positions."""
+    values = []
+    start = 0
+    reader = pd.read_csv(csv_path, usecols=[column_index], dtype=str,
+                         keep_default_na=False, chunksize=chunk_size)
+    for chunk in reader:
+        column = chunk.iloc[:, 0].to_numpy()
+        end = start + len(column)
+        first, last = np.searchsorted(rows, [start, end])
+        values.extend(column[rows[first:last] - start])
+        start = end
+    return values
+
+def drop_duplicates_in_csv(csv_path, column_index, keep='first', as_number=False, chunk_size=DEDUP_CHUNK_SIZE):
+    """Drops the rows of a CSV file whose value in a column was already seen.
+
+    The key column is read in chunks into a compact array, the rows to keep are
+    selected with np.unique, then the file is streamed again and the kept rows
+    are written to a temporary file that replaces csv_path. Memory use is a few
+    bytes per row, whatever the width of the file. Keys that are not numbers
+    are compared by their 64-bit hash, and the values of the rows sharing a
+    hash are then compared, so that a collision doesn't drop a distinct row.
+    Args:
+        csv_path: the CSV file to deduplicate.
+        column_index: index of the key column.
+        keep: 'first' or 'last', which occurrence of a duplicated key to keep.
+        as_number: whether the keys are integers.
+        chunk_size: number of rows read at once.
+    """
+    if keep not in ('first', 'last'):
+        raise ValueError(f"keep should be 'first' or 'last', got: {keep}")
+
+    keys = _read_keys(csv_path, column_index, as_number, chunk_size)
+    if as_number:
+        if keep == 'first':
+            _, kept_indices = np.unique(keys, return_index=True)
+        else:
+            _, reversed_indices = np.unique(keys[::-1], return_index=True)
+            kept_indices = len(keys) - 1 - reversed_indices
+        kept = np.zeros(len(keys), dtype=bool)
+        kept[kept_indices] = True
+        del kept_indices
+    else:
+        # Only the rows whose hash is shared can be duplicates, their values
+        # are read again and compared
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        candidates = np.flatnonzero(counts[inverse] > 1)
+        del inverse, counts
+        kept = np.ones(len(keys), dtype=bool)
+        values = _read_values(csv_path, column_index, candidates, chunk_size)
+        order = range(len(candidates)) if keep == 'first' else reversed(range(len(candidates)))
+        seen = set()
+        for i in order:
+            if values[i] in seen:
+                kept[candidates[i]] = False
+            else:
+                seen.add(values[i])
+        del candidates, values, seen
+    del keys
+
+    directory = os.path.dirname(os.path.abspath(csv_path))
+    fd, deduped_path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file, \
+         open(fd, 'w', newline='', encoding='utf-8') as deduped_file:
+        reader = csv.reader(csv_file)
+        writer = csv.writer(deduped_file)
+        writer.writerow(next(reader))
+        # pandas skips blank lines, so they are not counted here either
+        rows = (row for row in reader if row)
+        writer.writerows(row for row, keep_row in zip(rows, kept) if keep_row)
+    shutil.copymode(csv_path, deduped_path)
+    os.replace(deduped_path, csv_path)
+
+def merge_sorted_csvs(csv_paths, output_path, column_index, as_number=False):
+    """Merges CSV files with the same header into output_path, sorted by one of
+    their columns and without duplicated values in it.
+
+    Every file is first sorted in place (see read_and_sort_csv), then the files
+    are merged in a single streaming pass. When a value is in several files,
+    the row of the first file in csv_paths is kept. output_path may be one of
+    csv_paths, it is only replaced once the merge is done.
+    Args:
+        csv_paths: the CSV files to merge.
+        output_path: the merged CSV file.
+        column_index: index of the column to sort and deduplicate by.
+        as_number: whether to compare the column as integers instead of strings.
+    """
+    key = _sort_key(column_index, as_number)
+    for csv_path in csv_paths:
+        read_and_sort_csv(csv_path, column_index, as_number)
 
-def drop_duplicates_in_csv(csv_path, column_index):
-    df = pd.read_csv(csv_path)
-    column_name = df.columns[column_index]
-    df = df.drop_duplicates(subset=column_name)
-    df.to_csv(csv_path, index=False)
+    csv_files = [open(csv_path, 'r', newline='', encoding='utf-8') for csv_path in csv_paths]
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, merged_path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    try:
+        readers = [csv.reader(f) for f in csv_files]
+        headers = [next(reader, None) for reader in readers]
+        with open(fd, 'w', newline='', encoding='utf-8') as merged_file:
+            writer = csv.writer(merged_file)
+            writer.writerow(next(header for header in headers if header is not None))
+            previous = None
+            # heapq.merge is stable, so the row of the first file comes first
+            for row in heapq.merge(*((row for row in reader if row) for reader in readers), key=key):
+                value = key(row)
+                if value != previous:
+                    writer.writerow(row)
+                    previous = value
+    except BaseException:
+        os.remove(merged_path)
+        raise
+    finally:
+        for csv_file in csv_files:
+            csv_file.close()
+    os.replace(merged_path, output_path)
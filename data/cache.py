@@ -0,0 +1,227 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import Counter
+
+from data import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+cache_path = os.path.join(BASE_DIR, 'collected', 'http_cache.sqlite')
+
+# Time to live (in seconds) of the cached responses of each endpoint
+TTLS = {
+    'appdetails': 7 * 24 * 60 * 60,
+    'appreviews': 24 * 60 * 60,
+    # Only reused by the retries of an update, it must not hide new reviews
+    'appreviews_updated': 60 * 60,
+}
+DEFAULT_TTL = 24 * 60 * 60
+
+# Size (in bytes) of the compressed responses above which the least recently
+# used ones are evicted
+MAX_SIZE = 2 * 1024 * 1024 * 1024
+# The total size is only checked every EVICTION_INTERVAL writes
+EVICTION_INTERVAL = 100
+
+class ResponseCache(object):
+    """On-disk cache of the JSON responses of the Steam endpoints.
+
+    Responses are stored zlib-compressed in a SQLite database, keyed by a hash
+    of the endpoint and its arguments. SQLite takes care of the locking, so the
+    same cache is shared by every collector process.
+    """
+    def __init__(self, path=cache_path, ttls=TTLS, max_size=MAX_SIZE):
+        """Initializes a ResponseCache.
+        Args:
+            path: the SQLite database file.
+            ttls: a dictionary mapping endpoint names to time to live in seconds.
+            max_size: the maximum total size of the stored responses in bytes.
+        """
+        self.path = path
+        self.ttls = ttls
+        self.max_size = max_size
+        self.enabled = True
+        self._connection = None
+        self._pid = None
+        self._num_writes = 0
+        # Hits and misses counted since the last flush_stats, by (endpoint, column)
+        self._stats = Counter()
+        self._stats_pid = os.getpid()
+
+    def _connect(self):
+        # SQLite connections can't be shared with the forked Pool workers
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, endpoint TEXT, created REAL, accessed REAL, size INTEGER, data BLOB)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS stats (endpoint TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def use(self, path):
+        """Switches to another database file."""
+        self.path = path
+        self._connection = None
+
+    @staticmethod
+    def make_key(endpoint, arguments):
+        """Content address of a request."""
+        request = json.dumps([endpoint, arguments], sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, endpoint, arguments):
+        """Returns the cached response of a request, or None."""
+        connection = self._connect()
+        key = self.make_key(endpoint, arguments)
+        row = connection.execute("SELECT created, data FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None and now - row[0] <= self.ttls.get(endpoint, DEFAULT_TTL):
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._count(endpoint, hit=True)
+            return json.loads(zlib.decompress(row[1]))
+
+        self._count(endpoint, hit=False)
+        return None
+
+    def put(self, endpoint, arguments, response):
+        """Stores the response of a request."""
+        connection = self._connect()
+        data = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time.time()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (self.make_key(endpoint, arguments), endpoint, now, now, len(data), data))
+
+        self._num_writes += 1
+        if self._num_writes % EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used responses until the cache fits in max_size."""
+        connection = self._connect()
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        # Evict down to 90% of max_size so that this doesn't run on every check
+        to_free = total_size - int(0.9 * self.max_size)
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            keys.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def _count(self, endpoint, hit):
+        column = 'hits' if hit else 'misses'
+        metrics.count('cache_' + column)
+        # The counts of the parent aren't the forked child's to write
+        if self._stats_pid != os.getpid():
+            self._stats = Counter()
+            self._stats_pid = os.getpid()
+        self._stats[endpoint, column] += 1
+
+    def flush_stats(self):
+        """Adds the hits and misses counted by this process to the database,
+        where the counts of every process are added up."""
+        if self._stats_pid != os.getpid() or not self._stats:
+            return
+        connection = self._connect()
+        connection.execute("BEGIN")
+        try:
+            for (endpoint, column), count in self._stats.items():
+                connection.execute("INSERT OR IGNORE INTO stats VALUES (?, 0, 0)", (endpoint,))
+                connection.execute(f"UPDATE stats SET {column} = {column} + ? WHERE endpoint = ?", (count, endpoint))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self._stats = Counter()
+
+    def stats(self):
+        """Returns a dictionary mapping endpoint names to (hits, misses)."""
+        self.flush_stats()
+        rows = self._connect().execute("SELECT endpoint, hits, misses FROM stats")
+        return {endpoint: (hits, misses) for endpoint, hits, misses in rows}
+
+    def reset_stats(self):
+        self._stats = Counter()
+        self._stats_pid = os.getpid()
+        if self.enabled:
+            self._connect().execute("DELETE FROM stats")
+
+    def report(self):
+        """Prints the hit/miss counters of every endpoint, including the ones
+        flushed by the other processes."""
+        if not self.enabled:
+            return
+        for endpoint, (hits, misses) in sorted(self.stats().items()):
+            total = hits + misses
+            hit_rate = hits / total if total else 0
+            print(f"Cache {endpoint}: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate)")
+
+cache = ResponseCache()
+
+def is_not_none(response):
+    return response is not None
+
+def cached(endpoint, ignore=(), is_valid=is_not_none):
+    """Decorator caching the JSON responses of an endpoint function in `cache`.
+
+    Works with regular and async functions. Only the responses accepted by
+    is_valid are cached, so that a failed request is sent again next time
+    instead of being replayed for the whole TTL.
+    Args:
+        endpoint: the endpoint name, used for the TTL and the counters.
+        ignore: names of the arguments that are not part of the request
+            (e.g. an HTTP session).
+        is_valid: function telling whether a response can be cached. By
+            default, every response but None (failed requests).
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def request_arguments(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return {name: str(value) for name, value in bound.arguments.items() if name not in ignore}
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not cache.enabled:
+                    return await func(*args, **kwargs)
+                arguments = request_arguments(args, kwargs)
+                response = cache.get(endpoint, arguments)
+                if response is None:
+                    response = await func(*args, **kwargs)
+                    if is_valid(response):
+                        cache.put(endpoint, arguments, response)
+                return response
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return func(*args, **kwargs)
+            arguments = request_arguments(args, kwargs)
+            response = cache.get(endpoint, arguments)
+            if response is None:
+                response = func(*args, **kwargs)
+                if is_valid(response):
+                    cache.put(endpoint, arguments, response)
+            return response
+        return wrapper
+
+    return decorator
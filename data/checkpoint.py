@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+checkpoints_path = os.path.join(BASE_DIR, 'collected', 'checkpoints.sqlite')
+
+class CheckpointStore(object):
+    """Persists, for every app, the cursor of the next batch of reviews to fetch.
+
+    A checkpoint is saved after the rows of a batch are written, so a killed
+    harvest can continue every app from its last cursor. The same database
+    holds the watermarks of the incremental updates.
+    """
+    def __init__(self, path=None):
+        path = path if path is not None else checkpoints_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "app_id TEXT PRIMARY KEY, cursor TEXT, batch INTEGER, done INTEGER, updated REAL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (app_id TEXT PRIMARY KEY, timestamp_updated INTEGER)")
+
+    def load(self):
+        """Returns a dictionary mapping app_ids to (cursor, batch, done)."""
+        rows = self._connection.execute("SELECT app_id, cursor, batch, done FROM checkpoints")
+        return {app_id: (cursor, batch, bool(done)) for app_id, cursor, batch, done in rows}
+
+    def save(self, app_id, cursor, batch, done=False):
+        """Saves the cursor and number of the next batch of an app."""
+        self._connection.execute(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+            (app_id, cursor, batch, int(done), time.time()))
+
+    def load_watermarks(self):
+        """Returns a dictionary mapping app_ids to the latest timestamp_updated
+        of their collected reviews."""
+        rows = self._connection.execute("SELECT app_id, timestamp_updated FROM watermarks")
+        return {app_id: timestamp_updated for app_id, timestamp_updated in rows}
+
+    def save_watermark(self, app_id, timestamp_updated):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (app_id, timestamp_updated))
+
+    def clear(self):
+        self._connection.execute("DELETE FROM checkpoints")
+
+    def close(self):
+        self._connection.close()
@@ -1,18 +1,42 @@
+import asyncio
+import glob
+import itertools
+import logging
 import os
 import time
-from multiprocessing import Lock, Manager, Pool, Process
+import zlib
+from array import array
+from multiprocessing import Lock, Manager, Pool, Process, Queue, active_children
+from queue import Empty
 
+import aiohttp
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import json
 import csv
 
 from common import config, utils
+from common.index import IdIndex, index_path_for
+from data.cache import cache, cached
+from data.checkpoint import CheckpointStore
+from data import checkpoint, metrics, ratelimit
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 games_txt_path = os.path.join(BASE_DIR, 'collected', config.GAMES_TXT)
 games_csv_path = os.path.join(BASE_DIR, 'collected', config.GAMES_CSV)
 users_games_csv_path = os.path.join(BASE_DIR, 'collected', config.USERS_GAMES_CSV)
 
+logger = logging.getLogger(__name__)
+
+# Number of rows buffered by ParquetSink before a row group is written
+PARQUET_BATCH_SIZE = 50000
+# File of a Parquet dataset holding the size and modification time of the CSV
+# file it was last known to match (files starting with '_' are not read as data)
+PARQUET_MARKER = '_csv_signature'
+
 GAMES_COLUMNS = [
     # Details
     'app_id',
@@ -39,6 +63,16 @@ GAMES_COLUMNS = [
     'total_reivews',
 ]
 
+# Number of app_ids whose details or reviews are fetched concurrently in async mode
+ASYNC_CONCURRENCY = 32
+# Seconds the parent of the review workers waits for a message before
+# checking that the workers are still alive
+WORKER_POLL_INTERVAL = 1.0
+
+# Base URL of the store endpoints (appdetails, appreviews), can point to a
+# local stand-in (see data/fakesteam.py)
+STORE_URL = os.environ.get('STEAM_STORE_URL', 'https://store.steampowered.com')
+
 USERS_GAMES_COLUMNS = [
     'recommendation_id',
     'steam_id',
@@ -61,6 +95,299 @@ USERS_GAMES_COLUMNS = [
     'written_during_early_access',
 ]
 
+# Column types of the Parquet output, in the order of GAMES_COLUMNS
+GAMES_TYPES = {
+    'app_id': pa.int64(),
+    'name': pa.string(),
+    'required_age': pa.int64(),
+    'is_free': pa.bool_(),
+    'developers': pa.list_(pa.string()),
+    'publishers': pa.list_(pa.string()),
+    'platforms_windows': pa.bool_(),
+    'platforms_mac': pa.bool_(),
+    'platforms_linux': pa.bool_(),
+    'metacritic': pa.int64(),
+    'categories': pa.list_(pa.string()),
+    'genres': pa.list_(pa.string()),
+    'recommendations': pa.int64(),
+    'coming_soon': pa.bool_(),
+    'release_date': pa.string(),
+    'review_score': pa.int64(),
+    'review_score_desc': pa.string(),
+    'total_positive': pa.int64(),
+    'total_negative': pa.int64(),
+    'total_reivews': pa.int64(),
+}
+
+# Column types of the Parquet output, in the order of USERS_GAMES_COLUMNS
+USERS_GAMES_TYPES = {
+    'recommendation_id': pa.int64(),
+    'steam_id': pa.int64(),
+    'app_id': pa.int64(),
+    'num_games_owned': pa.int64(),
+    'num_reviews': pa.int64(),
+    'playtime_forever': pa.int64(),
+    'playtime_last_two_weeks': pa.int64(),
+    'playtime_at_review': pa.int64(),
+    'last_played': pa.int64(),
+    'timestamp_created': pa.int64(),
+    'timestamp_updated': pa.int64(),
+    'voted_up': pa.bool_(),
+    'votes_up': pa.int64(),
+    'votes_funny': pa.int64(),
+    'weighted_vote_score': pa.float64(),
+    'comment_count': pa.int64(),
+    'steam_purchase': pa.bool_(),
+    'received_for_free': pa.bool_(),
+    'written_during_early_access': pa.bool_(),
+}
+
+# Typecodes (see the array module) of the columns of ReviewBatch, in the
+# order of USERS_GAMES_COLUMNS: int64 ids, counts and timestamps, uint8 flags
+# and a float32 score
+REVIEW_TYPECODES = {
+    name: 'B' if data_type == pa.bool_() else 'f' if pa.types.is_floating(data_type) else 'q'
+    for name, data_type in USERS_GAMES_TYPES.items()
+}
+_NUMPY_TYPES = {'q': np.int64, 'B': np.uint8, 'f': np.float32}
+
+# OUTPUT SINKS
+
+def parquet_path_for(csv_path):
+    """Directory holding the Parquet files written alongside a CSV file."""
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None  # "N/A" and missing values
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value == 'True'
+    return bool(value)
+
+def _to_list(value):
+    if value is None or value == "N/A":
+        return None
+    return value.split('|')
+
+def _converter(data_type):
+    if pa.types.is_integer(data_type):
+        return _to_int
+    if pa.types.is_floating(data_type):
+        return _to_float
+    if pa.types.is_boolean(data_type):
+        return _to_bool
+    if pa.types.is_list(data_type):
+        return _to_list
+    return str
+
+class CsvSink(object):
+    """Appends rows to a CSV file, writing the header if the file is new."""
+    def __init__(self, csv_path, columns):
+        is_new = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        self._file = open(csv_path, 'a', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(columns)
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+
+    def write_batch(self, batch):
+        self._writer.writerows(batch.text_rows())
+
+    def sync(self):
+        """Makes the rows written so far survive a crash of the process."""
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class ParquetSink(object):
+    """Writes rows as typed, zstd-compressed Parquet row groups.
+
+    Every sink writes a new part file in the dataset directory, so the whole
+    table is read with pd.read_parquet(directory, columns=[...]).
+    """
+    def __init__(self, directory, types, batch_size=PARQUET_BATCH_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self._path = os.path.join(directory, f"part-{time.time_ns()}-{os.getpid()}.parquet")
+        self._schema = pa.schema(list(types.items()))
+        self._converters = [_converter(data_type) for data_type in types.values()]
+        self._columns = [[] for _ in types]
+        # Tables of the batches written since the last flush
+        self._tables = []
+        self._batch_size = batch_size
+        self._num_buffered = 0
+        self._writer = None
+
+    def write_rows(self, rows):
+        for row in rows:
+            for column, convert, value in zip(self._columns, self._converters, row):
+                column.append(convert(value))
+            self._num_buffered += 1
+        if self._num_buffered >= self._batch_size:
+            self.flush()
+
+    def write_batch(self, batch):
+        self._tables.append(batch.to_table(self._schema))
+        self._num_buffered += len(batch)
+        if self._num_buffered >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._num_buffered:
+            return
+        tables = self._tables
+        if self._columns[0]:
+            tables.append(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(self._columns, self._schema)],
+                schema=self._schema
+            ))
+        table = pa.concat_tables(tables)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._path, self._schema, compression='zstd')
+        self._writer.write_table(table)
+        self._columns = [[] for _ in self._columns]
+        self._tables = []
+        self._num_buffered = 0
+
+    def sync(self):
+        # A Parquet file is only readable once closed, after a crash it is
+        # rebuilt from the CSV file with export_parquet.
+        pass
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+class MultiSink(object):
+    """Writes the same rows to several sinks."""
+    def __init__(self, sinks):
+        self._sinks = sinks
+
+    def write_rows(self, rows):
+        for sink in self._sinks:
+            sink.write_rows(rows)
+
+    def write_batch(self, batch):
+        for sink in self._sinks:
+            sink.write_batch(batch)
+
+    def sync(self):
+        for sink in self._sinks:
+            sink.sync()
+
+    def close(self):
+        for sink in self._sinks:
+            sink.close()
+
+def open_sink(csv_path, types, parquet=False):
+    """Opens the output of a table: its CSV file, and optionally a Parquet
+    dataset next to it.
+    Args:
+        csv_path: the CSV file of the table.
+        types: the column types (GAMES_TYPES or USERS_GAMES_TYPES).
+        parquet: whether to also write the rows as Parquet.
+    """
+    sink = CsvSink(csv_path, list(types))
+    if parquet:
+        sink = MultiSink([sink, ParquetSink(parquet_path_for(csv_path), types)])
+    return sink
+
+def _csv_signature(csv_path):
+    stat = os.stat(csv_path)
+    return f"{stat.st_size} {stat.st_mtime_ns}"
+
+def parquet_is_current(csv_path):
+    """Whether the Parquet dataset of a table holds the same rows as its CSV
+    file.
+
+    It doesn't after a harvest without --parquet, a change of the CSV file
+    (e.g. drop_duplicated_users_games_data) or a crash, which also leaves a
+    part file that can't be read. A table without CSV file matches an empty
+    dataset.
+    """
+    parquet_path = parquet_path_for(csv_path)
+    if not os.path.exists(csv_path):
+        return not os.path.isdir(parquet_path) or not any(
+            file_name.endswith('.parquet') for file_name in os.listdir(parquet_path))
+    try:
+        with open(os.path.join(parquet_path, PARQUET_MARKER), 'r', encoding='utf-8') as f:
+            return f.read() == _csv_signature(csv_path)
+    except FileNotFoundError:
+        return False
+
+def mark_parquet_current(csv_path):
+    """Records that the Parquet dataset of a table matches its CSV file."""
+    parquet_path = parquet_path_for(csv_path)
+    os.makedirs(parquet_path, exist_ok=True)
+    with open(os.path.join(parquet_path, PARQUET_MARKER), 'w', encoding='utf-8') as f:
+        f.write(_csv_signature(csv_path))
+
+def finish_parquet(csv_path, types, was_current):
+    """Marks the Parquet dataset written by a harvest as matching the CSV file
+    (once the CSV file is sorted), or rebuilds it if it was stale before the
+    harvest.
+    Args:
+        csv_path: the CSV file of the table.
+        types: the column types (GAMES_TYPES or USERS_GAMES_TYPES).
+        was_current: parquet_is_current(csv_path) before the harvest.
+    """
+    if was_current:
+        mark_parquet_current(csv_path)
+    else:
+        logger.info("Rebuilding the Parquet dataset of '%s'...", csv_path)
+        export_parquet(csv_path, types)
+
+def export_parquet(csv_path, types):
+    """Rewrite the Parquet dataset of a table from its CSV file, e.g. for the
+    rows collected before the Parquet output was enabled."""
+    parquet_path = parquet_path_for(csv_path)
+    if os.path.isdir(parquet_path):
+        for file_name in os.listdir(parquet_path):
+            os.remove(os.path.join(parquet_path, file_name))
+
+    sink = ParquetSink(parquet_path, types)
+    try:
+        with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader) # Skip the header
+            for row in reader:
+                sink.write_rows([row])
+    finally:
+        sink.close()
+    mark_parquet_current(csv_path)
+
+def read_table(csv_path, columns=None):
+    """Reads a collected table, from its Parquet dataset if it matches the
+    CSV file (see parquet_is_current).
+    Args:
+        csv_path: the CSV file of the table.
+        columns: optional list of the columns to read.
+    Returns:
+        A pandas DataFrame.
+    """
+    if os.path.exists(csv_path) and parquet_is_current(csv_path):
+        return pd.read_parquet(parquet_path_for(csv_path), columns=columns)
+    return pd.read_csv(csv_path, usecols=columns)
+
+def read_games_data(columns=None):
+    return read_table(games_csv_path, columns)
+
+def read_users_games_data(columns=None):
+    return read_table(users_games_csv_path, columns)
+
 # USERS RELATED APIs
 
 def resolve_vanity_url(vanity_url):
@@ -70,7 +397,7 @@ def resolve_vanity_url(vanity_url):
     """
 
     url = f"https://api.steampowered.com/ISteamUser/ResolveVanityURL/v1/?key={config.STEAM_API_KEY}&vanityurl={vanity_url}"
-    response = requests.get(url)
+    response = ratelimit.get(url)
     return json.loads(response.text)
 
 
@@ -81,16 +408,29 @@ def get_player_summaries(steam_id):
     """
 
     url = f"https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v2/?key={config.STEAM_API_KEY}&steamids={steam_id}"
-    response = requests.get(url)
+    response = ratelimit.get(url)
     return json.loads(response.text)
 
 def get_recently_played_games(steam_id):
     url = f"https://api.steampowered.com/IPlayerService/GetRecentlyPlayedGames/v1/?key={config.STEAM_API_KEY}&steamid={steam_id}"
-    response = requests.get(url)
+    response = ratelimit.get(url)
     return json.loads(response.text)
 
 # GAMES (APPS) RELATED APIs
 
+def is_successful(response):
+    """Whether an appreviews response succeeded (success is 1), so that it can
+    be cached. A failed one has to be requested again."""
+    return isinstance(response, dict) and response.get('success') in (1, True)
+
+def are_details_successful(response):
+    """Whether an appdetails response ({app_id: {'success': ...}}) succeeded
+    for every app, so that it can be cached."""
+    return isinstance(response, dict) and bool(response) and all(
+        isinstance(details, dict) and details.get('success') in (1, True) for details in response.values())
+
+@cached('appdetails', is_valid=are_details_successful)
+@metrics.timed('appdetails')
 def get_app_details(app_id):
     """Get app details in English.
     Args:
@@ -100,10 +440,25 @@ def get_app_details(app_id):
               retrieved from the API.
     """
 
-    url = f"https://store.steampowered.com/api/appdetails?appids={app_id}&lang=en"
-    response = requests.get(url)
+    url = f"{STORE_URL}/api/appdetails?appids={app_id}&lang=en"
+    response = ratelimit.get(url)
     return json.loads(response.text.encode('utf-8-sig'))
 
+@cached('appdetails', ignore=('session',), is_valid=are_details_successful)
+@metrics.timed('appdetails')
+async def get_app_details_async(session, app_id):
+    """Get app details in English using a shared aiohttp session.
+
+    The endpoint only returns the full details for a single app_id (several
+    appids are only accepted with filters=price_overview), so there is one
+    request per app.
+    """
+    url = f"{STORE_URL}/api/appdetails"
+    status, body = await ratelimit.get_async(session, url, params={'appids': app_id, 'lang': 'en'})
+    return json.loads(body.decode('utf-8-sig'))
+
+@cached('appreviews', is_valid=is_successful)
+@metrics.timed('appreviews')
 def get_app_reviews(app_id, cursor='*'):
     """Get app reviews
     Args:
@@ -114,11 +469,104 @@ def get_app_reviews(app_id, cursor='*'):
               retrieved from the API.
     """
     cursor = requests.utils.quote(cursor)
-    url = f"https://store.steampowered.com/appreviews/{app_id}?json=1&language=all&num_per_page=100&cursor={cursor}"
-    response = requests.get(url)
+    url = f"{STORE_URL}/appreviews/{app_id}?json=1&language=all&num_per_page=100&cursor={cursor}"
+    response = ratelimit.get(url)
     return json.loads(response.text.encode('utf-8-sig'))
 
-def collect_games_data():
+@cached('appreviews', ignore=('session',), is_valid=is_successful)
+@metrics.timed('appreviews')
+async def get_app_reviews_async(session, app_id, cursor='*'):
+    """Get app reviews using a shared aiohttp session.
+    Args:
+        session (aiohttp.ClientSession): The session holding the connection pool.
+        app_id (str): The game's id.
+        cursor (str): The cursor returned by the previous batch.
+
+    Returns:
+        dict: A Python dictionary containing the app reviews
+              retrieved from the API.
+    """
+    url = f"{STORE_URL}/appreviews/{app_id}"
+    params = {'json': 1, 'language': 'all', 'num_per_page': 100, 'cursor': cursor}
+    status, body = await ratelimit.get_async(session, url, params=params)
+    return json.loads(body.decode('utf-8-sig'))
+
+@cached('appreviews_updated', ignore=('session',), is_valid=is_successful)
+@metrics.timed('appreviews_updated')
+async def get_updated_app_reviews_async(session, app_id, cursor='*'):
+    """Get app reviews, most recently updated first.
+    Args:
+        session (aiohttp.ClientSession): The session holding the connection pool.
+        app_id (str): The game's id.
+        cursor (str): The cursor returned by the previous batch.
+
+    Returns:
+        dict: A Python dictionary containing the app reviews
+              retrieved from the API.
+    """
+    url = f"{STORE_URL}/appreviews/{app_id}"
+    params = {'json': 1, 'language': 'all', 'num_per_page': 100, 'cursor': cursor, 'filter': 'updated'}
+    status, body = await ratelimit.get_async(session, url, params=params)
+    return json.loads(body.decode('utf-8-sig'))
+
+def build_game_row(app_id, app_details, app_reviews):
+    """Build a row of GAMES_COLUMNS.
+    Args:
+        app_id (str): The game's id.
+        app_details (dict): The game's entry in the appdetails API response.
+        app_reviews (dict): The appreviews API response.
+    Returns:
+        list: The row to write to the games CSV.
+    """
+    name = app_details['data']['name']
+    required_age = app_details['data']['required_age']
+    is_free = app_details['data']['is_free']
+    developers = '|'.join(developer for developer in app_details['data']['developers']) if 'developers' in app_details['data'] else "N/A"
+    publishers = '|'.join(publisher for publisher in app_details['data']['publishers']) if 'publishers' in app_details['data'] else "N/A"
+    platforms_windows = app_details['data']['platforms']['windows']
+    platforms_mac = app_details['data']['platforms']['mac']
+    platforms_linux = app_details['data']['platforms']['linux']
+    metacritic = app_details['data']['metacritic']['score'] if 'metacritic' in app_details['data'] else "N/A"
+    categories = '|'.join(category['description'] for category in app_details['data']['categories']) if 'categories' in app_details['data'] else "N/A"
+    genres = '|'.join(genre['description'] for genre in app_details['data']['genres']) if 'genres' in app_details['data'] else "N/A"
+    recommendations = app_details['data']['recommendations']['total'] if 'recommendations' in app_details['data'] else "N/A"
+    coming_soon = app_details['data']['release_date']['coming_soon']
+    release_date = app_details['data']['release_date']['date']
+
+    review_score = app_reviews['query_summary']['review_score']
+    review_score_desc = app_reviews['query_summary']['review_score_desc']
+    total_positive = app_reviews['query_summary']['total_positive']
+    total_negative = app_reviews['query_summary']['total_negative']
+    total_reviews = app_reviews['query_summary']['total_reviews']
+
+    return [
+        # Details
+        app_id,
+        name,
+        required_age,
+        is_free,
+        developers,
+        publishers,
+        platforms_windows,
+        platforms_mac,
+        platforms_linux,
+        metacritic,
+        categories,
+        genres,
+        recommendations,
+        coming_soon,
+        release_date,
+
+        # Reviews
+        review_score,
+        review_score_desc,
+        total_positive,
+        total_negative,
+        total_reviews
+    ]
+
+def read_existing_games():
+    """Returns the set of app_ids already in the games CSV."""
     existing_games = set()
     if os.path.exists(games_csv_path):
         with open(games_csv_path, 'r', newline='', encoding='utf-8') as csv_file:
@@ -126,233 +574,782 @@ def collect_games_data():
             next(reader) # Skip the header
             for row in reader:
                 existing_games.add(row[0])
+    return existing_games
+
+def collect_games_data(parquet=False):
+    cache.reset_stats()
 
-    with open(games_csv_path, 'a', newline='', encoding='utf-8') as csv_file:
-        writer = csv.writer(csv_file)
-        if not existing_games:
-            writer.writerow(GAMES_COLUMNS)
+    existing_games = read_existing_games()
 
+    parquet_was_current = parquet and parquet_is_current(games_csv_path)
+    sink = open_sink(games_csv_path, GAMES_TYPES, parquet)
+    try:
         with open(games_txt_path, 'r', encoding='utf-8') as f:
             for line in f.readlines():
                 app_id = line.rstrip()
                 if app_id in existing_games:
-                    print(f"Skipping {app_id}. Data already collected.")
+                    logger.debug("Skipping %s. Data already collected.", app_id)
                     continue
 
-                print(f"Retrieving details and reviews for: {app_id}...", end=" ")
+                logger.debug("Retrieving details and reviews for: %s...", app_id)
 
                 for i in range(5): # Retry up to 5 times
                     try:
                         app_details = get_app_details(app_id)[f"{app_id}"]
                         break
                     except TypeError:
-                        print("TYPE_ERROR")
-                        print(f"Failed to get app details for {app_id}. Retrying (attempt #{i + 1}) in 5 seconds...")
-                        time.sleep(5)
+                        delay = ratelimit.backoff(i)
+                        logger.warning("Failed to get app details for %s (TYPE_ERROR). Retrying (attempt #%d) in %.1f seconds...",
+                                       app_id, i + 1, delay)
+                        time.sleep(delay)
                 else:
-                    print(f"Failed to get details for {app_id} after 5 attempts")
+                    logger.warning("Failed to get details for %s after 5 attempts", app_id)
+                    metrics.count('apps_failed')
                     continue
 
                 app_reviews = get_app_reviews(app_id)
 
                 if app_details['success'] == True and app_reviews['success'] == True:
-                    name = app_details['data']['name']
-                    required_age = app_details['data']['required_age']
-                    is_free = app_details['data']['is_free']
-                    developers = '|'.join(developer for developer in app_details['data']['developers']) if 'developers' in app_details['data'] else "N/A"
-                    publishers = '|'.join(publisher for publisher in app_details['data']['publishers']) if 'publishers' in app_details['data'] else "N/A"
-                    platforms_windows = app_details['data']['platforms']['windows']
-                    platforms_mac = app_details['data']['platforms']['mac']
-                    platforms_linux = app_details['data']['platforms']['linux']
-                    metacritic = app_details['data']['metacritic']['score'] if 'metacritic' in app_details['data'] else "N/A"
-                    categories = '|'.join(category['description'] for category in app_details['data']['categories']) if 'categories' in app_details['data'] else "N/A"
-                    genres = '|'.join(genre['description'] for genre in app_details['data']['genres']) if 'genres' in app_details['data'] else "N/A"
-                    recommendations = app_details['data']['recommendations']['total'] if 'recommendations' in app_details['data'] else "N/A"
-                    coming_soon = app_details['data']['release_date']['coming_soon']
-                    release_date = app_details['data']['release_date']['date']
-
-                    review_score = app_reviews['query_summary']['review_score']
-                    review_score_desc = app_reviews['query_summary']['review_score_desc']
-                    total_positive = app_reviews['query_summary']['total_positive']
-                    total_negative = app_reviews['query_summary']['total_negative']
-                    total_reviews = app_reviews['query_summary']['total_reviews']
-
-                    row = [
-                        # Details
-                        app_id,
-                        name,
-                        required_age,
-                        is_free,
-                        developers,
-                        publishers,
-                        platforms_windows,
-                        platforms_mac,
-                        platforms_linux,
-                        metacritic,
-                        categories,
-                        genres,
-                        recommendations,
-                        coming_soon,
-                        release_date,
-
-                        # Reviews
-                        review_score,
-                        review_score_desc,
-                        total_positive,
-                        total_negative,
-                        total_reviews
-                    ]
-
-                    writer.writerow(row)
-
-                    print("SUCCESS")
+                    row = build_game_row(app_id, app_details, app_reviews)
+                    with metrics.timer('write'):
+                        sink.write_rows([row])
+                    metrics.count('rows_written')
+                    metrics.count('apps_done')
+                    logger.info("%s: SUCCESS", app_id)
                 else:
-                    print("FAILURE")
+                    metrics.count('apps_failed')
+                    logger.warning("%s: FAILURE", app_id)
+    finally:
+        sink.close()
+
+    with metrics.timer('sort'):
+        utils.read_and_sort_csv(games_csv_path, 0, as_number=True)
+    if parquet:
+        finish_parquet(games_csv_path, GAMES_TYPES, parquet_was_current)
+    logger.info("Successfully written to '%s'", games_csv_path)
+    cache.report()
+
+async def process_game_async(session, app_id):
+    """Fetch the details and the review summary of a game concurrently.
+    Returns:
+        list: The GAMES_COLUMNS row, or None if the game couldn't be collected.
+    """
+    for i in range(5): # Retry up to 5 times
+        try:
+            app_details, app_reviews = await asyncio.gather(
+                get_app_details_async(session, app_id),
+                get_app_reviews_async(session, app_id)
+            )
+            app_details = app_details[f"{app_id}"]
+            break
+        except Exception as e:
+            delay = ratelimit.backoff(i)
+            logger.warning("%s: EXCEPTION: %s. Retrying (attempt #%d) in %.1f seconds...", app_id, e, i + 1, delay)
+            await asyncio.sleep(delay)
+    else:
+        logger.warning("Failed to get details for %s after 5 attempts", app_id)
+        metrics.count('apps_failed')
+        return None
+
+    if app_details['success'] == True and app_reviews['success'] == True:
+        logger.info("%s: SUCCESS", app_id)
+        metrics.count('apps_done')
+        return build_game_row(app_id, app_details, app_reviews)
+
+    logger.warning("%s: FAILURE", app_id)
+    metrics.count('apps_failed')
+    return None
+
+async def harvest_games(app_ids, sink, concurrency=ASYNC_CONCURRENCY):
+    """Collect the games of app_ids with `concurrency` of them in flight."""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = iter(app_ids)
+
+        async def worker():
+            for app_id in pending:
+                row = await process_game_async(session, app_id)
+                if row is not None:
+                    with metrics.timer('write'):
+                        sink.write_rows([row])
+                    metrics.count('rows_written')
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+def collect_games_data_async(concurrency=ASYNC_CONCURRENCY, parquet=False):
+    """Same as collect_games_data, but collects `concurrency` games at the same
+    time on a single event loop.
+    """
+    start_time = time.time()
+    cache.reset_stats()
+
+    existing_games = read_existing_games()
+    with open(games_txt_path, 'r', encoding='utf-8') as f:
+        all_app_ids = list(dict.fromkeys(line.rstrip() for line in f))
+    app_ids = [app_id for app_id in all_app_ids if app_id not in existing_games]
+    logger.info("Skipping %d games already collected, %d to go.", len(all_app_ids) - len(app_ids), len(app_ids))
+
+    parquet_was_current = parquet and parquet_is_current(games_csv_path)
+    sink = open_sink(games_csv_path, GAMES_TYPES, parquet)
+    try:
+        asyncio.run(harvest_games(app_ids, sink, concurrency))
+    finally:
+        sink.close()
+
+    with metrics.timer('sort'):
+        utils.read_and_sort_csv(games_csv_path, 0, as_number=True)
+    if parquet:
+        finish_parquet(games_csv_path, GAMES_TYPES, parquet_was_current)
+    logger.info("Successfully written to '%s'", games_csv_path)
+
+    execution_time = time.time() - start_time
+    logger.info("Finished in %.1f seconds.", execution_time)
+    cache.report()
+
+class ReviewBatch(object):
+    """Reviews stored column by column, in a typed array per column of
+    USERS_GAMES_COLUMNS (see REVIEW_TYPECODES).
+
+    A review takes about 120 bytes instead of a list of 19 Python objects,
+    and a batch is pickled (e.g. through the pages queue) as a few buffers.
+    The rows are only formatted, in bulk, when they are written.
+    """
+    __slots__ = ('columns',)
+
+    def __init__(self, columns=None):
+        """Initializes a ReviewBatch.
+        Args:
+            columns: optional dictionary mapping every column of
+                USERS_GAMES_COLUMNS to an array of REVIEW_TYPECODES.
+        """
+        if columns is None:
+            columns = {name: array(typecode) for name, typecode in REVIEW_TYPECODES.items()}
+        self.columns = columns
+
+    @classmethod
+    def from_reviews(cls, app_id, reviews):
+        """Builds a batch from reviews of the appreviews API.
+        Args:
+            app_id (str): The game's id.
+            reviews (list): The reviews, as returned by the API.
+        """
+        authors = [review['author'] for review in reviews]
+        return cls({
+            'recommendation_id': array('q', [int(review['recommendationid']) for review in reviews]),
+            'steam_id': array('q', [int(author['steamid']) for author in authors]),
+            'app_id': array('q', [int(app_id)]) * len(reviews),
+            'num_games_owned': array('q', [author.get('num_games_owned', 0) for author in authors]),
+            'num_reviews': array('q', [author.get('num_reviews', 0) for author in authors]),
+            'playtime_forever': array('q', [author.get('playtime_forever', 0) for author in authors]),
+            'playtime_last_two_weeks': array('q', [author.get('playtime_last_two_weeks', 0) for author in authors]),
+            'playtime_at_review': array('q', [author.get('playtime_at_review', 0) for author in authors]),
+            'last_played': array('q', [author.get('last_played', 0) for author in authors]),
+            'timestamp_created': array('q', [review['timestamp_created'] for review in reviews]),
+            'timestamp_updated': array('q', [review['timestamp_updated'] for review in reviews]),
+            'voted_up': array('B', [review['voted_up'] for review in reviews]),
+            'votes_up': array('q', [review['votes_up'] for review in reviews]),
+            'votes_funny': array('q', [review['votes_funny'] for review in reviews]),
+            # A string in the API
+            'weighted_vote_score': array('f', [float(review['weighted_vote_score']) for review in reviews]),
+            'comment_count': array('q', [review['comment_count'] for review in reviews]),
+            'steam_purchase': array('B', [review['steam_purchase'] for review in reviews]),
+            'received_for_free': array('B', [review['received_for_free'] for review in reviews]),
+            'written_during_early_access': array('B', [review['written_during_early_access'] for review in reviews]),
+        })
+
+    def __len__(self):
+        return len(self.columns['recommendation_id'])
+
+    @property
+    def recommendation_ids(self):
+        return self.columns['recommendation_id']
+
+    def select(self, mask):
+        """Returns the batch of the reviews whose mask value is true."""
+        return ReviewBatch({name: array(column.typecode, itertools.compress(column, mask))
+                            for name, column in self.columns.items()})
+
+    def arrays(self):
+        """Returns the columns as NumPy arrays sharing their memory."""
+        return {name: np.frombuffer(column, dtype=_NUMPY_TYPES[column.typecode])
+                for name, column in self.columns.items()}
+
+    def text_rows(self):
+        """Returns the CSV rows of the batch, formatted a column at a time.
+
+        The flags are written as True/False, like the rows written before.
+        """
+        columns = []
+        for column in self.arrays().values():
+            if column.dtype == np.uint8:
+                columns.append(np.array(['False', 'True'])[column].tolist())
+            else:
+                columns.append(column.astype(str).tolist())
+        return zip(*columns)
+
+    def to_table(self, schema):
+        """Returns the batch as a pyarrow Table of schema."""
+        arrays = self.arrays()
+        return pa.Table.from_arrays(
+            [pa.array(arrays[field.name].astype(bool) if field.type == pa.bool_() else arrays[field.name],
+                      type=field.type) for field in schema],
+            schema=schema
+        )
 
-    utils.read_and_sort_csv(games_csv_path, 0, as_number=True)
-    print(f"Successfully written to '{games_csv_path}'")
+# Set in every Pool worker by init_review_worker
+existing_recommendations = None
+pages_queue = None
+
+def init_review_worker(queue, limiter, registry, csv_path):
+    """Pool initializer: memory-map the recommendation_id index of csv_path
+    once per worker so that dedup checks are local lookups instead of IPC
+    round-trips, and share the rate limiter and the metrics of the parent
+    process.
+    """
+    global existing_recommendations, pages_queue
+    existing_recommendations = IdIndex.open(index_path_for(csv_path))
+    pages_queue = queue
+    ratelimit.limiter = limiter
+    metrics.registry = registry
 
 def process_game_reviews(args):
-    app_id, existing_recommendations, lock = args
+    """Collect the reviews of a game that are not collected yet.
 
-    print(f"Retrieving reviews for: {app_id}...", end=" ")
+    Every batch is sent to the parent process through pages_queue as
+    (pid, app_id, next_cursor, next_batch, reviews, status), reviews being a
+    ReviewBatch, so that it is written and checkpointed before the next one is
+    fetched. status is 'started' for the first message of the app (so that
+    the parent knows which process to watch), then 'page', then 'done' or
+    'failed' for the last one.
+    Args:
+        args (tuple): The game's id, and the cursor and number of the first batch.
+    """
+    app_id, cursor, first_batch = args
+    pid = os.getpid()
+    pages_queue.put((pid, app_id, cursor, first_batch, None, 'started'))
 
-    rows = []
-    cursor = '*'
+    logger.debug("Retrieving reviews for: %s...", app_id)
+
+    try:
+        cursor_history = []
+        for batch in range(first_batch, 50):
+            attempts = 2
+            for i in range(attempts):
+                try:
+                    app_reviews = get_app_reviews(app_id, cursor)
+                    if app_reviews is None:
+                        delay = ratelimit.backoff(i)
+                        logger.warning("%s: Failed to get app reviews. Retrying (attempt #%d) in %.1f seconds...",
+                                       app_id, i + 1, delay)
+                        time.sleep(delay)
+                        continue
+                    break
+                except Exception as e:
+                    delay = ratelimit.backoff(i)
+                    logger.warning("%s: EXCEPTION: %s. Retrying (attempt #%d) in %.1f seconds...", app_id, e, i + 1, delay)
+                    time.sleep(delay)
+            else:
+                # Not sent as done, so that a resumed run continues from the last cursor
+                raise RuntimeError(f"Failed to get reviews after {attempts} attempts")
+
+            if app_reviews['success'] == True:
+                if cursor in cursor_history:
+                    logger.debug("%s: Already processed batch #%d (cursor=%s).", app_id, batch + 1, cursor)
+                    cursor = app_reviews['cursor']
+                    continue
+
+                reviews = app_reviews['reviews']
+                logger.debug("%s: Retrieving review data from %d reviews (batch #%d)...", app_id, len(reviews), batch + 1)
+
+                with metrics.timer('dedup'):
+                    new_reviews = ReviewBatch.from_reviews(app_id, [
+                        review for review in reviews if review['recommendationid'] not in existing_recommendations
+                    ])
+                metrics.count('pages')
+                metrics.count('reviews_fetched', len(reviews))
+                metrics.count('reviews_skipped', len(reviews) - len(new_reviews))
+
+                cursor_history.append(cursor)
+                cursor = app_reviews['cursor']
+                pages_queue.put((pid, app_id, cursor, batch + 1, new_reviews, 'page'))
+                if cursor == '*':
+                    logger.debug("%s: Last batch of reviews reached.", app_id)
+                    break
+            else:
+                raise RuntimeError("FAILURE")
+    except Exception as e:
+        logger.warning("%s: EXCEPTION: %s", app_id, e)
+        pages_queue.put((pid, app_id, cursor, None, None, 'failed'))
+    else:
+        pages_queue.put((pid, app_id, cursor, None, None, 'done'))
+    finally:
+        # The parent may read the totals as soon as the last message is received
+        metrics.registry.flush()
+        cache.flush_stats()
+
+def write_new_reviews(reviews, existing_recommendations, sink):
+    """Write the reviews (a ReviewBatch) whose recommendation_id is not
+    collected yet.
+    Returns:
+        int: The number of rows written.
+    """
+    is_new = []
+    for recommendation_id in reviews.recommendation_ids:
+        new = recommendation_id not in existing_recommendations
+        if new:
+            existing_recommendations.add(recommendation_id)
+        is_new.append(new)
+    new_reviews = reviews.select(is_new)
+    sink.write_batch(new_reviews)
+    metrics.count('rows_written', len(new_reviews))
+    return len(new_reviews)
+
+def review_tasks(app_ids, checkpoints, resume):
+    """Returns the (app_id, cursor, first_batch) to process.
+
+    With resume, the apps that were completed are skipped and the others
+    continue from their last checkpoint. Otherwise the checkpoints are cleared
+    and every app starts from the first batch.
+    """
+    if not resume:
+        checkpoints.clear()
+        return [(app_id, '*', 1) for app_id in app_ids]
+
+    saved = checkpoints.load()
+    tasks = []
+    for app_id in app_ids:
+        cursor, batch, done = saved.get(app_id, ('*', 1, False))
+        if not done:
+            tasks.append((app_id, cursor, batch))
+    logger.info("Resuming: %d games already completed, %d to go.", len(app_ids) - len(tasks), len(tasks))
+    return tasks
+
+def shard_path(path, shard, num_shards):
+    """Path of the segment of a shard, e.g. user_game.shard-0-of-4.csv."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard}-of-{num_shards}{ext}"
+
+def shard_app_ids(app_ids, shard, num_shards):
+    """Returns the app_ids of a shard.
+
+    The partition only depends on the app_ids, so every host computes the
+    same one from the same games.txt. app_ids are hashed rather than split in
+    ranges since the old (low) app_ids have most of the reviews.
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"shard should be in [0, {num_shards}), got: {shard}")
+    return [app_id for app_id in app_ids if zlib.crc32(app_id.encode('utf-8')) % num_shards == shard]
+
+def parse_shard(value):
+    """Parses 'i/n' (the i-th of n shards, from 0) into (i, n)."""
+    shard, num_shards = (int(part) for part in value.split('/'))
+    return shard, num_shards
+
+def open_review_harvest(shard=None):
+    """Returns the app_ids to collect the reviews of, the CSV file to write
+    them to, its recommendation_id index and the checkpoints.
+
+    With shard=(i, n), only the app_ids of the i-th of n shards are collected,
+    into a segment with its own index and checkpoints, so that shards can run
+    on several hosts (or processes) without sharing a file. The segments are
+    combined by merge_users_games_shards. The reviews already in the canonical
+    table of this host are not collected again.
+    """
+    with open(games_txt_path, 'r', encoding='utf-8') as f:
+        app_ids = list(dict.fromkeys(line.rstrip() for line in f))
+
+    if shard is None:
+        return app_ids, users_games_csv_path, IdIndex.load(users_games_csv_path), CheckpointStore()
+
+    csv_path = shard_path(users_games_csv_path, *shard)
+    recommendations_index = IdIndex.load(csv_path)
+    if os.path.exists(users_games_csv_path):
+        canonical = IdIndex.load(users_games_csv_path)
+        recommendations_index = IdIndex(np.union1d(recommendations_index.merged(), canonical.merged()))
+        recommendations_index.save(index_path_for(csv_path))
+    checkpoints = CheckpointStore(shard_path(checkpoint.checkpoints_path, *shard))
+    return shard_app_ids(app_ids, *shard), csv_path, recommendations_index, checkpoints
+
+def check_review_workers(result, running):
+    """Raises an error if the review workers can't finish their tasks.
+
+    A worker that crashes or is killed never sends the last message of its
+    app, and the Pool replaces it without failing the map, so the parent
+    would wait forever.
+    Args:
+        result: the AsyncResult of the map.
+        running (dict): maps the pid of every busy worker to its app_id.
+    """
+    if result.ready():
+        # Raises the error of a task, if any
+        result.get()
+        raise RuntimeError("The review workers stopped before sending every result")
+    alive = {process.pid for process in active_children()}
+    dead = {pid: app_id for pid, app_id in running.items() if pid not in alive}
+    if dead:
+        raise RuntimeError(f"The worker processes {', '.join(map(str, dead))} collecting the reviews of "
+                           f"{', '.join(dead.values())} died, continue with --resume")
+
+def collect_users_games_data(parquet=False, resume=False, shard=None):
+    start_time = time.time();
+    cache.reset_stats()
+
+    # The index is loaded (and rebuilt if stale) once here, the workers
+    # memory-map the saved file
+    app_ids, csv_path, recommendations_index, checkpoints = open_review_harvest(shard)
+    tasks = review_tasks(app_ids, checkpoints, resume)
+
+    # The workers only fetch, the rows are all written by this process so that
+    # no lock is needed around the output. A batch is checkpointed once its
+    # rows are flushed to the CSV file.
+    parquet_was_current = parquet and parquet_is_current(csv_path)
+    sink = open_sink(csv_path, USERS_GAMES_TYPES, parquet)
+    queue = Queue()
+    try:
+        with Pool(initializer=init_review_worker,
+                  initargs=(queue, ratelimit.limiter, metrics.registry, csv_path)) as p:
+            result = p.map_async(process_game_reviews, tasks)
+            remaining = len(tasks)
+            # Maps the pid of every busy worker to its app_id
+            running = {}
+            while remaining:
+                try:
+                    pid, app_id, cursor, batch, reviews, status = queue.get(timeout=WORKER_POLL_INTERVAL)
+                except Empty:
+                    check_review_workers(result, running)
+                    continue
+                if status == 'started':
+                    running[pid] = app_id
+                elif status == 'page':
+                    with metrics.timer('write'):
+                        write_new_reviews(reviews, recommendations_index, sink)
+                        sink.sync()
+                    checkpoints.save(app_id, cursor, batch)
+                else:
+                    if status == 'done':
+                        checkpoints.save(app_id, cursor, None, done=True)
+                        metrics.count('apps_done')
+                    else:
+                        metrics.count('apps_failed')
+                    running.pop(pid, None)
+                    remaining -= 1
+            result.get()
+    finally:
+        sink.close()
+        checkpoints.close()
+
+    logger.info("Sorting by recommendation_id...")
+    with metrics.timer('sort'):
+        utils.read_and_sort_csv(csv_path, 0)
+    if parquet:
+        finish_parquet(csv_path, USERS_GAMES_TYPES, parquet_was_current)
+    # Saved after sorting so that the index is newer than the CSV file
+    with metrics.timer('index_save'):
+        recommendations_index.save(index_path_for(csv_path))
+    logger.info("Successfully written to '%s'", csv_path)
+
+    end_time = time.time();
+    execution_time = end_time - start_time
+    logger.info("Finished in %.1f seconds.", execution_time)
+    cache.report()
+
+async def process_game_reviews_async(session, task, existing_recommendations, sink, checkpoints):
+    """Async counterpart of process_game_reviews.
+
+    Runs on the event loop, so every batch is written and checkpointed
+    without a lock.
+    """
+    app_id, cursor, first_batch = task
+
+    logger.debug("Retrieving reviews for: %s...", app_id)
+
+    num_written = 0
     cursor_history = []
-    for batch in range(1, 50):
+    for batch in range(first_batch, 50):
         attempts = 2
         for i in range(attempts):
             try:
-                app_reviews = get_app_reviews(app_id, cursor)
-                if app_reviews is None:
-                    print(f"{app_id}: Failed to get app reviews. Retrying (attempt #{i + 1}) in 5 seconds...")
-                    time.sleep(5)
-                    continue
+                app_reviews = await get_app_reviews_async(session, app_id, cursor)
                 break
             except Exception as e:
-                print(f"EXCEPTION: {e}")
-                print(f"{app_id}: Failed to get app reviews. Retrying (attempt #{i + 1}) in 5 seconds...")
-                time.sleep(5)
+                delay = ratelimit.backoff(i)
+                logger.warning("%s: EXCEPTION: %s. Retrying (attempt #%d) in %.1f seconds...", app_id, e, i + 1, delay)
+                await asyncio.sleep(delay)
         else:
-            print(f"{app_id}: Failed to get reviews after {attempts} attempts")
-            continue
+            # Not checkpointed as done, so that a resumed run continues from the last cursor
+            raise RuntimeError(f"Failed to get reviews after {attempts} attempts")
 
         if app_reviews['success'] == True:
             if cursor in cursor_history:
-                print(f"{app_id}: Already processed batch #{batch + 1} (cursor={cursor}).")
+                logger.debug("%s: Already processed batch #%d (cursor=%s).", app_id, batch + 1, cursor)
                 cursor = app_reviews['cursor']
                 continue
 
-            if batch == 1:
-                print("SUCCESS")
-
-            batch_num_reviews = app_reviews['query_summary']['num_reviews']
-            print(f"{app_id}: Retrieving review data from {batch_num_reviews} reviews (batch #{batch + 1})...")
-
-            for review in app_reviews['reviews']:
-                recommendation_id = review['recommendationid']
-                if recommendation_id in existing_recommendations:
-                    print(f"\tSkipping recommendation: {recommendation_id}. Data already collected.")
-                    continue
-
-                steam_id = review['author']['steamid']
-                num_games_owned = review['author']['num_games_owned'] if 'num_games_owned' in review['author'] else 0
-                num_reviews = review['author']['num_reviews'] if 'num_reviews' in review['author'] else 0
-                playtime_forever = review['author']['playtime_forever'] if 'playtime_forever' in review['author'] else 0
-                playtime_last_two_weeks = review['author']['playtime_last_two_weeks'] if 'playtime_last_two_weeks' in review['author'] else 0
-                playtime_at_review = review['author']['playtime_at_review'] if 'playtime_at_review' in review['author'] else 0
-                last_played = review['author']['last_played'] if 'last_played' in review['author'] else 0
-                timestamp_created = review['timestamp_created']
-                timestamp_updated = review['timestamp_updated']
-                voted_up = review['voted_up']
-                votes_up = review['votes_up']
-                votes_funny = review['votes_funny']
-                weighted_vote_score = review['weighted_vote_score']
-                comment_count = review['comment_count']
-                steam_purchase = review['steam_purchase']
-                received_for_free = review['received_for_free']
-                written_during_early_access = review['written_during_early_access']
-
-                row = [
-                    recommendation_id,
-                    steam_id,
-                    app_id,
-                    num_games_owned,
-                    num_reviews,
-                    playtime_forever,
-                    playtime_last_two_weeks,
-                    playtime_at_review,
-                    last_played,
-                    timestamp_created,
-                    timestamp_updated,
-                    voted_up,
-                    votes_up,
-                    votes_funny,
-                    weighted_vote_score,
-                    comment_count,
-                    steam_purchase,
-                    received_for_free,
-                    written_during_early_access,
-                ]
-
-                rows.append(row)
+            reviews = app_reviews['reviews']
+            with metrics.timer('dedup'):
+                new_reviews = ReviewBatch.from_reviews(app_id, [
+                    review for review in reviews if review['recommendationid'] not in existing_recommendations
+                ])
+            metrics.count('pages')
+            metrics.count('reviews_fetched', len(reviews))
+            metrics.count('reviews_skipped', len(reviews) - len(new_reviews))
 
             cursor_history.append(cursor)
             cursor = app_reviews['cursor']
+            with metrics.timer('write'):
+                num_written += write_new_reviews(new_reviews, existing_recommendations, sink)
+                sink.sync()
+            checkpoints.save(app_id, cursor, batch + 1)
             if cursor == '*':
-                print(f"\tLast batch of reviews for {app_id} reached.")
                 break
+        else:
+            raise RuntimeError("FAILURE")
+
+    checkpoints.save(app_id, cursor, None, done=True)
+    metrics.count('apps_done')
+    logger.info("%s: %d new reviews collected.", app_id, num_written)
+
+async def harvest_reviews(tasks, existing_recommendations, sink, checkpoints, concurrency=ASYNC_CONCURRENCY):
+    """Collect the reviews of the games with `concurrency` cursors in flight.
+    Args:
+        tasks (list): The (app_id, cursor, first_batch) to process.
+        existing_recommendations (IdIndex): Already collected recommendation ids.
+        sink: Where the new rows are written (see open_sink).
+        checkpoints (CheckpointStore): Where the cursors are saved.
+        concurrency (int): Number of app_ids processed at the same time.
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # The iterator is shared by the workers, each one takes the next app_id
+        # as soon as it is done with the previous one.
+        pending = iter(tasks)
+
+        async def worker():
+            for task in pending:
+                try:
+                    await process_game_reviews_async(session, task, existing_recommendations, sink, checkpoints)
+                except Exception as e:
+                    # Not checkpointed as done, a resumed run continues it
+                    logger.warning("%s: EXCEPTION: %s", task[0], e)
+                    metrics.count('apps_failed')
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+def collect_users_games_data_async(concurrency=ASYNC_CONCURRENCY, parquet=False, resume=False, shard=None):
+    """Same as collect_users_games_data, but uses a single event loop and a
+    pooled HTTP client instead of a process pool.
+    """
+    start_time = time.time()
+    cache.reset_stats()
+
+    app_ids, csv_path, recommendations_index, checkpoints = open_review_harvest(shard)
+    tasks = review_tasks(app_ids, checkpoints, resume)
+
+    parquet_was_current = parquet and parquet_is_current(csv_path)
+    sink = open_sink(csv_path, USERS_GAMES_TYPES, parquet)
+    try:
+        asyncio.run(harvest_reviews(tasks, recommendations_index, sink, checkpoints, concurrency))
+    finally:
+        sink.close()
+        checkpoints.close()
+
+    logger.info("Sorting by recommendation_id...")
+    with metrics.timer('sort'):
+        utils.read_and_sort_csv(csv_path, 0)
+    if parquet:
+        finish_parquet(csv_path, USERS_GAMES_TYPES, parquet_was_current)
+    with metrics.timer('index_save'):
+        recommendations_index.save(index_path_for(csv_path))
+    logger.info("Successfully written to '%s'", csv_path)
 
-            print("\tBatch completed.")
+    execution_time = time.time() - start_time
+    logger.info("Finished in %.1f seconds.", execution_time)
+    cache.report()
+
+def read_watermarks(app_ids, checkpoints):
+    """Returns the latest timestamp_updated collected for every app_id.
+
+    The apps updated before are read from the checkpoints, the others from the
+    collected reviews. Apps without any review get 0.
+    """
+    watermarks = checkpoints.load_watermarks()
+    missing = [app_id for app_id in app_ids if app_id not in watermarks]
+    if missing and os.path.exists(users_games_csv_path):
+        reviews = pd.read_csv(users_games_csv_path, usecols=['app_id', 'timestamp_updated'],
+                              dtype={'app_id': str, 'timestamp_updated': 'int64'})
+        latest = reviews.groupby('app_id')['timestamp_updated'].max()
+        for app_id in missing:
+            if app_id in latest.index:
+                watermarks[app_id] = int(latest[app_id])
+    return {app_id: watermarks.get(app_id, 0) for app_id in app_ids}
+
+def upsert_reviews(reviews, existing_recommendations, sink):
+    """Append the rows of new and updated reviews (a ReviewBatch). The older
+    rows of the updated ones are dropped at the end of the update.
+    Returns:
+        tuple: The number of new and updated rows.
+    """
+    num_new = 0
+    for recommendation_id in reviews.recommendation_ids:
+        if recommendation_id not in existing_recommendations:
+            existing_recommendations.add(recommendation_id)
+            num_new += 1
+    sink.write_batch(reviews)
+    metrics.count('rows_written', len(reviews))
+    return num_new, len(reviews) - num_new
+
+async def update_game_reviews_async(session, app_id, watermark, existing_recommendations, sink, checkpoints):
+    """Collect the reviews of a game created or updated after its watermark.
+
+    The reviews are requested most recently updated first, so paging stops at
+    the first review that is not newer than the watermark.
+    """
+    num_new = num_updated = 0
+    latest = watermark
+    cursor = '*'
+    for batch in range(1, 50):
+        attempts = 2
+        for i in range(attempts):
+            try:
+                app_reviews = await get_updated_app_reviews_async(session, app_id, cursor)
+                break
+            except Exception as e:
+                delay = ratelimit.backoff(i)
+                logger.warning("%s: EXCEPTION: %s. Retrying (attempt #%d) in %.1f seconds...", app_id, e, i + 1, delay)
+                await asyncio.sleep(delay)
         else:
-            print("FAILURE")
+            # The watermark is not moved, the next update fetches these again
+            raise RuntimeError(f"Failed to get reviews after {attempts} attempts")
 
-    with lock:
-        with open(users_games_csv_path, 'a', newline='', encoding='utf-8') as csv_file:
-            writer = csv.writer(csv_file)
-            for row in rows:
-                if row[0] not in existing_recommendations:
-                    writer.writerow(row)
-                    existing_recommendations.append(row[0])
+        if app_reviews['success'] != True:
+            raise RuntimeError("FAILURE")
 
-def collect_users_games_data():
-    start_time = time.time();
+        updated_reviews = []
+        watermark_reached = False
+        with metrics.timer('dedup'):
+            for review in app_reviews['reviews']:
+                if review['timestamp_updated'] <= watermark:
+                    watermark_reached = True
+                    break
+                updated_reviews.append(review)
+                latest = max(latest, review['timestamp_updated'])
+            updated_reviews = ReviewBatch.from_reviews(app_id, updated_reviews)
+        metrics.count('pages')
+        metrics.count('reviews_fetched', len(app_reviews['reviews']))
+        metrics.count('reviews_skipped', len(app_reviews['reviews']) - len(updated_reviews))
 
-    existing_recommendations = list()
-    if os.path.exists(users_games_csv_path):
-        with open(users_games_csv_path, 'r', newline='', encoding='utf-8') as csv_file:
-            reader = csv.reader(csv_file)
-            next(reader) # Skip the header
-            for row in reader:
-                existing_recommendations.append(row[0])
+        with metrics.timer('write'):
+            batch_new, batch_updated = upsert_reviews(updated_reviews, existing_recommendations, sink)
+            sink.sync()
+        num_new += batch_new
+        num_updated += batch_updated
+
+        cursor = app_reviews['cursor']
+        if watermark_reached or not app_reviews['reviews'] or cursor == '*':
+            break
+
+    checkpoints.save_watermark(app_id, latest)
+    metrics.count('apps_done')
+    logger.info("%s: %d new and %d updated reviews collected in %d requests.", app_id, num_new, num_updated, batch)
+
+async def update_reviews(watermarks, existing_recommendations, sink, checkpoints, concurrency=ASYNC_CONCURRENCY):
+    """Collect the new and updated reviews of the games with `concurrency`
+    games in flight.
+    Args:
+        watermarks (dict): Maps the app_ids to update to their watermark.
+        existing_recommendations (IdIndex): Already collected recommendation ids.
+        sink: Where the rows are written (see open_sink).
+        checkpoints (CheckpointStore): Where the watermarks are saved.
+        concurrency (int): Number of app_ids processed at the same time.
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = iter(watermarks.items())
 
-    with open(users_games_csv_path, 'a', newline='', encoding='utf-8') as csv_file:
-        writer = csv.writer(csv_file)
-        if not existing_recommendations:
-            writer.writerow(USERS_GAMES_COLUMNS)
+        async def worker():
+            for app_id, watermark in pending:
+                try:
+                    await update_game_reviews_async(session, app_id, watermark, existing_recommendations, sink, checkpoints)
+                except Exception as e:
+                    logger.warning("%s: EXCEPTION: %s", app_id, e)
+                    metrics.count('apps_failed')
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+def update_users_games_data(concurrency=ASYNC_CONCURRENCY, parquet=False):
+    """Incremental counterpart of collect_users_games_data_async, e.g. for a
+    nightly refresh: only the reviews created or updated since the last run
+    are fetched, and the updated reviews replace their previous row.
+    """
+    start_time = time.time()
+    cache.reset_stats()
+
+    recommendations_index = IdIndex.load(users_games_csv_path)
 
     with open(games_txt_path, 'r', encoding='utf-8') as f:
-        app_ids = [line.rstrip() for line in f]
+        app_ids = list(dict.fromkeys(line.rstrip() for line in f))
 
-    with Manager() as manager:
-        lock = manager.Lock()
-        # Convert to a Manager list so that it is shared between processes
-        existing_recommendations = manager.list(existing_recommendations)
-        with Pool() as p:
-            p.map(process_game_reviews, [(app_id, existing_recommendations, lock) for app_id in app_ids])
+    checkpoints = CheckpointStore()
+    watermarks = read_watermarks(app_ids, checkpoints)
 
-    print("Sorting by recommendation_id...", end=" ")
-    utils.read_and_sort_csv(users_games_csv_path, 0)
-    print("DONE")
-    print(f"Successfully written to '{users_games_csv_path}'")
+    # The Parquet dataset is rewritten at the end, it can't drop the old rows
+    sink = open_sink(users_games_csv_path, USERS_GAMES_TYPES)
+    try:
+        asyncio.run(update_reviews(watermarks, recommendations_index, sink, checkpoints, concurrency))
+    finally:
+        sink.close()
+        checkpoints.close()
 
-    end_time = time.time();
-    execution_time = end_time - start_time
-    print(f"Finished in {execution_time} seconds.")
+    logger.info("Sorting by recommendation_id...")
+    # The sort is stable, so the latest version of an updated review is last
+    with metrics.timer('sort'):
+        utils.read_and_sort_csv(users_games_csv_path, 0)
+    with metrics.timer('drop_duplicates'):
+        drop_duplicated_users_games_data(keep='last')
+    with metrics.timer('index_save'):
+        recommendations_index.save(index_path_for(users_games_csv_path))
+    if parquet:
+        export_parquet(users_games_csv_path, USERS_GAMES_TYPES)
+    logger.info("Successfully written to '%s'", users_games_csv_path)
+
+    execution_time = time.time() - start_time
+    logger.info("Finished in %.1f seconds.", execution_time)
+    cache.report()
 
-def drop_duplicated_users_games_data():
-    utils.drop_duplicates_in_csv(users_games_csv_path, 0)
+def drop_duplicated_users_games_data(keep='first'):
+    utils.drop_duplicates_in_csv(users_games_csv_path, 0, keep=keep, as_number=True)
+
+def merge_users_games_shards(parquet=False):
+    """Merges the segments of every shard (copied to data/collected/ from the
+    other hosts) into the users-games CSV, sorted by recommendation_id and
+    without duplicates. The rows already in the CSV file are kept.
+
+    The segments are left in place: a shard keeps using its own to skip the
+    reviews it already collected, and merging them again changes nothing.
+    """
+    start_time = time.time()
+
+    segment_paths = sorted(glob.glob(shard_path(users_games_csv_path, '*', '*')))
+    if not segment_paths:
+        logger.warning("No shard to merge next to '%s'", users_games_csv_path)
+        return
+    csv_paths = [users_games_csv_path] if os.path.exists(users_games_csv_path) else []
+    logger.info("Merging %d shards...", len(segment_paths))
+    with metrics.timer('merge'):
+        # Sorted as strings, like at the end of every harvest
+        utils.merge_sorted_csvs(csv_paths + segment_paths, users_games_csv_path, 0)
+    with metrics.timer('index_save'):
+        # Rebuilt from the merged file, which is newer than the saved index
+        IdIndex.load(users_games_csv_path)
+    if parquet:
+        export_parquet(users_games_csv_path, USERS_GAMES_TYPES)
+    logger.info("Successfully written to '%s'", users_games_csv_path)
+
+    execution_time = time.time() - start_time
+    logger.info("Finished in %.1f seconds.", execution_time)
 
 # def collect_users_games_data():
 #     start_time = time.time()
@@ -476,10 +1473,34 @@ def drop_duplicated_users_games_data():
 
 if __name__ == '__main__':
     import sys
-    if sys.argv[1] == 'collect_games_data':
-        collect_games_data()
-    if sys.argv[1] == 'collect_users_games_data':
-        collect_users_games_data()
-    if sys.argv[1] == 'drop_duplicated_users_games_data':
-        drop_duplicated_users_games_data()
-
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    parquet = '--parquet' in sys.argv
+    cache.enabled = '--no-cache' not in sys.argv
+    resume = '--resume' in sys.argv
+    # --shard=i/n collects the i-th of n shards (see open_review_harvest)
+    shard = next((parse_shard(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--shard=')), None)
+    level = logging.DEBUG if '--verbose' in sys.argv else logging.WARNING if '--quiet' in sys.argv else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    # The counters and latencies of the run are appended to metrics.metrics_path
+    with metrics.reporting():
+        if args[0] == 'collect_games_data':
+            collect_games_data(parquet)
+        if args[0] == 'collect_games_data_async':
+            concurrency = int(args[1]) if len(args) > 1 else ASYNC_CONCURRENCY
+            collect_games_data_async(concurrency, parquet)
+        if args[0] == 'collect_users_games_data':
+            collect_users_games_data(parquet, resume, shard)
+        if args[0] == 'collect_users_games_data_async':
+            concurrency = int(args[1]) if len(args) > 1 else ASYNC_CONCURRENCY
+            collect_users_games_data_async(concurrency, parquet, resume, shard)
+        if args[0] == 'update_users_games_data':
+            concurrency = int(args[1]) if len(args) > 1 else ASYNC_CONCURRENCY
+            update_users_games_data(concurrency, parquet)
+        if args[0] == 'merge_users_games_shards':
+            merge_users_games_shards(parquet)
+    if args[0] == 'export_parquet':
+        export_parquet(games_csv_path, GAMES_TYPES)
+        export_parquet(users_games_csv_path, USERS_GAMES_TYPES)
+    if args[0] == 'drop_duplicated_users_games_data':
+        keep = args[1] if len(args) > 1 else 'first'
+        drop_duplicated_users_games_data(keep)
@@ -0,0 +1,435 @@
+import asyncio
+import base64
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+import requests
+from aiohttp import web
+
+from data import ratelimit
+
+DEFAULT_PORT = 8081
+# Number of reviews of the most reviewed game, the game of rank r has
+# MAX_REVIEWS / r ** REVIEW_EXPONENT of them
+MAX_REVIEWS = 20000
+REVIEW_EXPONENT = 1.0
+# The author of a review is user int(NUM_USERS * u ** USER_EXPONENT) for a
+# uniform u, so a few users write most of the reviews
+NUM_USERS = 1000000
+USER_EXPONENT = 3
+# Fraction of the apps that are not games (filtered out by the scraper)
+NON_GAME_FRACTION = 0.05
+# Fraction of the games listed in a category
+CATEGORY_FRACTION = 0.1
+
+# Faults injected in the responses
+RATE_LIMITED_FRACTION = 0.002
+ERROR_FRACTION = 0.002
+NULL_DETAILS_FRACTION = 0.01
+# Fraction of the review pages that start with reviews of the previous page
+DUPLICATED_PAGE_FRACTION = 0.05
+RETRY_AFTER = 1
+
+FIRST_RECOMMENDATION_ID = 100000000
+FIRST_STEAM_ID = 76561197960265728
+LAST_TIMESTAMP = 1700000000
+TIME_SPAN = 5 * 365 * 24 * 60 * 60
+
+CATEGORIES = ['Single-player', 'Multi-player', 'Co-op', 'Steam Achievements', 'Full controller support',
+              'Steam Trading Cards', 'Steam Cloud', 'Online PvP', 'Remote Play Together', 'In-App Purchases']
+GENRES = ['Action', 'Adventure', 'Casual', 'Indie', 'RPG', 'Simulation', 'Strategy', 'Sports', 'Racing',
+          'Massively Multiplayer']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+REVIEW_SCORE_DESCS = ['Overwhelmingly Negative', 'Very Negative', 'Negative', 'Mostly Negative', 'Mixed',
+                      'Mostly Positive', 'Positive', 'Very Positive', 'Overwhelmingly Positive']
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua. ") * 40
+
+class SyntheticSteam(object):
+    """A deterministic catalogue of apps and reviews shaped like Steam's.
+
+    The number of reviews per game and per user follow power laws. Only the
+    per-app counts are kept in memory: a page of reviews is generated from
+    the seed, the app and the offset, so the same request always gets the
+    same answer, whatever the number of reviews.
+    """
+    def __init__(self, num_games=1000, max_reviews=MAX_REVIEWS, num_users=NUM_USERS, seed=0):
+        rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.num_users = num_users
+        self.app_ids = 10 * np.arange(1, num_games + 1)
+        ranks = rng.permutation(num_games) + 1
+        self.num_reviews = np.maximum(1, (max_reviews / ranks ** REVIEW_EXPONENT).astype(np.int64))
+        self.first_ids = FIRST_RECOMMENDATION_ID + np.concatenate([[0], np.cumsum(self.num_reviews)[:-1]])
+        self.is_game = rng.random(num_games) >= NON_GAME_FRACTION
+        self._index = {int(app_id): i for i, app_id in enumerate(self.app_ids)}
+        # Listings are ordered by number of reviews, as a "Top Rated" one
+        self._by_popularity = np.argsort(-self.num_reviews, kind='stable')
+
+    @property
+    def game_app_ids(self):
+        """The app_ids of the apps that are games, as listed in games.txt."""
+        return [int(app_id) for app_id in self.app_ids[self.is_game]]
+
+    def expected_reviews(self, max_pages=49, page_size=100):
+        """Number of distinct reviews of the games within max_pages pages."""
+        return int(np.minimum(self.num_reviews[self.is_game], max_pages * page_size).sum())
+
+    def _rng(self, *key):
+        return np.random.default_rng([self.seed, *key])
+
+    def app_details(self, app_id):
+        """The appdetails response of an app, None for unknown app_ids."""
+        i = self._index.get(app_id)
+        if i is None:
+            return {str(app_id): {'success': False}}
+        rng = self._rng(0, i)
+        year = int(rng.integers(2005, 2024))
+        data = {
+            'type': 'game' if self.is_game[i] else 'dlc',
+            'name': f"Game {app_id}",
+            'steam_appid': app_id,
+            'required_age': int(rng.choice([0, 0, 0, 13, 18])),
+            'is_free': bool(rng.random() < 0.1),
+            'detailed_description': LOREM[:int(rng.integers(500, len(LOREM)))],
+            'developers': [f"Developer {rng.integers(1000)}"],
+            'publishers': [f"Publisher {rng.integers(300)}"],
+            'platforms': {'windows': True, 'mac': bool(rng.random() < 0.3), 'linux': bool(rng.random() < 0.2)},
+            'categories': [{'id': int(c), 'description': CATEGORIES[c]}
+                           for c in np.sort(rng.choice(len(CATEGORIES), rng.integers(1, 5), replace=False))],
+            'genres': [{'id': str(g), 'description': GENRES[g]}
+                       for g in np.sort(rng.choice(len(GENRES), rng.integers(1, 3), replace=False))],
+            'recommendations': {'total': int(self.num_reviews[i])},
+            'release_date': {'coming_soon': False,
+                             'date': f"{rng.integers(1, 29)} {MONTHS[rng.integers(12)]}, {year}"},
+        }
+        if rng.random() < 0.3:
+            data['metacritic'] = {'score': int(rng.integers(40, 100))}
+        return {str(app_id): {'success': True, 'data': data}}
+
+    def reviews(self, app_id, start, count):
+        """The reviews start to start + count of an app, most recent first."""
+        i = self._index[app_id]
+        num_reviews = int(self.num_reviews[i])
+        count = max(0, min(count, num_reviews - start))
+        rng = self._rng(1, i, start)
+        offsets = np.arange(start, start + count)
+        authors = (self.num_users * rng.random(count) ** USER_EXPONENT).astype(np.int64)
+        created = LAST_TIMESTAMP - (offsets * TIME_SPAN) // max(num_reviews, 1)
+        updated = created + (rng.random(count) < 0.1) * rng.integers(0, 3600, count)
+        playtime = rng.lognormal(6, 2, count).astype(np.int64)
+        lengths = rng.integers(20, 1000, count)
+        return [{
+            'recommendationid': str(self.first_ids[i] + offset),
+            'author': {
+                'steamid': str(FIRST_STEAM_ID + author),
+                'num_games_owned': int(10 + (self.num_users // (author + 1)) % 1000),
+                'num_reviews': int(1 + (self.num_users // (author + 1)) % 200),
+                'playtime_forever': int(playtime[j]),
+                'playtime_last_two_weeks': int(playtime[j] % 600),
+                'playtime_at_review': int(playtime[j] // 2),
+                'last_played': int(updated[j]),
+            },
+            'language': 'english',
+            'review': LOREM[:lengths[j]],
+            'timestamp_created': int(created[j]),
+            'timestamp_updated': int(updated[j]),
+            'voted_up': bool(playtime[j] % 5),
+            'votes_up': int(playtime[j] % 7),
+            'votes_funny': int(playtime[j] % 3),
+            # Steam sends it as a string
+            'weighted_vote_score': f"{rng.random():.9f}",
+            'comment_count': int(playtime[j] % 2),
+            'steam_purchase': bool(playtime[j] % 4),
+            'received_for_free': not bool(playtime[j] % 20),
+            'written_during_early_access': not bool(playtime[j] % 10),
+        } for j, (offset, author) in enumerate(zip(offsets, authors))]
+
+    def query_summary(self, app_id, num_reviews, first_page):
+        """The query_summary of a page; the first page also has the totals."""
+        summary = {'num_reviews': num_reviews}
+        if first_page:
+            i = self._index[app_id]
+            total = int(self.num_reviews[i])
+            positive = int(total * self._rng(2, i).uniform(0.3, 1))
+            score = min(8, int(9 * positive / max(total, 1)))
+            summary.update({
+                'review_score': score + 1,
+                'review_score_desc': REVIEW_SCORE_DESCS[score],
+                'total_positive': positive,
+                'total_negative': total - positive,
+                'total_reviews': total,
+            })
+        return summary
+
+    def listing(self, category, start, count):
+        """The app_ids of a page of the "Top Rated" listing of a category."""
+        rng = np.random.default_rng([self.seed, 3, zlib.crc32(category.encode('utf-8'))])
+        listed = self._by_popularity[rng.random(len(self.app_ids)) < CATEGORY_FRACTION]
+        return [int(app_id) for app_id in self.app_ids[listed[start:start + count]]], len(listed)
+
+def encode_cursor(app_id, start, review_filter):
+    """An opaque cursor, base64 like Steam's."""
+    return base64.b64encode(f"{app_id}:{start}:{review_filter}".encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """The offset of a cursor, 0 for '*'."""
+    if cursor == '*':
+        return 0
+    return int(base64.b64decode(cursor).decode('utf-8').split(':')[1])
+
+class FakeSteam(object):
+    """Local stand-in for the store endpoints the collector and the scraper
+    use: appdetails, appreviews and the category listing.
+
+    Like Steam, a review cursor past the last page returns no reviews and the
+    same cursor, some pages repeat reviews of the previous page, appdetails
+    sometimes answers null, and some requests fail with 429 (with
+    Retry-After) or 5xx.
+    """
+    def __init__(self, steam, rate_limited_fraction=RATE_LIMITED_FRACTION, error_fraction=ERROR_FRACTION,
+                 null_details_fraction=NULL_DETAILS_FRACTION, duplicated_page_fraction=DUPLICATED_PAGE_FRACTION,
+                 latency=0.0, seed=0):
+        """Initializes a FakeSteam.
+        Args:
+            steam: the SyntheticSteam to serve.
+            latency: seconds waited before every response, as a network round trip.
+        """
+        self.steam = steam
+        self.rate_limited_fraction = rate_limited_fraction
+        self.error_fraction = error_fraction
+        self.null_details_fraction = null_details_fraction
+        self.duplicated_page_fraction = duplicated_page_fraction
+        self.latency = latency
+        self.stats = Counter()
+        self._random = random.Random(seed)
+
+    @web.middleware
+    async def _faults(self, request, handler):
+        endpoint = request.match_info.route.name
+        if endpoint == 'stats':
+            return await handler(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        fault = self._random.random()
+        if fault < self.rate_limited_fraction:
+            response = web.Response(status=429, headers={'Retry-After': str(RETRY_AFTER)})
+        elif fault < self.rate_limited_fraction + self.error_fraction:
+            response = web.Response(status=self._random.choice([500, 502, 503]))
+        else:
+            try:
+                response = await handler(request)
+            except Exception:
+                self.stats[f"{endpoint} 500"] += 1
+                raise
+        self.stats[f"{endpoint} {response.status}"] += 1
+        return response
+
+    async def app_details(self, request):
+        try:
+            app_id = int(request.query['appids'])
+        except (KeyError, ValueError):
+            return web.json_response(None)
+        if self._random.random() < self.null_details_fraction:
+            return web.json_response(None)
+        return web.json_response(self.steam.app_details(app_id))
+
+    async def app_reviews(self, request):
+        app_id = int(request.match_info['app_id'])
+        if app_id not in self.steam._index:
+            return web.json_response({'success': 2})
+        cursor = request.query.get('cursor', '*')
+        count = min(int(request.query.get('num_per_page', 20)), 100)
+        review_filter = request.query.get('filter', 'all')
+        start = decode_cursor(cursor)
+        reviews = self.steam.reviews(app_id, start, count)
+        if reviews:
+            next_cursor = encode_cursor(app_id, start + len(reviews), review_filter)
+            if start and self._random.random() < self.duplicated_page_fraction:
+                reviews = self.steam.reviews(app_id, max(0, start - 5), min(5, start)) + reviews
+        else:
+            next_cursor = cursor
+        return web.json_response({
+            'success': 1,
+            'query_summary': self.steam.query_summary(app_id, len(reviews), cursor == '*'),
+            'reviews': reviews,
+            'cursor': next_cursor,
+        })
+
+    async def listing(self, request):
+        try:
+            category = json.loads(request.query['contenthub'])['category']
+            start = int(request.query.get('start', 0))
+            count = int(request.query.get('count', 12))
+        except (KeyError, ValueError):
+            return web.json_response({'success': 2})
+        app_ids, total = self.steam.listing(category, start, count)
+        results_html = ''.join(
+            f'<a href="https://store.steampowered.com/app/{app_id}/Game_{app_id}/" data-ds-appid="{app_id}">'
+            f'Game {app_id}</a>' for app_id in app_ids)
+        return web.json_response({'success': 1, 'start': start, 'total_count': total, 'results_html': results_html})
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+    def app(self):
+        app = web.Application(middlewares=[self._faults])
+        app.router.add_get('/api/appdetails', self.app_details, name='appdetails')
+        app.router.add_get('/appreviews/{app_id}', self.app_reviews, name='appreviews')
+        app.router.add_get('/contenthub/querypaginated/category/TopRated/render/', self.listing, name='listing')
+        app.router.add_get('/stats', self.get_stats, name='stats')
+        return app
+
+def serve(port=DEFAULT_PORT, num_games=1000, max_reviews=MAX_REVIEWS, seed=0, **kwargs):
+    """Runs a FakeSteam of a SyntheticSteam on localhost until interrupted."""
+    steam = SyntheticSteam(num_games, max_reviews, seed=seed)
+    web.run_app(FakeSteam(steam, seed=seed, **kwargs).app(), host='127.0.0.1', port=port, print=None)
+
+def wait_for_server(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return requests.get(f"{url}/stats", timeout=1).json()
+        except requests.ConnectionError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def _count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        return max(0, sum(1 for _ in f) - 1)
+
+COMMANDS = [
+    'discover',
+    'collect_games_data',
+    'collect_games_data_async',
+    'collect_users_games_data',
+    'collect_users_games_data_async',
+    'update_users_games_data',
+]
+
+def drive(command, num_games=1000, max_reviews=MAX_REVIEWS, concurrency=32, runs=1, rate=1000.0,
+          port=DEFAULT_PORT, directory=None, verbose=False, seed=0, **kwargs):
+    """Runs a collector command against a FakeSteam served by another process.
+
+    The outputs, checkpoints and response cache go to directory (a new
+    temporary one by default), with a games.txt listing the games of the
+    synthetic catalogue. Running the command several times measures the
+    dedup of reviews already collected.
+    Args:
+        command: one of COMMANDS.
+        rate: requests per second allowed by the rate limiter.
+        verbose: whether to keep the output of the command.
+        The metrics of every run are appended to metrics.jsonl in directory.
+        kwargs: fault settings of FakeSteam.
+    Returns:
+        list: For every run, the requests and rows (written) per second, and
+              the snapshot of the collector metrics.
+    """
+    from data import cache, checkpoint, collector, listing, metrics, scraper
+
+    if command not in COMMANDS:
+        raise ValueError(f"command should be one of {', '.join(COMMANDS)}, got: {command}")
+    directory = directory or tempfile.mkdtemp(prefix='fakesteam-')
+    os.makedirs(directory, exist_ok=True)
+    print(f"Writing to '{directory}'")
+    collector.games_txt_path = scraper.games_txt_path = os.path.join(directory, 'games.txt')
+    collector.games_csv_path = os.path.join(directory, 'games.csv')
+    collector.users_games_csv_path = os.path.join(directory, 'user_game.csv')
+    checkpoint.checkpoints_path = os.path.join(directory, 'checkpoints.sqlite')
+    cache.cache.use(os.path.join(directory, 'http_cache.sqlite'))
+
+    url = f"http://127.0.0.1:{port}"
+    collector.STORE_URL = listing.STORE_URL = url
+    ratelimit.limiter = ratelimit.RateLimiter({f"127.0.0.1:{port}": rate})
+
+    steam = SyntheticSteam(num_games, max_reviews, seed=seed)
+    if command != 'discover':
+        with open(collector.games_txt_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(map(str, steam.game_app_ids)))
+    output_path = {
+        'discover': collector.games_txt_path,
+        'collect_games_data': collector.games_csv_path,
+        'collect_games_data_async': collector.games_csv_path,
+    }.get(command, collector.users_games_csv_path)
+
+    def run_command():
+        if command == 'discover':
+            scraper.write_games_txt(scraper.discover(scraper.categories, scraper.PAGES))
+        elif command == 'collect_games_data':
+            collector.collect_games_data()
+        elif command == 'collect_games_data_async':
+            collector.collect_games_data_async(concurrency)
+        elif command == 'collect_users_games_data':
+            collector.collect_users_games_data()
+        elif command == 'collect_users_games_data_async':
+            collector.collect_users_games_data_async(concurrency)
+        else:
+            collector.update_users_games_data(concurrency)
+
+    server = multiprocessing.Process(target=serve, args=(port, num_games, max_reviews, seed), kwargs=kwargs,
+                                     daemon=True)
+    server.start()
+    results = []
+    try:
+        previous = Counter(wait_for_server(url))
+        for run in range(runs):
+            rows_before = _count_lines(output_path) if command != 'discover' else 0
+            metrics.registry.reset()
+            start_time = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull), \
+                    metrics.reporting(os.path.join(directory, 'metrics.jsonl')):
+                run_command()
+            seconds = time.time() - start_time
+            stats = Counter(wait_for_server(url))
+            requests_stats = stats - previous
+            previous = stats
+            num_requests = sum(requests_stats.values())
+            rows = _count_lines(output_path) - rows_before
+            results.append({
+                'command': command,
+                'run': run + 1,
+                'seconds': seconds,
+                'requests': num_requests,
+                'requests_per_second': num_requests / seconds,
+                'rows': rows,
+                'rows_per_second': rows / seconds,
+                'expected_rows': len(steam.game_app_ids) if 'games' in command and 'users' not in command
+                else steam.expected_reviews() if 'users' in command else None,
+                'statuses': dict(sorted(requests_stats.items())),
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'peak_children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+                'metrics': metrics.registry.snapshot(),
+            })
+            print(json.dumps(results[-1], indent=2))
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'serve':
+        port = int(args[1]) if len(args) > 1 else DEFAULT_PORT
+        num_games = int(args[2]) if len(args) > 2 else 1000
+        serve(port, num_games)
+    if args[0] == 'drive':
+        logging.basicConfig(level=logging.INFO if '--verbose' in sys.argv else logging.WARNING,
+                            format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+        num_games = int(args[2]) if len(args) > 2 else 1000
+        concurrency = int(args[3]) if len(args) > 3 else 32
+        runs = int(args[4]) if len(args) > 4 else 1
+        drive(args[1], num_games, concurrency=concurrency, runs=runs, verbose='--verbose' in sys.argv)
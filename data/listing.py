@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import re
+
+import aiohttp
+
+from data import metrics, ratelimit
+
+# Number of games on a page of a category listing
+PAGE_SIZE = 12
+# Number of listing pages fetched at the same time
+LISTING_CONCURRENCY = 16
+
+CATEGORY_URL = 'https://store.steampowered.com/category/'
+TOP_RATED = '?flavor=contenthub_toprated'
+# Base URL of the JSON listing, can point to a local stand-in (see data/fakesteam.py)
+STORE_URL = os.environ.get('STEAM_STORE_URL', 'https://store.steampowered.com')
+# JSON endpoint the category pages load their "Top Rated" rows from
+QUERY_PATH = '/contenthub/querypaginated/category/TopRated/render/'
+
+APP_ID_PATTERN = re.compile(r'data-ds-appid="(\d+)"|store\.steampowered\.com/app/(\d+)')
+
+def category_page_url(category, page):
+    """URL of a category page as rendered by the browser."""
+    return f"{CATEGORY_URL}{category}/{TOP_RATED}&offset={page * PAGE_SIZE}"
+
+def listing_params(category, page):
+    """Query parameters of a page of the JSON listing of a category."""
+    return {
+        'query': '',
+        'start': page * PAGE_SIZE,
+        'count': PAGE_SIZE,
+        'cc': 'US',
+        'l': 'english',
+        'v': 4,
+        'tag': '',
+        'contenthub': json.dumps({'type': 'category', 'category': category, 'source': 'top_rated'}),
+    }
+
+def parse_app_ids(html):
+    """Extracts the app_ids linked from a listing, in order and without duplicates.
+    Args:
+        html (str): The listing HTML (the results_html of the JSON listing, or
+            a saved category page).
+    Returns:
+        list: The app_ids as strings.
+    """
+    app_ids = {}
+    for match in APP_ID_PATTERN.finditer(html):
+        app_ids.setdefault(match.group(1) or match.group(2), None)
+    return list(app_ids)
+
+def parse_listing(body):
+    """Extracts the app_ids of a JSON listing response.
+    Args:
+        body (bytes or str): The response.
+    Returns:
+        list: The app_ids as strings (empty past the last page), or None if
+              the listing is not valid JSON, is null or has no success, so
+              that the page is fetched in the browser instead.
+    """
+    if isinstance(body, bytes):
+        body = body.decode('utf-8-sig')
+    try:
+        listing = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(listing, dict) or not listing.get('success') or 'results_html' not in listing:
+        return None
+    return parse_app_ids(listing['results_html'])
+
+@metrics.timed('listing')
+async def fetch_listing_async(session, category, page):
+    """Fetches the app_ids of a page of a category through plain HTTP."""
+    status, body = await ratelimit.get_async(session, f"{STORE_URL}{QUERY_PATH}", params=listing_params(category, page))
+    if status != 200:
+        raise RuntimeError(f"HTTP {status}")
+    app_ids = parse_listing(body)
+    if app_ids is None:
+        raise RuntimeError("Unsuccessful listing")
+    return app_ids
+
+async def fetch_listings_async(categories, pages, concurrency=LISTING_CONCURRENCY):
+    """Fetches `pages` pages of every category concurrently.
+    Returns:
+        dict: Maps (category, page) to the list of app_ids found, or to None
+              if the page couldn't be fetched.
+    """
+    results = {}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = iter([(category, page) for category in categories for page in range(pages)])
+
+        async def worker():
+            for category, page in pending:
+                try:
+                    results[(category, page)] = await fetch_listing_async(session, category, page)
+                except Exception as e:
+                    print(f"Could not fetch {category} (page {page}). EXCEPTION: {e}")
+                    results[(category, page)] = None
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+def fetch_listings(categories, pages, concurrency=LISTING_CONCURRENCY):
+    return asyncio.run(fetch_listings_async(categories, pages, concurrency))
+
+class BrowserListingFetcher(object):
+    """Fallback that renders the category pages in a headless Firefox.
+
+    Selenium is only imported, and the browser only started, on first use.
+    """
+    def __init__(self):
+        self._driver = None
+
+    def _get_driver(self):
+        if self._driver is None:
+            from selenium import webdriver
+            options = webdriver.FirefoxOptions()
+            options.add_argument('-headless')
+            self._driver = webdriver.Firefox(options=options)
+        return self._driver
+
+    def fetch(self, category, page):
+        """Returns the app_ids of a page of a category."""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.wait import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        driver = self._get_driver()
+        url = category_page_url(category, page)
+        driver.get(url)
+
+        print(f"Waiting for: {url}...", end=" ")
+
+        wait = WebDriverWait(driver, 20)
+        wait.until(EC.presence_of_all_elements_located((By.CLASS_NAME, 'salepreviewwidgets_SaleItemBrowserRow_y9MSd')))
+        elements = driver.find_elements(By.XPATH, "//div[@class='salepreviewwidgets_StoreSaleWidgetHalfLeft_2Va3O']/a")
+
+        print("DONE.")
+
+        return parse_app_ids(' '.join(str(element.get_attribute('href')) for element in elements))
+
+    def quit(self):
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
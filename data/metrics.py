@@ -0,0 +1,251 @@
+import bisect
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+metrics_path = os.path.join(BASE_DIR, 'collected', 'metrics.jsonl')
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = [
+    'requests',
+    'retries',
+    'responses_429',
+    'responses_5xx',
+    'cache_hits',
+    'cache_misses',
+    'pages',
+    'reviews_fetched',
+    'reviews_skipped',
+    'rows_written',
+    'apps_done',
+    'apps_failed',
+]
+# Latency histograms
+TIMERS = [
+    # Endpoint calls, including the rate limiting and the retries
+    'appdetails',
+    'appreviews',
+    'appreviews_updated',
+    'listing',
+    # Time spent waiting for the rate limiter
+    'rate_limit_wait',
+    # Per page: skipping the reviews already collected and building the rows
+    # of the others, then writing the new rows
+    'dedup',
+    'write',
+    # End of a harvest
+    'sort',
+    'drop_duplicates',
+    'index_save',
+    # Merge of the shards
+    'merge',
+]
+# Upper bounds (in seconds) of the histogram buckets, from 0.1 ms to about 52
+# seconds; the last bucket is unbounded
+BUCKETS = [0.0001 * 2 ** i for i in range(20)]
+# The measures of a process are added to the shared ones at most every
+# FLUSH_INTERVAL seconds
+FLUSH_INTERVAL = 1.0
+# Seconds between two lines of the metrics file
+REPORT_INTERVAL = 10.0
+
+class Metrics(object):
+    """Counters and latency histograms shared by every collector process.
+
+    The totals live in shared memory like the rate limiter's buckets, so the
+    Pool workers forked from the process that created them (or given them as
+    an initializer argument) add to the same totals. Every process counts in
+    a private buffer, added to the shared totals under the lock at most every
+    FLUSH_INTERVAL seconds, so measuring costs a few list operations.
+    """
+    def __init__(self, counters=COUNTERS, timers=TIMERS, buckets=BUCKETS):
+        self.counters = list(counters)
+        self.timers = list(timers)
+        self.buckets = list(buckets)
+        self._counter_index = {name: i for i, name in enumerate(self.counters)}
+        # A timer is the count of every bucket followed by the total seconds
+        self._timer_size = len(self.buckets) + 2
+        self._timer_offset = {name: len(self.counters) + i * self._timer_size for i, name in enumerate(self.timers)}
+        self._size = len(self.counters) + len(self.timers) * self._timer_size
+        self._lock = multiprocessing.Lock()
+        self._shared = multiprocessing.RawArray('d', self._size)
+        self._reset_local()
+        # The buffer of the parent isn't the child's to flush
+        os.register_at_fork(after_in_child=self._reset_local)
+
+    def _reset_local(self):
+        self._local = [0.0] * self._size
+        self._flushed = time.monotonic()
+
+    def count(self, name, value=1):
+        self._local[self._counter_index[name]] += value
+        if time.monotonic() - self._flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def observe(self, name, seconds):
+        """Records a duration in the histogram of a timer."""
+        offset = self._timer_offset[name]
+        self._local[offset + bisect.bisect_left(self.buckets, seconds)] += 1
+        self._local[offset + len(self.buckets) + 1] += seconds
+        if time.monotonic() - self._flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Records the duration of a block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def flush(self):
+        """Adds the measures of this process to the shared totals."""
+        local = self._local
+        with self._lock:
+            for i, value in enumerate(local):
+                if value:
+                    self._shared[i] += value
+        self._reset_local()
+
+    def reset(self):
+        with self._lock:
+            for i in range(self._size):
+                self._shared[i] = 0.0
+        self._reset_local()
+
+    def _quantile(self, counts, total, q):
+        target = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def snapshot(self, flush=True):
+        """The totals of every process.
+        Args:
+            flush: whether to flush the measures of this process first. Only
+                the thread that measures may flush.
+        Returns:
+            dict: The counters, and the number of calls, total seconds, mean
+                  and approximate p50/p90/p99 (bucket upper bounds, in
+                  milliseconds) of the timers that were used.
+        """
+        if flush:
+            self.flush()
+        with self._lock:
+            shared = list(self._shared)
+        timers = {}
+        for name, offset in self._timer_offset.items():
+            counts = shared[offset:offset + len(self.buckets) + 1]
+            calls = sum(counts)
+            if not calls:
+                continue
+            total = shared[offset + len(self.buckets) + 1]
+            timers[name] = {
+                'calls': int(calls),
+                'total_seconds': total,
+                'mean_ms': 1000 * total / calls,
+                'p50_ms': 1000 * self._quantile(counts, calls, 0.5),
+                'p90_ms': 1000 * self._quantile(counts, calls, 0.9),
+                'p99_ms': 1000 * self._quantile(counts, calls, 0.99),
+            }
+        return {
+            'counters': {name: int(shared[i]) for name, i in self._counter_index.items()},
+            'timers': timers,
+        }
+
+registry = Metrics()
+
+# The functions below use the current registry, so that a worker given
+# another one (see init_review_worker in data/collector.py) records to it
+
+def count(name, value=1):
+    registry.count(name, value)
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+def timer(name):
+    """Context manager recording the duration of a block."""
+    return registry.timer(name)
+
+def timed(name):
+    """Decorator recording the duration of every call of a function or
+    coroutine function."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    registry.observe(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def log_summary(snapshot):
+    """Logs the totals of a snapshot, the slowest timers first."""
+    counters = ', '.join(f"{name}={value}" for name, value in snapshot['counters'].items() if value)
+    logger.info("Counters: %s", counters or 'none')
+    for name, timer in sorted(snapshot['timers'].items(), key=lambda item: -item[1]['total_seconds']):
+        logger.info("%s: %d calls, %.2f s in total, mean %.2f ms, p50 <= %g ms, p99 <= %g ms", name, timer['calls'],
+                    timer['total_seconds'], timer['mean_ms'], timer['p50_ms'], timer['p99_ms'])
+
+@contextlib.contextmanager
+def reporting(path=metrics_path, interval=REPORT_INTERVAL, metrics=None):
+    """Appends a snapshot of the metrics, with the rate of every counter since
+    the previous one, to a JSON lines file every interval seconds while the
+    block runs (and once at its end), then logs a summary.
+    """
+    metrics = metrics if metrics is not None else registry
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    stopped = threading.Event()
+    start = previous_time = time.time()
+    previous = metrics.snapshot()['counters']
+
+    def write(snapshot):
+        nonlocal previous, previous_time
+        now = time.time()
+        snapshot['time'] = now
+        snapshot['elapsed'] = now - start
+        snapshot['rates'] = {name: (value - previous[name]) / max(now - previous_time, 1e-9)
+                             for name, value in snapshot['counters'].items()}
+        previous, previous_time = snapshot['counters'], now
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot) + '\n')
+
+    def run():
+        while not stopped.wait(interval):
+            write(metrics.snapshot(flush=False))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield metrics
+    finally:
+        stopped.set()
+        thread.join()
+        snapshot = metrics.snapshot()
+        write(snapshot)
+        log_summary(snapshot)
@@ -0,0 +1,201 @@
+import asyncio
+import email.utils
+import multiprocessing
+import os
+import random
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from data import metrics
+
+# Maximum number of requests per second sent to each host by all the collector
+# processes together. Hosts not listed here share the DEFAULT_RATE bucket.
+HOST_RATES = {
+    'store.steampowered.com': 4.0,
+    'api.steampowered.com': 10.0,
+}
+DEFAULT_RATE = 4.0
+# Number of requests that can be sent at once after the bucket was idle
+BURST = 5
+# The rate never goes below MIN_RATE after throttling
+MIN_RATE = 0.1
+# After every successful request the rate grows back by this fraction of the
+# host's maximum rate, and it is halved on every 429/5xx response
+ADDITIVE_INCREASE = 0.02
+MULTIPLICATIVE_DECREASE = 0.5
+
+# Responses that are retried after a backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+# Layout of the shared state of a bucket
+_TOKENS, _UPDATED, _RATE, _MAX_RATE, _BLOCKED_UNTIL = range(5)
+_FIELDS = 5
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Returns a jittered exponential backoff delay (in seconds) for a retry.
+    Args:
+        attempt: the number of the failed attempt, starting from 0.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def parse_retry_after(value):
+    """Returns the delay (in seconds) of a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter(object):
+    """Adaptive token bucket per host, shared by every collector process.
+
+    The buckets live in shared memory, so the Pool workers forked from the
+    process that created the limiter (or given it as an initializer argument)
+    draw from the same budget. The rate of a host is halved when it answers
+    429 or 5xx, and grows back slowly while the requests succeed (AIMD).
+    A Retry-After header blocks the host until the given time.
+    """
+    def __init__(self, host_rates=HOST_RATES, default_rate=DEFAULT_RATE, burst=BURST):
+        self._hosts = {host: i for i, host in enumerate(host_rates)}
+        self._burst = burst
+        rates = list(host_rates.values()) + [default_rate]
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray('d', _FIELDS * len(rates))
+        now = time.time()
+        for i, rate in enumerate(rates):
+            self._state[i * _FIELDS + _TOKENS] = burst
+            self._state[i * _FIELDS + _UPDATED] = now
+            self._state[i * _FIELDS + _RATE] = rate
+            self._state[i * _FIELDS + _MAX_RATE] = rate
+            self._state[i * _FIELDS + _BLOCKED_UNTIL] = 0.0
+
+    def _offset(self, host):
+        return self._hosts.get(host, len(self._hosts)) * _FIELDS
+
+    def _take(self, host):
+        """Takes a token for host. Returns 0 on success, otherwise the time to
+        wait before trying again."""
+        i = self._offset(host)
+        state = self._state
+        with self._lock:
+            now = time.time()
+            if now < state[i + _BLOCKED_UNTIL]:
+                return state[i + _BLOCKED_UNTIL] - now
+            elapsed = now - state[i + _UPDATED]
+            state[i + _TOKENS] = min(self._burst, state[i + _TOKENS] + elapsed * state[i + _RATE])
+            state[i + _UPDATED] = now
+            if state[i + _TOKENS] >= 1:
+                state[i + _TOKENS] -= 1
+                return 0
+            return (1 - state[i + _TOKENS]) / state[i + _RATE]
+
+    def acquire(self, host):
+        """Blocks until a request can be sent to host."""
+        while True:
+            wait = self._take(host)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, host):
+        """Waits, without blocking the event loop, until a request can be sent to host."""
+        while True:
+            wait = self._take(host)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def feedback(self, host, status, retry_after=None):
+        """Adapts the rate of host to the status of its last response.
+        Args:
+            host: the host that answered.
+            status: the HTTP status code.
+            retry_after: the value of the Retry-After header, if any.
+        """
+        i = self._offset(host)
+        state = self._state
+        with self._lock:
+            if status in RETRY_STATUSES:
+                state[i + _RATE] = max(MIN_RATE, state[i + _RATE] * MULTIPLICATIVE_DECREASE)
+                state[i + _TOKENS] = min(state[i + _TOKENS], 0)
+                delay = parse_retry_after(retry_after)
+                if delay is not None:
+                    state[i + _BLOCKED_UNTIL] = max(state[i + _BLOCKED_UNTIL], time.time() + delay)
+            else:
+                max_rate = state[i + _MAX_RATE]
+                state[i + _RATE] = min(max_rate, state[i + _RATE] + ADDITIVE_INCREASE * max_rate)
+
+    def rate(self, host):
+        """The current rate (requests per second) of host."""
+        return self._state[self._offset(host) + _RATE]
+
+limiter = RateLimiter()
+
+_session = None
+_session_pid = None
+
+def get_session():
+    """Returns the requests session of this process (one connection pool per worker)."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        _session_pid = os.getpid()
+    return _session
+
+def count_response(status):
+    metrics.count('requests')
+    if status == 429:
+        metrics.count('responses_429')
+    elif status >= 500:
+        metrics.count('responses_5xx')
+
+def get(url, max_attempts=MAX_ATTEMPTS, **kwargs):
+    """Rate-limited requests.get.
+
+    429 and 5xx responses are retried after the longest of the Retry-After
+    delay and a jittered exponential backoff.
+    Returns:
+        The last requests.Response.
+    """
+    host = urlparse(url).netloc
+    for attempt in range(max_attempts):
+        with metrics.timer('rate_limit_wait'):
+            limiter.acquire(host)
+        response = get_session().get(url, **kwargs)
+        retry_after = response.headers.get('Retry-After')
+        limiter.feedback(host, response.status_code, retry_after)
+        count_response(response.status_code)
+        if response.status_code not in RETRY_STATUSES or attempt == max_attempts - 1:
+            return response
+        metrics.count('retries')
+        time.sleep(max(backoff(attempt), parse_retry_after(retry_after) or 0))
+
+async def get_async(session, url, max_attempts=MAX_ATTEMPTS, **kwargs):
+    """Rate-limited aiohttp GET, see get.
+    Returns:
+        tuple: The status code and body of the last response.
+    """
+    host = urlparse(url).netloc
+    for attempt in range(max_attempts):
+        with metrics.timer('rate_limit_wait'):
+            await limiter.acquire_async(host)
+        async with session.get(url, **kwargs) as response:
+            status = response.status
+            retry_after = response.headers.get('Retry-After')
+            body = await response.read()
+        limiter.feedback(host, status, retry_after)
+        count_response(status)
+        if status not in RETRY_STATUSES or attempt == max_attempts - 1:
+            return status, body
+        metrics.count('retries')
+        await asyncio.sleep(max(backoff(attempt), parse_retry_after(retry_after) or 0))
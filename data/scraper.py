@@ -1,17 +1,13 @@
+import asyncio
 import os
-import time
-import requests
-import json
 from urllib.parse import urlparse
 from urllib.error import URLError
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-
+import aiohttp
 
 from common import config
+from data.cache import cache
+from data import listing, ratelimit
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 games_txt_path = os.path.join(BASE_DIR, 'collected', config.GAMES_TXT)
@@ -74,15 +70,20 @@ test_categories = [
     'sports_fishing_hunting',
 ]
 
-BASE_URL = 'https://store.steampowered.com/category/'
-TOP_RATED = '?flavor=contenthub_toprated'
-
-options = webdriver.FirefoxOptions()
-options.add_argument('-headless')
+# Number of listing pages scraped per category
+PAGES = 20
+# Number of appdetails requests in flight while filtering the games
+TYPE_FILTER_CONCURRENCY = 32
 
-driver = webdriver.Firefox(options=options)
+# Only used for the pages that can't be fetched through plain HTTP, and only
+# started when first needed
+_browser = None
 
-app_ids = []
+def get_browser():
+    global _browser
+    if _browser is None:
+        _browser = listing.BrowserListingFetcher()
+    return _browser
 
 def is_url_valid(url):
     """Checks if a URL is valid by parsing it and handling potential errors."""
@@ -93,59 +94,109 @@ def is_url_valid(url):
         print(f"Invalid URL: {url}. Error: {e}")
         return False
 
-def get_app_details(app_id):
-    url = f"https://store.steampowered.com/api/appdetails?appids={app_id}&lang=en"
-    response = requests.get(url)
-    return json.loads(response.text)
-
-for category in categories:
-    for offset in range(20):
-        url = f"{BASE_URL}{category}/{TOP_RATED}&offset={offset * 12}"
-
-        if is_url_valid(url):
+def list_categories(categories, pages=PAGES):
+    """Lists the app_ids of the first pages of every category.
+
+    The pages are fetched concurrently over HTTP, the browser is only used for
+    the pages that failed.
+    Returns:
+        set: The app_ids found (as strings).
+    """
+    print(f"Fetching {pages} pages of {len(categories)} categories...")
+    listings = listing.fetch_listings(categories, pages)
+
+    app_ids = set()
+    for (category, page), listed_app_ids in listings.items():
+        if listed_app_ids is None:
+            url = listing.category_page_url(category, page)
+            if not is_url_valid(url):
+                print(f"Skipping invalid URL: {url}")
+                continue
             try:
-                driver.get(url)
-
-                print(f"Waiting for: {url}...", end=" ")
-
-                wait = WebDriverWait(driver, 20)
-                wait.until(EC.presence_of_all_elements_located((By.CLASS_NAME, 'salepreviewwidgets_SaleItemBrowserRow_y9MSd')))
-                elements = driver.find_elements(By.XPATH, "//div[@class='salepreviewwidgets_StoreSaleWidgetHalfLeft_2Va3O']/a")
-
-                print(f"DONE.\n\tFound {len(elements)} games in {category} category...")
-
-                for element in elements:
-                    href = element.get_attribute('href')
-                    app_id = str(href).split('/app/')[1].split('/')[0]
-
-                    for i in range(2): # Retry only once to save time
-                        try:
-                            app_details = get_app_details(app_id)[f"{app_id}"]
-                            break
-                        except TypeError:
-                            print("TYPE_ERROR")
-                            print(f"Failed to get app details for {app_id}. Retrying (attempt #{i + 1}) in 5 seconds...")
-                            time.sleep(5)
-                    else:
-                        print(f"Failed to get details for {app_id} after 5 attempts")
-                        continue
-
-                    if app_details['success'] == True:
-                        app_type = app_details['data']['type']
-                        if app_id not in app_ids and app_type == "game":
-                            app_ids.append(app_id)
-
+                listed_app_ids = get_browser().fetch(category, page)
             except Exception as e:
                 print("ERROR")
                 print(f"Could not process url: {url}. EXCEPTION: {e}")
-        else:
-            print(f"Skipping invalid URL: {url}")
-
-app_ids = sorted(map(int, app_ids))
-
-print(f"Writing the app_ids to {games_txt_path}")
-with open(games_txt_path, 'w', encoding='utf-8') as file:
-    file.write('\n'.join(map(str, app_ids)))
-
-print("Done\nQuiting...")
-driver.quit()
+                continue
+
+        print(f"Found {len(listed_app_ids)} games in {category} category (page {page})...")
+        app_ids.update(listed_app_ids)
+
+    return app_ids
+
+async def filter_games_async(app_ids, concurrency=TYPE_FILTER_CONCURRENCY):
+    """Keeps the app_ids whose type is "game", fetching the details concurrently."""
+    # Imported here so that importing the scraper stays cheap
+    from data import collector
+
+    games = set()
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        pending = iter(app_ids)
+
+        async def worker():
+            for app_id in pending:
+                for i in range(2): # Retry only once to save time
+                    try:
+                        app_details = (await collector.get_app_details_async(session, app_id))[f"{app_id}"]
+                        break
+                    except Exception as e:
+                        delay = ratelimit.backoff(i)
+                        print(f"Failed to get app details for {app_id} ({e}). Retrying (attempt #{i + 1}) in {delay:.1f} seconds...")
+                        await asyncio.sleep(delay)
+                else:
+                    print(f"Failed to get details for {app_id} after 2 attempts")
+                    continue
+
+                if app_details['success'] == True and app_details['data']['type'] == "game":
+                    games.add(app_id)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return games
+
+def filter_games(app_ids, concurrency=TYPE_FILTER_CONCURRENCY):
+    return asyncio.run(filter_games_async(app_ids, concurrency))
+
+def read_games_txt():
+    """Returns the set of app_ids already in games.txt."""
+    if not os.path.exists(games_txt_path):
+        return set()
+    with open(games_txt_path, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+def write_games_txt(app_ids):
+    print(f"Writing the app_ids to {games_txt_path}")
+    with open(games_txt_path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(map(str, sorted(map(int, app_ids)))))
+
+def discover(categories=categories, pages=PAGES, known_app_ids=()):
+    """Discovers the games listed in the first pages of the given categories.
+    Args:
+        categories: list of Steam category names.
+        pages: number of pages (of listing.PAGE_SIZE games) per category.
+        known_app_ids: app_ids already known to be games, their details are
+            not fetched again.
+    Returns:
+        list: The sorted app_ids (as int) of the known and discovered games.
+    """
+    known_app_ids = set(map(str, known_app_ids))
+    listed = list_categories(categories, pages)
+    new_app_ids = listed - known_app_ids
+    print(f"Found {len(listed)} apps, {len(new_app_ids)} of them are new. Filtering the games...")
+    games = filter_games(sorted(new_app_ids))
+    return sorted(map(int, known_app_ids | games))
+
+def main():
+    cache.reset_stats()
+    try:
+        app_ids = discover(categories, PAGES, read_games_txt())
+        write_games_txt(app_ids)
+    finally:
+        if _browser is not None:
+            _browser.quit()
+    cache.report()
+    print("Done\nQuiting...")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import bisect
+import json
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from model.recommender import COSINE, DOT, normalize, top_k
+from model.trainer import MFModel, models_path
+
+# Number of points sampled to train the k-means centroids, per list
+TRAINING_POINTS_PER_LIST = 64
+KMEANS_ITERATIONS = 10
+# Number of (points x centroids) distances computed at once
+BLOCK_SCORES = 1 << 24
+# Number of lists scanned by a query by default
+NUM_PROBES = 8
+
+def _assign(vectors, centroids):
+    """Index of the closest centroid (euclidean) of every vector, in blocks."""
+    half_norms = 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+    block_size = max(1, BLOCK_SCORES // max(len(centroids), 1))
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        # argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+        assignments[start:start + block_size] = np.argmax(block @ centroids.T - half_norms, axis=1)
+    return assignments
+
+def kmeans(vectors, num_clusters, num_iterations=KMEANS_ITERATIONS, seed=None):
+    """Lloyd's k-means. Empty clusters are restarted on random points.
+    Returns:
+        The [num_clusters, dim] centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].astype(np.float32)
+    for _ in range(num_iterations):
+        assignments = _assign(vectors, centroids)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        members = sp.csr_matrix((np.ones(len(vectors), dtype=np.float32), (assignments, np.arange(len(vectors)))),
+                                shape=(num_clusters, len(vectors)))
+        sums = members @ vectors
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids
+
+class IVFIndex(object):
+    """Inverted file index over embeddings for approximate DOT or COSINE search.
+
+    The embeddings are clustered with k-means and stored contiguously list by
+    list. A query only scores the embeddings of the num_probes lists whose
+    centroids score best, so num_probes trades speed for recall (probing
+    every list is exact).
+    """
+    def __init__(self, centroids, offsets, ids, vectors, measure=DOT):
+        """Initializes an IVFIndex.
+        Args:
+            centroids: the [num_lists, dim] centroids.
+            offsets: the start of every list in ids/vectors, plus the end.
+            ids: the index of every stored embedding, list by list.
+            vectors: the stored embeddings (normalized for COSINE), list by list.
+            measure: DOT or COSINE.
+        """
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.measure = measure
+
+    @classmethod
+    def build(cls, embeddings, measure=DOT, num_lists=None, seed=None):
+        """Builds an index of embeddings.
+        Args:
+            embeddings: the [num_items, dim] embeddings, the item index is the row.
+            measure: DOT or COSINE.
+            num_lists: number of lists, defaults to about sqrt(num_items).
+            seed: optional seed of the clustering.
+        Returns:
+            An IVFIndex.
+        """
+        if measure not in (DOT, COSINE):
+            raise ValueError(f"measure should be '{DOT}' or '{COSINE}', got: {measure}")
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if measure == COSINE:
+            vectors = normalize(vectors)
+        num_lists = min(num_lists or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+
+        rng = np.random.default_rng(seed)
+        num_samples = min(len(vectors), num_lists * TRAINING_POINTS_PER_LIST)
+        sample = vectors[rng.choice(len(vectors), num_samples, replace=False)]
+        centroids = kmeans(sample, num_lists, seed=seed)
+
+        assignments = _assign(vectors, centroids)
+        ids = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=num_lists), out=offsets[1:])
+        return cls(centroids, offsets, ids, vectors[ids], measure)
+
+    def search(self, queries, k=6, num_probes=NUM_PROBES):
+        """Approximate top k items of every query.
+        Args:
+            queries: the [num_queries, dim] query embeddings.
+            k: number of items per query.
+            num_probes: number of lists scanned per query.
+        Returns:
+            tuple: The [num_queries, k] item indices and scores, best first.
+                   Missing results (fewer than k candidates) are -1 and -inf.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.measure == COSINE:
+            queries = normalize(queries)
+        num_probes = min(num_probes, len(self.centroids))
+        probes, _ = top_k(queries @ self.centroids.T, num_probes)
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if not len(candidates):
+                continue
+            candidate_scores = np.asarray(self.vectors[candidates]) @ query
+            best, best_scores = top_k(candidate_scores[None, :], k)
+            indices[i, :best.shape[1]] = self.ids[candidates[best[0]]]
+            scores[i, :best.shape[1]] = best_scores[0]
+        return indices, scores
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in ('centroids', 'offsets', 'ids', 'vectors'):
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'measure': self.measure}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Loads a saved index, memory-mapping its arrays by default."""
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None)
+                  for name in ('centroids', 'offsets', 'ids', 'vectors')}
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        # The centroids are read by every query, keep them in memory
+        arrays['centroids'] = np.array(arrays['centroids'])
+        return cls(measure=meta['measure'], **arrays)
+
+def measure_recall(index, embeddings, queries, k=6, num_probes=NUM_PROBES):
+    """Compares index.search with an exact scan of embeddings.
+    Returns:
+        tuple: The recall at k, and the mean latency of a single query in seconds.
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    if index.measure == COSINE:
+        vectors = normalize(vectors)
+    exact, _ = top_k((normalize(queries) if index.measure == COSINE else queries) @ vectors.T, k)
+
+    start_time = time.perf_counter()
+    approximate = np.concatenate([index.search(query[None, :], k, num_probes)[0] for query in queries])
+    latency = (time.perf_counter() - start_time) / len(queries)
+
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approximate, exact))
+    return hits / exact.size, latency
+
+class NameIndex(object):
+    """Finds games by name without scanning the games table for exact and
+    prefix matches. Matching is case-insensitive."""
+    def __init__(self, names):
+        """Initializes a NameIndex.
+        Args:
+            names: the name of every game, the game index is the position.
+        """
+        self._names = ["" if not isinstance(name, str) else name.casefold() for name in names]
+        order = sorted(range(len(self._names)), key=self._names.__getitem__)
+        self._sorted_names = [self._names[i] for i in order]
+        self._order = order
+
+    def lookup(self, name):
+        """Returns the indices of the games named name, or else of the games
+        whose name starts with name, or else of those that contain it."""
+        key = name.casefold()
+        start = bisect.bisect_left(self._sorted_names, key)
+        end = bisect.bisect_right(self._sorted_names, key)
+        if start < end:
+            return sorted(self._order[start:end])
+
+        # Names starting with key sort right after key
+        end = start
+        while end < len(self._sorted_names) and self._sorted_names[end].startswith(key):
+            end += 1
+        if start < end:
+            return sorted(self._order[start:end])
+
+        return [i for i, game_name in enumerate(self._names) if key in game_name]
+
+def index_path(name, key, measure, path=models_path):
+    """Directory of the index of the 'steam_id' or 'app_id' embeddings of a model."""
+    return os.path.join(path, name, f"ann_{key}_{measure}")
+
+def build_indices(name, measure=DOT, num_queries=1000, k=10):
+    """Builds and saves the indices of the user and game embeddings of a saved
+    model, and prints their recall and latency against an exact scan."""
+    model = MFModel.load(name)
+    rng = np.random.default_rng()
+    for key, embeddings in model.embeddings.items():
+        start_time = time.time()
+        index = IVFIndex.build(embeddings, measure)
+        index.save(index_path(name, key, measure))
+        print(f"Built the {key} index ({len(index.centroids)} lists) in {time.time() - start_time} seconds.")
+
+        queries = np.asarray(embeddings)[rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)]
+        for num_probes in (1, 4, NUM_PROBES, 32):
+            recall, latency = measure_recall(index, embeddings, queries, k, num_probes)
+            print(f"\tnum_probes={num_probes}: recall@{k}={recall:.3f}, {latency * 1000:.3f} ms per query")
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'build':
+        name = args[1] if len(args) > 1 else 'regularized'
+        build_indices(name, COSINE if '--cosine' in sys.argv else DOT)
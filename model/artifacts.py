@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from model import features
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+artifacts_path = os.path.join(BASE_DIR, 'data', 'collected', 'artifacts')
+
+# Name of the file holding the name of the current version of the artifacts
+CURRENT = 'CURRENT'
+# Number of versions kept, for the models trained on the previous ones
+KEEP_VERSIONS = 3
+
+# Columns of the games table kept for displaying the recommendations and for
+# the game features of the softmax model
+GAME_COLUMNS = ['app_id', 'name', 'categories', 'genres', 'release_date']
+
+def build_matrix(user_index, game_index, values, shape):
+    """Builds a CSR matrix from (row, column, value) triplets. A repeated
+    (row, column) pair keeps its last value."""
+    pairs = pd.DataFrame({'row': user_index, 'column': game_index, 'value': values})
+    pairs = pairs.drop_duplicates(['row', 'column'], keep='last')
+    matrix = sp.csr_matrix(
+        (pairs['value'].to_numpy(dtype=np.float32),
+         (pairs['row'].to_numpy(dtype=np.int32), pairs['column'].to_numpy(dtype=np.int32))),
+        shape=shape
+    )
+    matrix.sort_indices()
+    return matrix
+
+def _save_csr(directory, name, matrix):
+    # scipy downcasts the index arrays to int32 when they fit, which would
+    # copy them when they are opened
+    index_dtype = np.int32 if max(matrix.nnz, *matrix.shape) < 2 ** 31 else np.int64
+    np.save(os.path.join(directory, f"{name}.indptr.npy"), matrix.indptr.astype(index_dtype))
+    np.save(os.path.join(directory, f"{name}.indices.npy"), matrix.indices.astype(index_dtype))
+    np.save(os.path.join(directory, f"{name}.data.npy"), matrix.data.astype(np.float32))
+
+def _open_csr(directory, name, shape):
+    arrays = [np.load(os.path.join(directory, f"{name}.{part}.npy"), mmap_mode='r')
+              for part in ('data', 'indices', 'indptr')]
+    # No copy as long as the arrays already have the dtypes scipy expects
+    return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+def save(ratings, steam_ids, games, path=artifacts_path):
+    """Writes a new version of the artifacts and makes it the current one.
+
+    The files of a version are never modified, and the KEEP_VERSIONS latest
+    versions are kept. Processes that opened an older version keep reading
+    their memory-mapped pages after it is deleted.
+    Args:
+        ratings: the ratings DataFrame of features.build_features.
+        steam_ids: the steam_id of every user index.
+        games: the games table, the game index is the row.
+        path: the artifacts directory.
+    """
+    os.makedirs(path, exist_ok=True)
+    version = f"ratings-{time.time_ns()}"
+    directory = os.path.join(path, version)
+    os.makedirs(directory)
+
+    shape = (len(steam_ids), len(games))
+    matrix = build_matrix(ratings['steam_id'].to_numpy(), ratings['app_id'].to_numpy(),
+                          ratings['pseudo_ratings'].to_numpy(), shape)
+    _save_csr(directory, 'user_game', matrix)
+    # The game x user matrix, for the algorithms that iterate over games
+    _save_csr(directory, 'game_user', matrix.T.tocsr())
+
+    steam_ids = np.asarray(steam_ids, dtype=np.int64)
+    app_ids = games['app_id'].to_numpy(dtype=np.int64)
+    np.save(os.path.join(directory, 'steam_ids.npy'), steam_ids)
+    np.save(os.path.join(directory, 'app_ids.npy'), app_ids)
+    # Sorted ids and their indices, for the id -> index lookups
+    for name, ids in (('steam_ids', steam_ids), ('app_ids', app_ids)):
+        order = np.argsort(ids, kind='stable')
+        np.save(os.path.join(directory, f"{name}.sorted.npy"), ids[order])
+        np.save(os.path.join(directory, f"{name}.order.npy"), order)
+    games[[column for column in GAME_COLUMNS if column in games.columns]].to_parquet(
+        os.path.join(directory, 'games.parquet'), index=False)
+
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'num_users': shape[0], 'num_games': shape[1], 'nnz': int(matrix.nnz), 'built': time.time()}, f)
+
+    tmp_path = os.path.join(path, f"{CURRENT}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(path, CURRENT))
+
+    versions = sorted((name for name in os.listdir(path) if name.startswith('ratings-')),
+                      key=lambda name: int(name.split('-')[1]))
+    for name in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return directory
+
+def build(path=artifacts_path):
+    """Builds the artifacts from the collected tables."""
+    start_time = time.time()
+    ratings, steam_ids, games = features.load_features()
+    directory = save(ratings, steam_ids, games, path)
+    print(f"Successfully written to '{directory}'")
+    print(f"Finished in {time.time() - start_time} seconds.")
+
+class Interactions(object):
+    """The current version of the artifacts, memory-mapped.
+
+    Opening it only maps the files, and every process that opens it shares
+    the same pages of the page cache.
+    Attributes:
+        matrix: the users x games scipy.sparse.csr_matrix of pseudo ratings.
+        game_matrix: its transpose as a games x users CSR matrix.
+        steam_ids: the steam_id of every user index.
+        app_ids: the app_id of every game index.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        shape = (self.meta['num_users'], self.meta['num_games'])
+        self.matrix = _open_csr(directory, 'user_game', shape)
+        self.game_matrix = _open_csr(directory, 'game_user', shape[::-1])
+        self.steam_ids = np.load(os.path.join(directory, 'steam_ids.npy'), mmap_mode='r')
+        self.app_ids = np.load(os.path.join(directory, 'app_ids.npy'), mmap_mode='r')
+        self._sorted = {name: (np.load(os.path.join(directory, f"{name}.sorted.npy"), mmap_mode='r'),
+                               np.load(os.path.join(directory, f"{name}.order.npy"), mmap_mode='r'))
+                        for name in ('steam_ids', 'app_ids')}
+        self._games = None
+
+    @classmethod
+    def open(cls, path=artifacts_path, version=None):
+        """Opens a version of the artifacts in path, the current one by default."""
+        if version is None:
+            with open(os.path.join(path, CURRENT), 'r', encoding='utf-8') as f:
+                version = f.read().strip()
+        directory = os.path.join(path, version)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No version {version} of the artifacts in {path}")
+        return cls(directory)
+
+    @property
+    def num_users(self):
+        return self.matrix.shape[0]
+
+    @property
+    def num_games(self):
+        return self.matrix.shape[1]
+
+    @property
+    def games(self):
+        """The games table (GAME_COLUMNS), the game index is the row. Read on
+        first use."""
+        if self._games is None:
+            self._games = pd.read_parquet(os.path.join(self.directory, 'games.parquet'))
+        return self._games
+
+    def _lookup(self, name, ids):
+        sorted_ids, order = self._sorted[name]
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(sorted_ids):
+            return np.full(ids.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[positions] == ids, order[positions], -1)
+
+    def user_index(self, steam_ids):
+        """Maps steam_ids to user indices (-1 for the unknown ones)."""
+        return self._lookup('steam_ids', steam_ids)
+
+    def game_index(self, app_ids):
+        """Maps app_ids to game indices (-1 for the unknown ones)."""
+        return self._lookup('app_ids', app_ids)
+
+if __name__ == '__main__':
+    build()
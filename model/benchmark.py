@@ -0,0 +1,406 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from model import artifacts, features
+from model.artifacts import Interactions
+from model.loader import UserGamesLoader, split_users
+from model.recommender import DOT, Recommender
+from model.softmax import SAMPLED, SoftmaxModel, sampling_distribution, vocabulary_sizes
+from model.trainer import MFModel
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+benchmarks_path = os.path.join(BASE_DIR, 'data', 'collected', 'benchmarks')
+BASELINE = 'baseline'
+
+# Synthetic data scales: number of users, number of games, mean number of
+# reviews per user
+SCALES = {
+    'small': (10000, 1000, 20),
+    'medium': (100000, 10000, 20),
+    'large': (1000000, 50000, 20),
+}
+DEFAULT_SCALES = ['small', 'medium']
+# Relative change of a metric reported as a regression
+TOLERANCE = 0.1
+
+# Training settings of the quality benchmark, fixed so that runs compare
+MF_SETTINGS = {
+    'embedding_dim': 32,
+    'regularization_coeff': 0.5,
+    'gravity_coeff': 1.0,
+    'init_stddev': 0.5,
+    'holdout_fraction': 0,
+    'max_iterations': 10,
+}
+SOFTMAX_SETTINGS = {
+    'num_iterations': 1000,
+    'mode': SAMPLED,
+    'eval_every': 1000,
+}
+
+def synthetic_tables(num_users, num_games, reviews_per_user=20, num_clusters=20, seed=0):
+    """Builds random reviews and games tables with the columns read by
+    build_features (and timestamp_created).
+
+    Game popularity and the number of reviews per user follow power laws, and
+    every user mostly reviews the games of a favourite cluster (which sets the
+    categories and genres of its games), so that there is something to learn.
+    Returns:
+        tuple: The reviews and games DataFrames.
+    """
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, num_games + 1) ** 1.1
+    game_clusters = rng.integers(num_clusters, size=num_games)
+
+    # Pareto lengths with a mean of reviews_per_user
+    lengths = np.ceil((rng.pareto(1.2, num_users) + 1) * reviews_per_user / 6).astype(np.int64)
+    lengths = np.minimum(lengths, max(num_games // 2, 1))
+    users = np.repeat(np.arange(num_users), lengths)
+    user_clusters = rng.integers(num_clusters, size=num_users)[users]
+
+    games = np.searchsorted(np.cumsum(popularity), rng.random(len(users)) * popularity.sum())
+    in_cluster = rng.random(len(users)) < 0.7
+    for cluster in range(num_clusters):
+        cluster_games = np.flatnonzero(game_clusters == cluster)
+        reviews = np.flatnonzero(in_cluster & (user_clusters == cluster))
+        if len(cluster_games) and len(reviews):
+            weights = np.cumsum(popularity[cluster_games])
+            games[reviews] = cluster_games[np.searchsorted(weights, rng.random(len(reviews)) * weights[-1])]
+    games = np.minimum(games, num_games - 1)
+
+    playtime = rng.lognormal(6, 2, len(users)).astype(np.int64)
+    recs = pd.DataFrame({
+        'steam_id': 76561197960265728 + users,
+        'app_id': 10 * (games + 1),
+        'num_games_owned': lengths[users] * rng.integers(1, 20, len(users)),
+        'num_reviews': lengths[users],
+        'playtime_forever': playtime,
+        'playtime_last_two_weeks': (playtime * rng.random(len(users)) * 0.1).astype(np.int64),
+        'playtime_at_review': (playtime * rng.random(len(users))).astype(np.int64),
+        'voted_up': rng.random(len(users)) < 0.8,
+        'votes_up': rng.geometric(0.3, len(users)) - 1,
+        'votes_funny': rng.geometric(0.6, len(users)) - 1,
+        'weighted_vote_score': rng.random(len(users)),
+        'comment_count': rng.geometric(0.8, len(users)) - 1,
+        'timestamp_created': rng.integers(1600000000, 1700000000, len(users)),
+    }).drop_duplicates(['steam_id', 'app_id'])
+
+    counts = np.bincount(games, minlength=num_games)
+    positive = (counts * rng.uniform(0.5, 1, num_games)).astype(np.int64)
+    games_table = pd.DataFrame({
+        'app_id': 10 * (np.arange(num_games) + 1),
+        'name': [f"Game {i}" for i in range(num_games)],
+        'categories': [f"Single-player|Category {c % 7}" for c in game_clusters],
+        'genres': [f"Genre {c}" for c in game_clusters],
+        'release_date': [f"1 Jan, {year}" for year in rng.integers(2000, 2024, num_games)],
+        'review_score': rng.integers(0, 10, num_games),
+        'total_positive': positive,
+        'total_negative': counts - positive,
+        'total_reivews': counts,
+    })
+    return recs, games_table
+
+def load_tables():
+    """Reads the collected reviews (with their timestamps) and games tables."""
+    from data import collector
+    recs = collector.read_users_games_data(columns=features.REVIEW_COLUMNS + ['timestamp_created'])
+    games = collector.read_games_data(columns=features.GAME_COLUMNS)
+    return recs, games
+
+def time_split(recs, test_fraction=0.2, column='timestamp_created'):
+    """Splits the reviews at the timestamp leaving test_fraction of them after it.
+    Returns:
+        tuple: The training and test reviews, and the cutoff timestamp.
+    """
+    cutoff = np.quantile(recs[column].to_numpy(), 1 - test_fraction)
+    is_test = (recs[column] > cutoff).to_numpy()
+    return recs[~is_test], recs[is_test], int(cutoff)
+
+def test_matrix(interactions, test_recs):
+    """The users x games binary CSR matrix of the test reviews of known users
+    and games, without the pairs already in the training interactions."""
+    users = interactions.user_index(test_recs['steam_id'].to_numpy())
+    games = interactions.game_index(test_recs['app_id'].to_numpy())
+    known = (users >= 0) & (games >= 0)
+    matrix = sp.csr_matrix((np.ones(int(known.sum()), dtype=np.float32), (users[known], games[known])),
+                           shape=(interactions.num_users, interactions.num_games))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    matrix = matrix - matrix.multiply(interactions.matrix != 0)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return matrix
+
+def ranking_metrics(recommender, test, k=10, batch_size=10000):
+    """Recall@k, NDCG@k and catalogue coverage of the top k games (excluding
+    the rated ones) of every user with test games.
+
+    The hits of a batch of users are found at once by searching the
+    (row, game) keys of the recommendations in the sorted keys of the test
+    matrix.
+    Returns:
+        dict: The mean recall and NDCG over the users, the fraction of the
+              games recommended to at least one user, and the number of users.
+    """
+    num_games = test.shape[1]
+    users = np.flatnonzero(np.diff(test.indptr))
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+    ideal = np.cumsum(discounts)
+    recalls, ndcgs = [], []
+    recommended = np.zeros(num_games, dtype=bool)
+    for start in range(0, len(users), batch_size):
+        batch = users[start:start + batch_size]
+        indices, scores = recommender.recommend(batch, k, DOT, exclude_rated=True)
+        rows = test[batch]
+        relevant = np.diff(rows.indptr)
+        test_keys = np.repeat(np.arange(len(batch), dtype=np.int64), relevant) * num_games + rows.indices
+        keys = np.arange(len(batch), dtype=np.int64)[:, None] * num_games + indices
+        positions = np.minimum(np.searchsorted(test_keys, keys), len(test_keys) - 1)
+        valid = np.isfinite(scores)
+        hits = (test_keys[positions] == keys) & valid
+        recalls.append(hits.sum(axis=1) / relevant)
+        ndcgs.append((hits * discounts[:hits.shape[1]]).sum(axis=1) / ideal[np.minimum(relevant, k) - 1])
+        recommended[indices[valid]] = True
+    return {
+        f"recall_at_{k}": float(np.mean(np.concatenate(recalls))) if recalls else 0.0,
+        f"ndcg_at_{k}": float(np.mean(np.concatenate(ndcgs))) if ndcgs else 0.0,
+        'coverage': float(recommended.mean()),
+        'num_users': int(len(users)),
+    }
+
+def _interactions(recs, games, path):
+    ratings, steam_ids, reviewed_games = features.build_features(recs, games)
+    artifacts.save(ratings, steam_ids, reviewed_games, path)
+    return Interactions.open(path)
+
+def evaluate_quality(recs, games, k=10, test_fraction=0.2, mf_settings=MF_SETTINGS,
+                     softmax_settings=SOFTMAX_SETTINGS, seed=0):
+    """Trains the MF and softmax models on the reviews before a timestamp and
+    measures their top k recommendations on the reviews after it, next to a
+    most popular games baseline.
+    Returns:
+        dict: The split sizes, and the ranking_metrics (and training time) of
+              every model.
+    """
+    train_recs, test_recs, cutoff = time_split(recs, test_fraction)
+    with tempfile.TemporaryDirectory() as path:
+        interactions = _interactions(train_recs, games, path)
+        test = test_matrix(interactions, test_recs)
+        results = {'split': {
+            'cutoff': cutoff,
+            'train_reviews': len(train_recs),
+            'test_reviews': len(test_recs),
+            'num_users': interactions.num_users,
+            'num_games': interactions.num_games,
+        }}
+
+        counts = np.bincount(interactions.matrix.indices, minlength=interactions.num_games).astype(np.float32)
+        popularity = Recommender(np.ones((interactions.num_users, 1), dtype=np.float32), counts[:, None], interactions)
+        results['popularity'] = ranking_metrics(popularity, test, k)
+
+        start_time = time.time()
+        mf = MFModel.train(interactions.matrix, seed=seed, verbose=False, **mf_settings)
+        train_seconds = time.time() - start_time
+        results['mf'] = ranking_metrics(
+            Recommender(mf.embeddings['steam_id'], mf.embeddings['app_id'], interactions), test, k)
+        results['mf']['train_seconds'] = train_seconds
+
+        start_time = time.time()
+        loader = UserGamesLoader(interactions)
+        softmax = SoftmaxModel(vocabulary_sizes(loader), seed=seed)
+        train_users, eval_users = split_users(interactions.num_users, seed=seed)
+        softmax.train(loader, train_users, eval_users, seed=seed, verbose=False, **softmax_settings)
+        user_embeddings = softmax.all_user_embeddings(loader)
+        train_seconds = time.time() - start_time
+        results['softmax'] = ranking_metrics(
+            Recommender(user_embeddings, softmax.params['app_id'], interactions), test, k)
+        results['softmax']['train_seconds'] = train_seconds
+    return results
+
+def profile(function, *args, **kwargs):
+    """Runs a function twice: once tracing its allocations (NumPy arrays
+    included) for the peak memory, then untraced for the elapsed time, since
+    tracing slows down every allocation. The function has to do the same work
+    on both calls.
+    Returns:
+        tuple: The result of the second call, its elapsed seconds and the peak
+               traced memory of the first one in MB.
+    """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start_time
+    return result, elapsed, peak / 2**20
+
+def evaluate_performance(num_users, num_games, reviews_per_user=20, k=10, seed=0,
+                         als_iterations=3, softmax_steps=100, num_queries=200):
+    """Times the pipeline on synthetic data of a given scale: feature
+    building, ALS and sampled softmax training throughput, and top k latency
+    of single and batched queries, with the peak memory of every phase.
+    """
+    recs, games = synthetic_tables(num_users, num_games, reviews_per_user, seed=seed)
+    results = {'num_reviews': len(recs)}
+
+    (ratings, steam_ids, reviewed_games), seconds, memory = profile(features.build_features, recs, games)
+    results['features'] = {
+        'seconds': seconds,
+        'reviews_per_second': len(recs) / seconds,
+        'peak_memory_mb': memory,
+    }
+    with tempfile.TemporaryDirectory() as path:
+        artifacts.save(ratings, steam_ids, reviewed_games, path)
+        interactions = Interactions.open(path)
+        matrix = interactions.matrix
+
+        mf, seconds, memory = profile(MFModel.train, matrix, embedding_dim=MF_SETTINGS['embedding_dim'],
+                                      holdout_fraction=0, max_iterations=als_iterations, seed=seed, verbose=False)
+        results['als'] = {
+            'seconds_per_iteration': seconds / als_iterations,
+            'ratings_per_second': matrix.nnz * als_iterations / seconds,
+            'peak_memory_mb': memory,
+        }
+
+        loader = UserGamesLoader(interactions)
+        sampling = sampling_distribution(loader)
+        batch_size = 200
+
+        def train_softmax():
+            # A new model on every call, so that both calls of profile do the same steps
+            softmax = SoftmaxModel(vocabulary_sizes(loader), seed=seed)
+            rng = np.random.default_rng(seed)
+            batches = loader.batches(batch_size=batch_size, padded=False, repeat=True, seed=seed)
+            try:
+                for _ in range(softmax_steps):
+                    softmax.train_step(next(batches), rng, 3., SAMPLED, sampling)
+            finally:
+                batches.close()
+
+        _, seconds, memory = profile(train_softmax)
+        results['softmax'] = {
+            'examples_per_second': softmax_steps * batch_size / seconds,
+            'peak_memory_mb': memory,
+        }
+
+        recommender = Recommender(mf.embeddings['steam_id'], mf.embeddings['app_id'], interactions)
+        rng = np.random.default_rng(seed)
+        users = rng.choice(interactions.num_users, num_queries)
+        latencies = []
+        for user in users:
+            start_time = time.perf_counter()
+            recommender.recommend([user], k, exclude_rated=True)
+            latencies.append(time.perf_counter() - start_time)
+        latencies = np.array(latencies) * 1000
+        batch_users = rng.choice(interactions.num_users, min(10000, interactions.num_users), replace=False)
+        _, seconds, memory = profile(recommender.recommend, batch_users, k, exclude_rated=True)
+        results['top_k'] = {
+            'single_p50_ms': float(np.percentile(latencies, 50)),
+            'single_p99_ms': float(np.percentile(latencies, 99)),
+            'batch_ms_per_user': seconds * 1000 / len(batch_users),
+            'batch_peak_memory_mb': memory,
+        }
+    return results
+
+def run(scales=DEFAULT_SCALES, collected=False, k=10, seed=0):
+    """Runs the quality benchmark (on the small synthetic scale, and on the
+    collected data if collected) and the performance benchmark at every scale."""
+    results = {
+        'created': int(time.time()),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'quality': {'synthetic': evaluate_quality(*synthetic_tables(*SCALES['small'], seed=seed), k=k, seed=seed)},
+        'performance': {},
+    }
+    if collected:
+        results['quality']['collected'] = evaluate_quality(*load_tables(), k=k, seed=seed)
+    for scale in scales:
+        results['performance'][scale] = evaluate_performance(*SCALES[scale], k=k, seed=seed)
+    return results
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+def _direction(key):
+    """1 if a metric is better higher, -1 if better lower, 0 if it isn't a
+    benchmark metric (sizes, timestamps)."""
+    name = key.rsplit('.', 1)[-1]
+    if name.startswith(('recall', 'ndcg', 'coverage')) or name.endswith('per_second'):
+        return 1
+    if name.endswith(('seconds', '_ms', 'per_user', 'per_iteration', 'memory_mb')):
+        return -1
+    return 0
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Compares benchmark results to a baseline.
+    Returns:
+        list: The (metric, baseline value, value, relative change) of every
+              metric worse than the baseline by more than tolerance.
+    """
+    current = _flatten(results)
+    regressions = []
+    for key, base in _flatten(baseline).items():
+        direction = _direction(key)
+        if not direction or key not in current or key.startswith('environment.'):
+            continue
+        change = (current[key] - base) / abs(base) if base else 0.0
+        if direction * change < -tolerance:
+            regressions.append((key, base, current[key], change))
+    return regressions
+
+def write(results, name, path=benchmarks_path):
+    os.makedirs(path, exist_ok=True)
+    results_path = os.path.join(path, f"{name}.json")
+    with open(results_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    return results_path
+
+def read(name, path=benchmarks_path):
+    with open(os.path.join(path, f"{name}.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def benchmark(name, scales=DEFAULT_SCALES, collected=False, save_baseline=False):
+    """Runs the benchmarks, writes the results to benchmarks_path/name.json
+    and reports the regressions against the saved baseline."""
+    start_time = time.time()
+    results = run(scales, collected)
+    print(f"Successfully written to '{write(results, name)}'")
+    if save_baseline:
+        print(f"Successfully written to '{write(results, BASELINE)}'")
+    elif os.path.exists(os.path.join(benchmarks_path, f"{BASELINE}.json")):
+        regressions = compare(results, read(BASELINE))
+        for key, base, value, change in regressions:
+            print(f"REGRESSION {key}: {base:g} -> {value:g} ({change:+.1%})")
+        if not regressions:
+            print("No regression against the baseline.")
+    print(f"Finished in {time.time() - start_time} seconds.")
+    return results
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'run':
+        name = args[1] if len(args) > 1 else time.strftime('%Y%m%d-%H%M%S')
+        scales = args[2:] or DEFAULT_SCALES
+        benchmark(name, scales, '--collected' in sys.argv, '--save-baseline' in sys.argv)
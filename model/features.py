@@ -0,0 +1,208 @@
+import itertools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from data import collector
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+pseudo_ratings_csv_path = os.path.join(BASE_DIR, 'data', 'collected', 'pseudo_ratings.csv')
+
+# Columns min-max normalized before computing the pseudo ratings
+COLS_TO_NORMALIZE = [
+    'num_games_owned',
+    'num_reviews',
+    'playtime_forever',
+    'playtime_last_two_weeks',
+    'playtime_at_review',
+    'votes_up',
+    'votes_funny',
+    'comment_count',
+    'review_score',
+    'total_positive',
+    'total_negative',
+    'total_reviews',
+]
+
+WEIGHTS = {
+    'weighted_vote_score': 0.5,
+    'playtime_forever': 0.2,
+    'voted_up': 0.1,
+    'num_reviews': 0.05,
+    'total_reviews': 0.05,
+    'total_positive': 0.05,
+    'total_negative': 0.05,
+}
+
+INTERACTION_WEIGHTS = {
+    'voted_up_total_positive_negative_reviews': 0.25,
+    'playtime_voted_up': 0.25,
+    'playtime_category': 0.25,
+    'playtime_genre': 0.25,
+}
+
+# The plain and interaction terms weigh half of the rating each
+WEIGHTS = {key: 0.5 * value for key, value in WEIGHTS.items()}
+INTERACTION_WEIGHTS = {key: 0.5 * value for key, value in INTERACTION_WEIGHTS.items()}
+
+# Columns read from the collected tables
+REVIEW_COLUMNS = [
+    'steam_id',
+    'app_id',
+    'num_games_owned',
+    'num_reviews',
+    'playtime_forever',
+    'playtime_last_two_weeks',
+    'playtime_at_review',
+    'voted_up',
+    'votes_up',
+    'votes_funny',
+    'weighted_vote_score',
+    'comment_count',
+]
+GAME_COLUMNS = [
+    'app_id',
+    'name',
+    'categories',
+    'genres',
+    'release_date',
+    'review_score',
+    'total_positive',
+    'total_negative',
+    'total_reivews',
+]
+
+def split_tags(column):
+    """Returns the list of tags of every value of a categories/genres column,
+    read from CSV ('|'-separated strings) or Parquet (lists). Missing values
+    and "N/A" have no tags."""
+    tags = []
+    for value in column:
+        if isinstance(value, str):
+            tags.append([] if value == "N/A" else [tag for tag in value.split('|') if tag])
+        elif isinstance(value, (list, np.ndarray)):
+            tags.append(list(value))
+        else:
+            tags.append([])
+    return tags
+
+def multi_hot(tags):
+    """Sparse multi-hot encoding of lists of tags.
+    Args:
+        tags: a list of lists of tags, one per row.
+    Returns:
+        tuple: A scipy.sparse.csr_matrix of shape [len(tags), len(vocabulary)]
+               and the sorted vocabulary (the tag of every column).
+    """
+    lengths = np.fromiter(map(len, tags), dtype=np.int64, count=len(tags))
+    codes, vocabulary = pd.factorize(np.array(list(itertools.chain.from_iterable(tags)), dtype=object), sort=True)
+    indptr = np.zeros(len(tags) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    matrix = sp.csr_matrix(
+        (np.ones(len(codes), dtype=np.float32), codes, indptr),
+        shape=(len(tags), len(vocabulary))
+    )
+    # A tag listed twice is still a single 1
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix, np.asarray(vocabulary)
+
+def min_max_normalize(values):
+    """Scales values to [0, 1] like sklearn's MinMaxScaler: NaNs are ignored,
+    and a constant column becomes 0."""
+    values = np.asarray(values, dtype=np.float64)
+    low, high = np.nanmin(values), np.nanmax(values)
+    value_range = high - low
+    return (values - low) / (value_range if value_range != 0 else 1.0)
+
+def encode_ids(recs, games):
+    """Maps the steam_ids and app_ids of the reviews to contiguous indices.
+
+    The users are numbered in order of first appearance in the reviews, and the
+    games in the order of the games table, keeping only the reviewed games.
+    Returns:
+        tuple: The user and game index of every review, the steam_id of every
+               user index, and the reviewed games (the game index is the row).
+    """
+    user_index, steam_ids = pd.factorize(recs['steam_id'])
+    games = games[games['app_id'].isin(recs['app_id'].unique())]
+    games = games.drop_duplicates('app_id').reset_index(drop=True)
+    game_index = pd.Index(games['app_id']).get_indexer(recs['app_id'])
+    return user_index, game_index, np.asarray(steam_ids), games
+
+def build_features(recs, games):
+    """Builds the pseudo rating of every review.
+
+    The per-game features (tags, review counts) are computed once per game and
+    gathered by game index instead of being merged into the reviews, and the
+    category/genre interaction terms are a single sparse matrix product.
+    Args:
+        recs: a DataFrame with the REVIEW_COLUMNS of the users-games table.
+        games: a DataFrame with the GAME_COLUMNS of the games table.
+    Returns:
+        tuple: The ratings DataFrame (steam_id and app_id indices, and
+               pseudo_ratings in [0, 1]), the steam_id of every user index,
+               and the reviewed games (the app_id index is the row).
+    """
+    games = games.rename(columns={'total_reivews': 'total_reviews'})
+    # Reviews of games missing from the games table have no features
+    recs = recs[recs['app_id'].isin(games['app_id'])]
+    user_index, game_index, steam_ids, games = encode_ids(recs, games)
+
+    # Min and max over the reviewed games are the min and max over the reviews
+    columns = {}
+    for col in COLS_TO_NORMALIZE:
+        if col in games.columns:
+            columns[col] = min_max_normalize(games[col].to_numpy())[game_index]
+        else:
+            columns[col] = min_max_normalize(recs[col].to_numpy())
+    columns['weighted_vote_score'] = recs['weighted_vote_score'].to_numpy(dtype=np.float64)
+    columns['voted_up'] = recs['voted_up'].to_numpy(dtype=np.float64)
+
+    pseudo_ratings = np.zeros(len(recs))
+    for col, weight in WEIGHTS.items():
+        pseudo_ratings += weight * columns[col]
+
+    # The 'voted_up_total_positive_negative_reviews' and 'playtime_voted_up'
+    # terms of the original notebook add the same total to every review, which
+    # the final normalization cancels out, so they are left out.
+
+    categories, category_vocabulary = multi_hot(split_tags(games['categories']))
+    genres, genre_vocabulary = multi_hot(split_tags(games['genres']))
+    tag_weights = np.concatenate([
+        np.full(len(category_vocabulary), INTERACTION_WEIGHTS['playtime_category'] / max(len(category_vocabulary), 1)),
+        np.full(len(genre_vocabulary), INTERACTION_WEIGHTS['playtime_genre'] / max(len(genre_vocabulary), 1)),
+    ])
+    game_tag_weights = sp.hstack([categories, genres], format='csr') @ tag_weights
+    pseudo_ratings += columns['playtime_forever'] * game_tag_weights[game_index]
+
+    ratings = pd.DataFrame({
+        'steam_id': user_index,
+        'app_id': game_index,
+        'pseudo_ratings': min_max_normalize(pseudo_ratings),
+    })
+    return ratings, steam_ids, games
+
+def load_features():
+    """Builds the features from the collected tables (see build_features)."""
+    recs = collector.read_users_games_data(columns=REVIEW_COLUMNS)
+    games = collector.read_games_data(columns=GAME_COLUMNS)
+    return build_features(recs, games)
+
+def write_pseudo_ratings():
+    """Writes the pseudo ratings with the original steam_ids and app_ids."""
+    start_time = time.time()
+    ratings, steam_ids, games = load_features()
+    pd.DataFrame({
+        'steam_id': steam_ids[ratings['steam_id'].to_numpy()],
+        'app_id': games['app_id'].to_numpy()[ratings['app_id'].to_numpy()],
+        'pseudo_ratings': ratings['pseudo_ratings'],
+    }).to_csv(pseudo_ratings_csv_path, index=False)
+    print(f"Successfully written to '{pseudo_ratings_csv_path}'")
+    print(f"Finished in {time.time() - start_time} seconds.")
+
+if __name__ == '__main__':
+    write_pseudo_ratings()
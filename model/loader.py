@@ -0,0 +1,217 @@
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+from model.artifacts import Interactions
+from model.features import split_tags
+
+# Tag of the games without categories or genres (as the notebook's fillna)
+UNKNOWN = 'Unknown'
+# Value of the padding of the padded batches
+PADDING = -1
+# Number of batches computed ahead by the background thread
+PREFETCH = 4
+# Number of batches whose users are sorted by length together when bucketing
+BUCKET_WINDOW = 100
+
+def release_year(release_date):
+    """The year of a release date as in the notebook ("21 Aug, 2012" -> "2012")."""
+    return str(release_date).split(', ')[-1].split(' ')[-1]
+
+def encode_tags(tags):
+    """Encodes lists of tags as CSR-like arrays of vocabulary indices.
+    Returns:
+        tuple: The indptr and int32 values arrays, and the sorted vocabulary.
+    """
+    tags = [row if row else [UNKNOWN] for row in tags]
+    lengths = np.fromiter(map(len, tags), dtype=np.int64, count=len(tags))
+    codes, vocabulary = pd.factorize(np.array([tag for row in tags for tag in row], dtype=object), sort=True)
+    indptr = np.zeros(len(tags) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return indptr, codes.astype(np.int32), list(vocabulary)
+
+def ragged_gather(indptr, values, rows):
+    """Concatenates the rows of a CSR-like (indptr, values) pair.
+    Returns:
+        tuple: The concatenated values and the length of every row.
+    """
+    starts = indptr[rows]
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    ends = np.cumsum(lengths)
+    positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+    return values[positions], lengths
+
+def bucket_length(length):
+    """Rounds a length up to a power of two, so that padded batches only take
+    a few shapes."""
+    return 1 << max(int(length) - 1, 0).bit_length()
+
+def pad(values, row_splits, length=None):
+    """Pads ragged rows into a dense [num_rows, length] int32 array."""
+    lengths = np.diff(row_splits)
+    length = length if length is not None else bucket_length(lengths.max(initial=1))
+    padded = np.full((len(lengths), length), PADDING, dtype=np.int32)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    columns = np.arange(len(values)) - np.repeat(row_splits[:-1], lengths)
+    padded[rows, columns] = values
+    return padded
+
+def split_users(num_users, holdout_fraction=0.1, seed=None):
+    """Randomly splits the user indices into training and test users."""
+    users = np.random.default_rng(seed).permutation(num_users)
+    num_test = int(round(num_users * holdout_fraction))
+    return np.sort(users[num_test:]), np.sort(users[:num_test])
+
+class UserGamesLoader(object):
+    """Streams the softmax model examples (one per user) from the artifacts.
+
+    A user's example holds the features of the games they reviewed: app_id
+    (game index), year, categories and genres (vocabulary indices), and the
+    label (game indices). The per-game features are encoded once, so a batch
+    is only a few gathers over the CSR interaction matrix, and only the
+    current batches are in memory.
+    """
+    def __init__(self, interactions=None):
+        """Initializes a UserGamesLoader.
+        Args:
+            interactions: the Interactions to read, the current ones by default.
+        """
+        self.interactions = interactions if interactions is not None else Interactions.open()
+        games = self.interactions.games
+
+        years = [release_year(date) for date in games['release_date']] if 'release_date' in games else [UNKNOWN] * len(games)
+        year_codes, year_vocabulary = pd.factorize(np.array(years, dtype=object), sort=True)
+        self._years = year_codes.astype(np.int32)
+        self._categories = encode_tags(split_tags(games['categories']))
+        self._genres = encode_tags(split_tags(games['genres']))
+        self.vocabularies = {
+            'app_id': self.interactions.num_games,
+            'year': list(year_vocabulary),
+            'categories': self._categories[2],
+            'genres': self._genres[2],
+        }
+
+    def example_lengths(self, users):
+        """Number of reviewed games of every user."""
+        indptr = self.interactions.matrix.indptr
+        return indptr[np.asarray(users) + 1] - indptr[users]
+
+    def batch(self, users):
+        """Builds the ragged batch of users.
+        Returns:
+            dict: Maps every feature (app_id, year, categories, genres, label)
+                  to (values, row_splits) int32/int64 arrays, as
+                  tf.RaggedTensor.from_row_splits expects.
+        """
+        matrix = self.interactions.matrix
+        games, game_lengths = ragged_gather(matrix.indptr, matrix.indices, users)
+        game_splits = np.zeros(len(users) + 1, dtype=np.int64)
+        np.cumsum(game_lengths, out=game_splits[1:])
+        games = games.astype(np.int32)
+
+        batch = {
+            'app_id': (games, game_splits),
+            'year': (self._years[games], game_splits),
+            'label': (games, game_splits),
+        }
+        # The tags of all the games of a user are concatenated
+        game_rows = np.repeat(np.arange(len(users)), game_lengths)
+        for name, (indptr, values, _) in (('categories', self._categories), ('genres', self._genres)):
+            tags, tag_lengths = ragged_gather(indptr, values, games)
+            tag_splits = np.zeros(len(users) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(game_rows, weights=tag_lengths, minlength=len(users)).astype(np.int64),
+                      out=tag_splits[1:])
+            batch[name] = (tags, tag_splits)
+        return batch
+
+    def padded_batch(self, users):
+        """Same as batch, but every feature is a dense [len(users), length]
+        int32 array padded with PADDING, length being rounded up with
+        bucket_length."""
+        return {name: pad(values, row_splits) for name, (values, row_splits) in self.batch(users).items()}
+
+    def _user_batches(self, users, batch_size, shuffle, bucket, rng):
+        users = np.asarray(users)
+        if shuffle:
+            users = users[rng.permutation(len(users))]
+        if not bucket:
+            return [users[start:start + batch_size] for start in range(0, len(users), batch_size)]
+
+        # Users of similar lengths are batched together, the batches are then
+        # shuffled so that lengths don't follow a pattern
+        batches = []
+        window = batch_size * BUCKET_WINDOW
+        for start in range(0, len(users), window):
+            chunk = users[start:start + window]
+            chunk = chunk[np.argsort(self.example_lengths(chunk), kind='stable')]
+            batches.extend(chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size))
+        if shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def batches(self, users=None, batch_size=200, padded=True, shuffle=True, bucket=True,
+                repeat=False, prefetch=PREFETCH, seed=None):
+        """Iterates over batches of users, built ahead on a background thread.
+        Args:
+            users: the user indices to use (see split_users), all by default.
+            batch_size: number of users per batch.
+            padded: whether to yield padded_batch (True) or batch (False).
+            shuffle: whether to shuffle the users at every epoch.
+            bucket: whether to batch users with similar numbers of games.
+            repeat: whether to loop over the users forever.
+            prefetch: number of batches built ahead.
+            seed: optional seed of the shuffling.
+        Yields:
+            dict: The batches, see batch and padded_batch.
+        """
+        if users is None:
+            users = np.arange(self.interactions.num_users)
+        rng = np.random.default_rng(seed)
+        build = self.padded_batch if padded else self.batch
+
+        def produce():
+            while True:
+                for batch_users in self._user_batches(users, batch_size, shuffle, bucket, rng):
+                    yield build(batch_users)
+                if not repeat:
+                    return
+
+        return prefetched(produce(), prefetch)
+
+def prefetched(iterator, size=PREFETCH):
+    """Runs an iterator on a background thread, size items ahead of the
+    consumer. Exceptions are raised in the consumer."""
+    items = queue.Queue(maxsize=size)
+    done = object()
+    stopped = threading.Event()
+
+    def run():
+        try:
+            for item in iterator:
+                while not stopped.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    return
+        except Exception as e:
+            items.put(e)
+        items.put(done)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # The consumer stopped early, let the thread exit
+        stopped.set()
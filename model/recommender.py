@@ -0,0 +1,163 @@
+import os
+import time
+
+import numpy as np
+
+from model import artifacts
+from model.artifacts import Interactions
+from model.trainer import MFModel, models_path
+
+DOT = 'dot'
+COSINE = 'cosine'
+
+# Number of scores (queries x games) computed by a single matrix product
+BLOCK_SCORES = 1 << 24
+
+def normalize(embeddings):
+    """Scales every row to unit norm (zero rows stay zero)."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1)
+
+def top_k(scores, k):
+    """Selects the k best scores of every row without sorting whole rows.
+    Args:
+        scores: a [num_queries, num_items] array.
+        k: number of items to select (at most num_items).
+    Returns:
+        tuple: The [num_queries, k] item indices and their scores, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        indices = np.argpartition(scores, -k, axis=1)[:, -k:]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    selected = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-selected, axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(selected, order, axis=1)
+
+class Recommender(object):
+    """Scores and ranks games for many queries at once.
+
+    The game embeddings (normalized once for COSINE) are scored against
+    blocks of queries with a single matrix product per block, and only the
+    top k of every row are selected and sorted.
+    """
+    def __init__(self, user_embeddings, game_embeddings, interactions=None):
+        """Initializes a Recommender.
+        Args:
+            user_embeddings: the [num_users, k] user embeddings.
+            game_embeddings: the [num_games, k] game embeddings.
+            interactions: optional Interactions, needed to exclude the games
+                already rated by the users.
+        """
+        self.user_embeddings = user_embeddings
+        self.game_embeddings = game_embeddings
+        self.interactions = interactions
+        self._game_embeddings = {DOT: np.asarray(game_embeddings, dtype=np.float32)}
+
+    @classmethod
+    def open(cls, name, path=models_path, artifacts_path=artifacts.artifacts_path):
+        """Opens a saved model together with the artifacts it was trained on
+        (the current ones if the model doesn't say)."""
+        model = MFModel.load(name, path)
+        interactions = Interactions.open(artifacts_path, model.meta.get('artifacts'))
+        return cls(model.embeddings['steam_id'], model.embeddings['app_id'], interactions)
+
+    def _items(self, measure):
+        if measure not in self._game_embeddings:
+            if measure != COSINE:
+                raise ValueError(f"measure should be '{DOT}' or '{COSINE}', got: {measure}")
+            self._game_embeddings[COSINE] = normalize(self._game_embeddings[DOT])
+        return self._game_embeddings[measure]
+
+    def _rank(self, queries, k, measure, rated=None):
+        """Top k games of every query embedding.
+        Args:
+            queries: the [num_queries, k] query embeddings.
+            rated: optional CSR matrix of the games to exclude, one row per query.
+        """
+        items = self._items(measure)
+        block_size = max(1, BLOCK_SCORES // max(items.shape[0], 1))
+        k = min(k, items.shape[0])
+        indices = np.empty((len(queries), k), dtype=np.int32)
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), block_size):
+            end = min(start + block_size, len(queries))
+            block = np.asarray(queries[start:end], dtype=np.float32)
+            if measure == COSINE:
+                block = normalize(block)
+            block_scores = block @ items.T
+            if rated is not None:
+                rated_block = rated[start:end]
+                rows = np.repeat(np.arange(end - start), np.diff(rated_block.indptr))
+                block_scores[rows, rated_block.indices] = -np.inf
+            indices[start:end], scores[start:end] = top_k(block_scores, k)
+        return indices, scores
+
+    def recommend(self, user_indices, k=6, measure=DOT, exclude_rated=False):
+        """Recommends games to users.
+        Args:
+            user_indices: the user indices (see Interactions.user_index).
+            k: number of games per user.
+            measure: DOT or COSINE.
+            exclude_rated: whether to skip the games the users already rated.
+                Their score is -inf when a user rated all but fewer than k games.
+        Returns:
+            tuple: The [num_users, k] game indices and scores, best first.
+        """
+        user_indices = np.asarray(user_indices, dtype=np.int64)
+        if np.any(user_indices < 0):
+            raise ValueError("Unknown user index")
+        rated = None
+        if exclude_rated:
+            if self.interactions is None:
+                raise ValueError("exclude_rated needs the interactions")
+            rated = self.interactions.matrix[user_indices]
+        return self._rank(self.user_embeddings[user_indices], k, measure, rated)
+
+    def neighbors(self, game_indices, k=6, measure=DOT):
+        """Returns the k nearest games of every game (including itself),
+        as the [num_games, k] game indices and scores."""
+        game_indices = np.asarray(game_indices, dtype=np.int64)
+        if np.any(game_indices < 0):
+            raise ValueError("Unknown game index")
+        return self._rank(self.game_embeddings[game_indices], k, measure)
+
+    def recommend_all(self, k=6, measure=DOT, exclude_rated=True, batch_size=100000):
+        """Recommends games to every user, batch_size users at a time.
+        Yields:
+            tuple: The first user index of the batch, and the game indices and
+                   scores of the batch (see recommend).
+        """
+        num_users = len(self.user_embeddings)
+        for start in range(0, num_users, batch_size):
+            user_indices = np.arange(start, min(start + batch_size, num_users))
+            yield (start,) + self.recommend(user_indices, k, measure, exclude_rated)
+
+def write_recommendations(name, k=10, measure=DOT):
+    """Writes the top k games of every user of a saved model (excluding the
+    games they rated) to the model directory, as [num_users, k] game indices
+    and scores."""
+    start_time = time.time()
+    recommender = Recommender.open(name)
+    num_users = len(recommender.user_embeddings)
+    directory = os.path.join(models_path, name)
+    indices = np.lib.format.open_memmap(os.path.join(directory, f"top{k}_{measure}.indices.npy"), mode='w+',
+                                        dtype=np.int32, shape=(num_users, min(k, recommender.interactions.num_games)))
+    scores = np.lib.format.open_memmap(os.path.join(directory, f"top{k}_{measure}.scores.npy"), mode='w+',
+                                       dtype=np.float32, shape=indices.shape)
+    for start, batch_indices, batch_scores in recommender.recommend_all(k, measure):
+        indices[start:start + len(batch_indices)] = batch_indices
+        scores[start:start + len(batch_indices)] = batch_scores
+    indices.flush()
+    scores.flush()
+    print(f"Successfully written to '{directory}'")
+    print(f"Finished in {time.time() - start_time} seconds.")
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'recommend_all':
+        name = args[1] if len(args) > 1 else 'regularized'
+        k = int(args[2]) if len(args) > 2 else 10
+        write_recommendations(name, k, COSINE if '--cosine' in sys.argv else DOT)
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from model import artifacts
+from model.ann import NUM_PROBES, IVFIndex, NameIndex, index_path
+from model.recommender import COSINE, DOT, Recommender
+from model.trainer import models_path
+
+logger = logging.getLogger(__name__)
+
+# A batch is run as soon as it has MAX_BATCH_SIZE requests, or MAX_DELAY
+# seconds after its first request
+MAX_BATCH_SIZE = 256
+MAX_DELAY = 0.002
+# Seconds between two checks for a new model or new artifacts
+RELOAD_INTERVAL = 5
+DEFAULT_K = 6
+MAX_K = 100
+
+class MicroBatcher(object):
+    """Groups concurrent requests with the same key into a single call of
+    run_batch(key, items), run in a thread so that the event loop keeps
+    accepting requests meanwhile."""
+    def __init__(self, run_batch, max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_DELAY, num_threads=2):
+        self._run_batch = run_batch
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._executor = ThreadPoolExecutor(num_threads)
+        self._pending = {}
+        self._timers = {}
+
+    async def submit(self, key, item):
+        """Returns the result of item, computed with the other items of its batch."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((item, future))
+        if len(batch) >= self._max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self._max_delay, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            asyncio.ensure_future(self._run(key, batch))
+
+    async def _run(self, key, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self._executor, self._run_batch, key, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+class RecommendationService(object):
+    """HTTP service answering recommendation, neighbour and game name requests
+    from a saved model.
+
+    Concurrent requests are micro-batched into a single ranking per batch.
+    The neighbours of games are searched in the approximate nearest neighbour
+    index of the measure when the model has an up to date one (see
+    model/ann.py), else (or with exact=1) by an exact scan.
+    The model and artifacts are checked every RELOAD_INTERVAL seconds, and a
+    new version is loaded in the background then swapped in: the batches
+    already running finish with the previous one.
+    """
+    def __init__(self, name, path=models_path, artifacts_path=artifacts.artifacts_path, num_probes=NUM_PROBES):
+        self.name = name
+        self.path = path
+        self.artifacts_path = artifacts_path
+        self.num_probes = num_probes
+        self._version = self._current_version()
+        # The recommender, the game names, their NameIndex and the game
+        # indices by measure, swapped together
+        self._model = self._load()
+        self._batcher = MicroBatcher(self._run_batch)
+
+    def _current_version(self):
+        """Changes when the model is saved again, the artifacts are rebuilt or
+        an index of the games is built."""
+        meta_path = os.path.join(self.path, self.name, 'meta.json')
+        index_times = tuple(
+            os.path.getmtime(path) if os.path.exists(path) else None
+            for path in (os.path.join(index_path(self.name, 'app_id', measure, self.path), 'meta.json')
+                         for measure in (DOT, COSINE)))
+        with open(os.path.join(self.artifacts_path, artifacts.CURRENT), 'r', encoding='utf-8') as f:
+            return os.path.getmtime(meta_path), f.read().strip(), index_times
+
+    def _load(self):
+        recommender = Recommender.open(self.name, self.path, self.artifacts_path)
+        # Read once, every response needs the names
+        names = recommender.interactions.games['name'].to_numpy()
+        return recommender, names, NameIndex(names), self._load_game_indices(recommender)
+
+    def _load_game_indices(self, recommender):
+        """Loads the app_id indices of the model, skipping those built before
+        the model was last saved."""
+        model_time = os.path.getmtime(os.path.join(self.path, self.name, 'meta.json'))
+        indices = {}
+        for measure in (DOT, COSINE):
+            directory = index_path(self.name, 'app_id', measure, self.path)
+            if not os.path.exists(os.path.join(directory, 'meta.json')):
+                continue
+            index = IVFIndex.load(directory)
+            if os.path.getmtime(os.path.join(directory, 'meta.json')) < model_time \
+                    or len(index.ids) != len(recommender.game_embeddings):
+                logger.warning("The %s index of the games is older than the model, using exact search instead",
+                               measure)
+                continue
+            indices[measure] = index
+        return indices
+
+    async def _watch(self, app):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(RELOAD_INTERVAL)
+            try:
+                version = self._current_version()
+                if version == self._version:
+                    continue
+                model = await loop.run_in_executor(None, self._load)
+            except Exception:
+                logger.exception("Could not reload the model")
+                continue
+            self._model = model
+            self._version = version
+            logger.info("Reloaded the model (version: %s)", version)
+
+    def _run_batch(self, key, items):
+        """Runs a batch of (id, k) in a thread, with a single recommender for
+        the whole batch. The last item of key is exclude_rated for users, and
+        exact for games."""
+        recommender, names, _, game_indices_by_measure = self._model
+        kind, measure, option = key
+        ids = np.array([id for id, _ in items], dtype=np.int64)
+        if kind == 'users':
+            indices = recommender.interactions.user_index(ids)
+        else:
+            indices = recommender.interactions.game_index(ids)
+        known = indices >= 0
+
+        results = [None] * len(items)
+        if not known.any():
+            return results
+        k = max(k for _, k in items)
+        if kind == 'users':
+            game_indices, scores = recommender.recommend(indices[known], k, measure, option)
+        elif option or measure not in game_indices_by_measure:
+            game_indices, scores = recommender.neighbors(indices[known], k, measure)
+        else:
+            game_indices, scores = game_indices_by_measure[measure].search(
+                recommender.game_embeddings[indices[known]], k, self.num_probes)
+        app_ids = recommender.interactions.app_ids
+        for row, i in enumerate(np.flatnonzero(known)):
+            results[i] = [
+                {'app_id': int(app_ids[j]), 'name': names[j], 'score': float(score)}
+                for j, score in zip(game_indices[row, :items[i][1]], scores[row, :items[i][1]])
+                if np.isfinite(score)
+            ]
+        return results
+
+    @staticmethod
+    def _parse_query(request):
+        measure = request.query.get('measure', DOT)
+        if measure not in (DOT, COSINE):
+            raise web.HTTPBadRequest(text=f"measure should be '{DOT}' or '{COSINE}'")
+        try:
+            k = int(request.query.get('k', DEFAULT_K))
+        except ValueError:
+            raise web.HTTPBadRequest(text="k should be an integer")
+        if not 1 <= k <= MAX_K:
+            raise web.HTTPBadRequest(text=f"k should be between 1 and {MAX_K}")
+        exclude_rated = request.query.get('exclude_rated', '0').lower() in ('1', 'true', 'yes')
+        exact = request.query.get('exact', '0').lower() in ('1', 'true', 'yes')
+        return measure, k, exclude_rated, exact
+
+    @staticmethod
+    def _parse_id(request, name):
+        try:
+            return int(request.match_info[name])
+        except ValueError:
+            raise web.HTTPBadRequest(text=f"{name} should be an integer")
+
+    async def user_recommendations(self, request):
+        steam_id = self._parse_id(request, 'steam_id')
+        measure, k, exclude_rated, _ = self._parse_query(request)
+        recommendations = await self._batcher.submit(('users', measure, exclude_rated), (steam_id, k))
+        if recommendations is None:
+            raise web.HTTPNotFound(text=f"Unknown steam_id: {steam_id}")
+        return web.json_response({'steam_id': str(steam_id), 'recommendations': recommendations})
+
+    async def game_neighbors(self, request):
+        app_id = self._parse_id(request, 'app_id')
+        measure, k, _, exact = self._parse_query(request)
+        neighbors = await self._batcher.submit(('games', measure, exact), (app_id, k))
+        if neighbors is None:
+            raise web.HTTPNotFound(text=f"Unknown app_id: {app_id}")
+        return web.json_response({'app_id': app_id, 'neighbors': neighbors})
+
+    async def find_games(self, request):
+        """Games named name, or else whose name starts with (or else contains) it."""
+        name = request.query.get('name')
+        if not name:
+            raise web.HTTPBadRequest(text="name is required")
+        _, k, _, _ = self._parse_query(request)
+        recommender, names, name_index, _ = self._model
+        app_ids = recommender.interactions.app_ids
+        games = [{'app_id': int(app_ids[i]), 'name': names[i]} for i in name_index.lookup(name)[:k]]
+        return web.json_response({'name': name, 'games': games})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/users/{steam_id}/recommendations', self.user_recommendations)
+        app.router.add_get('/games/{app_id}/neighbors', self.game_neighbors)
+        app.router.add_get('/games', self.find_games)
+
+        async def start_watching(app):
+            app['watcher'] = asyncio.ensure_future(self._watch(app))
+
+        async def stop_watching(app):
+            app['watcher'].cancel()
+            self._batcher.close()
+
+        app.on_startup.append(start_watching)
+        app.on_cleanup.append(stop_watching)
+        return app
+
+def serve(name, port=8080):
+    web.run_app(RecommendationService(name).app(), port=port)
+
+async def load_test_async(base_url, steam_ids, app_ids, concurrency=64, duration=10.0):
+    """Sends recommendation and neighbour requests (half each) from
+    `concurrency` clients for `duration` seconds.
+    Returns:
+        dict: The throughput (requests per second), latency percentiles (in
+              milliseconds) and number of errors.
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def client():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                if random.random() < 0.5:
+                    url = f"{base_url}/users/{random.choice(steam_ids)}/recommendations?exclude_rated=1"
+                else:
+                    url = f"{base_url}/games/{random.choice(app_ids)}/neighbors?measure={COSINE}"
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': float(np.percentile(latencies, 50)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(latencies.max()),
+        'errors': errors,
+    }
+
+def load_test(name, port=8080, concurrency=64, duration=10.0):
+    """Load tests a service running the model `name` on localhost."""
+    interactions = Recommender.open(name).interactions
+    steam_ids = [int(id) for id in np.random.choice(interactions.steam_ids, 1000)]
+    app_ids = [int(id) for id in np.random.choice(interactions.app_ids, 1000)]
+    results = asyncio.run(load_test_async(f"http://localhost:{port}", steam_ids, app_ids, concurrency, duration))
+    print(json.dumps(results, indent=2))
+    return results
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    name = args[1] if len(args) > 1 else 'regularized'
+    port = int(args[2]) if len(args) > 2 else 8080
+    if args[0] == 'serve':
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        serve(name, port)
+    if args[0] == 'load_test':
+        concurrency = int(args[3]) if len(args) > 3 else 64
+        duration = float(args[4]) if len(args) > 4 else 10.0
+        load_test(name, port, concurrency, duration)
@@ -0,0 +1,302 @@
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from model.loader import UserGamesLoader, split_users
+from model.trainer import MFModel, models_path
+
+FULL = 'full'
+SAMPLED = 'sampled'
+
+# Embedding dimension of every input feature, as in the notebook
+EMBEDDING_DIMS = {
+    'app_id': 30,
+    'categories': 4,
+    'genres': 4,
+    'year': 2,
+}
+HIDDEN_DIMS = [30]
+# Number of negatives sampled per step, shared by the whole batch
+NUM_SAMPLED = 1000
+# Exponent of the game popularity in the sampling distribution
+SAMPLING_EXPONENT = 0.75
+INITIAL_ACCUMULATOR = 0.1
+
+def truncated_normal(rng, shape, stddev):
+    """Normal values redrawn until within 2 standard deviations, like
+    tf.truncated_normal_initializer."""
+    values = rng.normal(scale=stddev, size=shape)
+    outside = np.abs(values) > 2 * stddev
+    while outside.any():
+        values[outside] = rng.normal(scale=stddev, size=int(outside.sum()))
+        outside = np.abs(values) > 2 * stddev
+    return values.astype(np.float32)
+
+def _bag(values, row_splits):
+    """Mean-combiner bag of ids of a ragged batch, over the ids present only.
+    Returns:
+        tuple: The unique ids, and the [batch_size, len(ids)] CSR averaging matrix.
+    """
+    ids, columns = np.unique(values, return_inverse=True)
+    lengths = np.diff(row_splits)
+    weights = np.repeat(1.0 / np.maximum(lengths, 1), lengths).astype(np.float32)
+    return ids, sp.csr_matrix((weights, columns, row_splits), shape=(len(lengths), len(ids)))
+
+def _sum_rows(rows, gradients):
+    """Sums the gradients of repeated rows. Returns the unique rows and sums."""
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    summing = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (inverse, np.arange(len(rows)))),
+                            shape=(len(unique_rows), len(rows)))
+    return unique_rows, summing @ gradients
+
+def _cross_entropy(logits, targets):
+    """Mean softmax cross-entropy and its gradient with respect to logits."""
+    logits = logits - logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    rows = np.arange(len(targets))
+    loss = -np.mean(np.log(np.maximum(probabilities[rows, targets], 1e-30)))
+    probabilities[rows, targets] -= 1
+    return float(loss), probabilities / len(targets)
+
+class SoftmaxModel(object):
+    """The softmax model of softmax_model.ipynb, in NumPy.
+
+    The user embedding is a linear network over the mean embeddings of the
+    app_ids, categories, genres and years of the games a user reviewed. Its
+    dot product with the app_id embeddings (tied with the input ones) are
+    the logits of the reviewed game.
+
+    With mode=SAMPLED, the softmax of a step only covers the batch's labels
+    and NUM_SAMPLED games sampled by popularity, with the logQ correction of
+    sampled softmax, so the cost of a step doesn't depend on the number of
+    games. The full softmax metrics are computed every eval_every steps.
+    """
+    def __init__(self, vocabulary_sizes, embedding_dims=EMBEDDING_DIMS, hidden_dims=HIDDEN_DIMS, seed=None):
+        """Initializes a SoftmaxModel.
+        Args:
+            vocabulary_sizes: a dictionary mapping the features to the size of
+                their vocabulary.
+            embedding_dims: a dictionary mapping the features to the dimension
+                of their embeddings.
+            hidden_dims: the dimensions of the hidden layers, the last one
+                must be the app_id embedding dimension.
+        """
+        if hidden_dims[-1] != embedding_dims['app_id']:
+            raise ValueError(
+                "The user embedding dimension %d should match the game embedding dimension %d"
+                % (hidden_dims[-1], embedding_dims['app_id']))
+        rng = np.random.default_rng(seed)
+        # Sorted like tf.feature_column.input_layer sorts its columns
+        self.features = sorted(embedding_dims)
+        self.params = {
+            feature: truncated_normal(rng, (vocabulary_sizes[feature], embedding_dims[feature]),
+                                      1. / np.sqrt(embedding_dims[feature]))
+            for feature in self.features
+        }
+        input_dim = sum(embedding_dims.values())
+        for i, output_dim in enumerate(hidden_dims):
+            self.params[f"hidden{i}_w"] = truncated_normal(rng, (input_dim, output_dim), 1. / np.sqrt(output_dim))
+            input_dim = output_dim
+        self.num_layers = len(hidden_dims)
+        self._accumulators = {name: np.full_like(param, INITIAL_ACCUMULATOR) for name, param in self.params.items()}
+
+    @property
+    def embeddings(self):
+        """The embeddings dictionary."""
+        return {'app_id': self.params['app_id']}
+
+    def _forward(self, batch):
+        bags = {feature: _bag(*batch[feature]) for feature in self.features}
+        inputs = np.hstack([bags[feature][1] @ self.params[feature][bags[feature][0]] for feature in self.features])
+        layers = [inputs]
+        for i in range(self.num_layers):
+            # The notebook scales the hidden weights down by 10
+            layers.append(layers[-1] @ (self.params[f"hidden{i}_w"] / 10.))
+        return bags, layers
+
+    def _backward(self, bags, layers, user_gradients):
+        """Gradients of the network parameters as (rows, values) for the
+        embeddings (None for every row) given the user embedding gradients."""
+        gradients = {}
+        gradient = user_gradients
+        for i in reversed(range(self.num_layers)):
+            gradients[f"hidden{i}_w"] = (None, layers[i].T @ gradient / 10.)
+            gradient = gradient @ (self.params[f"hidden{i}_w"] / 10.).T
+        start = 0
+        for feature in self.features:
+            ids, bag = bags[feature]
+            dim = self.params[feature].shape[1]
+            gradients[feature] = (ids, bag.T @ gradient[:, start:start + dim])
+            start += dim
+        return gradients
+
+    def _apply(self, gradients, learning_rate):
+        """Adagrad update, only of the touched rows of the embeddings."""
+        for name, (rows, gradient) in gradients.items():
+            if rows is None:
+                self._accumulators[name] += gradient * gradient
+                self.params[name] -= learning_rate * gradient / np.sqrt(self._accumulators[name])
+            else:
+                rows, gradient = _sum_rows(rows, gradient)
+                self._accumulators[name][rows] += gradient * gradient
+                self.params[name][rows] -= learning_rate * gradient / np.sqrt(self._accumulators[name][rows])
+
+    def user_embeddings(self, batch):
+        """The user embeddings of a ragged batch (see UserGamesLoader.batch)."""
+        return self._forward(batch)[1][-1]
+
+    def all_user_embeddings(self, loader, batch_size=10000):
+        """The user embeddings of every user of a UserGamesLoader."""
+        user_embeddings = np.empty((loader.interactions.num_users, self.params['app_id'].shape[1]), dtype=np.float32)
+        for start in range(0, len(user_embeddings), batch_size):
+            users = np.arange(start, min(start + batch_size, len(user_embeddings)))
+            user_embeddings[users] = self.user_embeddings(loader.batch(users))
+        return user_embeddings
+
+    @staticmethod
+    def select_random(batch, rng):
+        """Selects a random reviewed game of every user of a batch as its label."""
+        values, row_splits = batch['label']
+        lengths = np.diff(row_splits)
+        return values[row_splits[:-1] + (rng.random(len(lengths)) * lengths).astype(np.int64)]
+
+    def full_metrics(self, batch, rng, k=10):
+        """Full softmax loss and precision at k of a batch."""
+        labels = self.select_random(batch, rng)
+        logits = self.user_embeddings(batch) @ self.params['app_id'].T
+        loss, _ = _cross_entropy(logits, labels)
+        top = np.argpartition(logits, -k, axis=1)[:, -k:] if logits.shape[1] > k else np.arange(logits.shape[1])[None, :]
+        hits = np.any(top == labels[:, None], axis=1)
+        return {'test_loss': loss, f"test_precision_at_{k}": float(np.mean(hits)) / k}
+
+    def train_step(self, batch, rng, learning_rate, mode=FULL, sampling=None, num_sampled=NUM_SAMPLED):
+        """Runs an Adagrad step on a ragged batch and returns its loss.
+        Args:
+            sampling: for SAMPLED, the cumulative sampling distribution of
+                the games (see sampling_distribution).
+        """
+        labels = self.select_random(batch, rng)
+        bags, layers = self._forward(batch)
+        users = layers[-1]
+        games = self.params['app_id']
+
+        if mode == FULL:
+            logits = users @ games.T
+            loss, logit_gradients = _cross_entropy(logits, labels)
+            user_gradients = logit_gradients @ games
+            output_rows = np.arange(len(games))
+            output_gradients = logit_gradients.T @ users
+        else:
+            probabilities, cumulative = sampling
+            sampled = np.minimum(np.searchsorted(cumulative, rng.random(num_sampled) * cumulative[-1], side='right'),
+                                 len(games) - 1)
+            # logQ correction: subtract the log of the expected number of
+            # times a game is sampled
+            true_logits = np.einsum('ij,ij->i', users, games[labels]) - np.log(num_sampled * probabilities[labels])
+            sampled_logits = users @ games[sampled].T - np.log(num_sampled * probabilities[sampled])
+            # A sampled game that is the label isn't a negative
+            sampled_logits[sampled[None, :] == labels[:, None]] = -1e9
+            logits = np.hstack([true_logits[:, None], sampled_logits])
+            loss, logit_gradients = _cross_entropy(logits, np.zeros(len(labels), dtype=np.int64))
+            user_gradients = (logit_gradients[:, :1] * games[labels]) + logit_gradients[:, 1:] @ games[sampled]
+            output_rows = np.concatenate([labels, sampled])
+            output_gradients = np.vstack([logit_gradients[:, :1] * users, logit_gradients[:, 1:].T @ users])
+
+        gradients = self._backward(bags, layers, user_gradients)
+        # The output embeddings are the app_id input embeddings
+        input_rows, input_gradients = gradients['app_id']
+        gradients['app_id'] = (np.concatenate([input_rows, output_rows]), np.vstack([input_gradients, output_gradients]))
+        self._apply(gradients, learning_rate)
+        return loss
+
+    def train(self, loader, train_users, test_users, num_iterations=10000, learning_rate=3., mode=FULL,
+              batch_size=200, num_sampled=NUM_SAMPLED, eval_every=100, eval_size=1000, seed=None, verbose=True):
+        """Trains the model.
+        Args:
+            loader: the UserGamesLoader of the examples.
+            train_users, test_users: the user indices (see split_users).
+            num_iterations: number of steps to run.
+            learning_rate: Adagrad learning rate.
+            mode: FULL or SAMPLED softmax.
+            batch_size: number of users per step.
+            num_sampled: number of sampled games per step in SAMPLED mode.
+            eval_every: number of steps between two full softmax evaluations
+                on eval_size test users.
+        Returns:
+            list: The metrics of every evaluation.
+        """
+        if mode not in (FULL, SAMPLED):
+            raise ValueError(f"mode should be '{FULL}' or '{SAMPLED}', got: {mode}")
+        rng = np.random.default_rng(seed)
+        sampling = sampling_distribution(loader) if mode == SAMPLED else None
+        test_batch = loader.batch(np.sort(rng.choice(test_users, min(eval_size, len(test_users)), replace=False)))
+
+        history = []
+        start_time = time.time()
+        batches = loader.batches(train_users, batch_size, padded=False, repeat=True, seed=seed)
+        try:
+            for iteration in range(num_iterations + 1):
+                loss = self.train_step(next(batches), rng, learning_rate, mode, sampling, num_sampled)
+                if iteration % eval_every == 0 or iteration == num_iterations:
+                    metrics = {'iteration': iteration, 'train_loss': loss}
+                    metrics.update(self.full_metrics(test_batch, rng))
+                    metrics['examples_per_second'] = (iteration + 1) * batch_size / (time.time() - start_time)
+                    history.append(metrics)
+                    if verbose:
+                        print(f"\r iteration {iteration}: " + ", ".join(
+                            f"{k}={v:f}" for k, v in metrics.items() if k != 'iteration'), end='')
+        finally:
+            batches.close()
+        if verbose:
+            print(f"\nFinished in {time.time() - start_time} seconds.")
+        return history
+
+    def save(self, name, loader, meta=None, path=models_path):
+        """Saves the model so that it can be used like an MFModel: the user
+        embeddings of every user are computed from their games, and the
+        network weights are saved next to them."""
+        user_embeddings = self.all_user_embeddings(loader)
+        meta = dict(meta or {}, model='softmax', artifacts=os.path.basename(loader.interactions.directory))
+        directory = MFModel({'steam_id': user_embeddings, 'app_id': self.params['app_id']}, meta).save(name, path)
+        for param_name, param in self.params.items():
+            if param_name != 'app_id':
+                np.save(os.path.join(directory, f"softmax_{param_name}.npy"), param)
+        return directory
+
+def sampling_distribution(loader, exponent=SAMPLING_EXPONENT):
+    """Popularity-based sampling distribution of the games: the number of
+    reviews of a game to the power exponent (plus one, so that every game can
+    be sampled).
+    Returns:
+        tuple: The probability of every game, and their cumulative sum.
+    """
+    counts = np.bincount(loader.interactions.matrix.indices, minlength=loader.interactions.num_games)
+    weights = (counts + 1.0) ** exponent
+    probabilities = weights / weights.sum()
+    return probabilities, np.cumsum(probabilities)
+
+def vocabulary_sizes(loader):
+    """The vocabulary size of every feature of a UserGamesLoader."""
+    return {feature: vocabulary if isinstance(vocabulary, int) else len(vocabulary)
+            for feature, vocabulary in loader.vocabularies.items()}
+
+def train_and_save(name, mode=FULL, num_iterations=10000, **kwargs):
+    """Trains a softmax model on the current artifacts and saves it as name."""
+    loader = UserGamesLoader()
+    model = SoftmaxModel(vocabulary_sizes(loader))
+    train_users, test_users = split_users(loader.interactions.num_users)
+    history = model.train(loader, train_users, test_users, num_iterations, mode=mode, **kwargs)
+    directory = model.save(name, loader, {'mode': mode, 'history': history})
+    print(f"Successfully written to '{directory}'")
+    return model
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'train':
+        name = args[1] if len(args) > 1 else 'softmax'
+        num_iterations = int(args[2]) if len(args) > 2 else 10000
+        train_and_save(name, SAMPLED if '--sampled' in sys.argv else FULL, num_iterations)
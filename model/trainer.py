@@ -0,0 +1,268 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from model.artifacts import Interactions
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+models_path = os.path.join(BASE_DIR, 'data', 'collected', 'models')
+
+# Maximum number of observed ratings handled at once by a thread, bounds the
+# memory of the gathered embeddings to about BLOCK_NNZ * embedding_dim floats
+BLOCK_NNZ = 1 << 20
+# Conjugate gradient steps per ALS half-step, warm-started from the previous
+# embeddings
+CG_STEPS = 3
+
+def split_ratings(matrix, holdout_fraction=0.1, seed=None):
+    """Splits the observed ratings of a CSR matrix into training and test sets.
+    Args:
+        matrix: a scipy.sparse.csr_matrix.
+        holdout_fraction: fraction of the ratings to use in the test set.
+        seed: optional seed of the random split.
+    Returns:
+        tuple: The train and test CSR matrices, of the same shape as matrix.
+    """
+    rng = np.random.default_rng(seed)
+    test_mask = rng.random(matrix.nnz) < holdout_fraction
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+    def select(mask):
+        indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[mask], minlength=matrix.shape[0]), out=indptr[1:])
+        return sp.csr_matrix((matrix.data[mask], matrix.indices[mask], indptr), shape=matrix.shape)
+
+    return select(~test_mask), select(test_mask)
+
+def row_blocks(indptr, block_nnz=BLOCK_NNZ):
+    """Splits the rows of a CSR matrix into contiguous blocks of at most
+    block_nnz values (or a single row). Returns the list of (start, end)."""
+    num_rows = len(indptr) - 1
+    blocks = []
+    start = 0
+    while start < num_rows:
+        end = int(np.searchsorted(indptr, indptr[start] + block_nnz, side='right')) - 1
+        end = min(max(end, start + 1), num_rows)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+def predict_observed(matrix, X, Y):
+    """Returns X[i] . Y[j] for every stored (i, j) of a CSR matrix, in the
+    order of matrix.data."""
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    return np.einsum('ij,ij->i', X[rows], Y[matrix.indices])
+
+def _solve_block(R, X, Y, reg, grav, G, steps):
+    """Minimizes, for every row x of X and observed ratings r of R, with a few
+    conjugate gradient steps:
+        sum((r - Y_r x)^2) + reg * |x|^2 + grav * x^T G x
+    where Y_r are the rows of Y of the observed ratings.
+    """
+    def apply(P):
+        # (Y_r^T Y_r + reg * I + grav * G) P, row by row
+        Q = sp.csr_matrix((predict_observed(R, P, Y), R.indices, R.indptr), shape=R.shape)
+        return Q @ Y + reg * P + grav * (P @ G)
+
+    X = X.copy()
+    residual = R @ Y - apply(X)
+    direction = residual.copy()
+    residual_norms = np.einsum('ij,ij->i', residual, residual)
+    for _ in range(steps):
+        A_direction = apply(direction)
+        curvature = np.einsum('ij,ij->i', direction, A_direction)
+        alpha = np.divide(residual_norms, curvature, out=np.zeros_like(residual_norms), where=curvature > 0)
+        X += alpha[:, None] * direction
+        residual -= alpha[:, None] * A_direction
+        new_residual_norms = np.einsum('ij,ij->i', residual, residual)
+        beta = np.divide(new_residual_norms, residual_norms, out=np.zeros_like(residual_norms), where=residual_norms > 0)
+        direction = residual + beta[:, None] * direction
+        residual_norms = new_residual_norms
+    return X
+
+def als_step(R, X, Y, reg, grav, executor, steps=CG_STEPS):
+    """Updates every row of X given Y, in parallel over blocks of rows.
+    Args:
+        R: the ratings as a CSR matrix with the rows of X as rows.
+        X: the embeddings to update (updated in place).
+        Y: the fixed embeddings, one per column of R.
+        reg, grav: the regularization and gravity coefficients of the
+            per-row problem (see _solve_block).
+        executor: the ThreadPoolExecutor running the blocks.
+    """
+    G = Y.T @ Y
+    blocks = row_blocks(R.indptr)
+
+    def solve(block):
+        start, end = block
+        X[start:end] = _solve_block(R[start:end], X[start:end], Y, reg, grav, G, steps)
+
+    # numpy and scipy release the GIL in their kernels, so the blocks run on
+    # all the cores
+    list(executor.map(solve, blocks))
+
+def sparse_mse(R, U, V):
+    if not R.nnz:
+        return 0.0
+    return float(np.mean((R.data - predict_observed(R, U, V)) ** 2))
+
+def gravity(U, V):
+    """The gravity loss of the regularized model: the mean squared predicted
+    rating over every (user, game) pair."""
+    return float(np.sum((U.T @ U) * (V.T @ V)) / (U.shape[0] * V.shape[0]))
+
+class MFModel(object):
+    """Matrix factorization model trained with alternating least squares.
+
+    Minimizes the objective of the regularized notebook model:
+        sparse MSE + regularization_coeff * (|U|^2 / num_users + |V|^2 / num_games)
+                   + gravity_coeff * gravity(U, V)
+    Each half-step solves the per-user (then per-game) least squares
+    problems with a few warm-started conjugate gradient steps, batched over
+    all the rows, so an iteration is a handful of sparse and dense matrix
+    products.
+    """
+    def __init__(self, embeddings, meta=None):
+        """Initializes an MFModel.
+        Args:
+            embeddings: a dictionary with the 'steam_id' (users) and 'app_id'
+                (games) embedding matrices.
+            meta: optional dictionary describing the training.
+        """
+        self._embeddings = embeddings
+        self.meta = meta or {}
+
+    @property
+    def embeddings(self):
+        """The embeddings dictionary."""
+        return self._embeddings
+
+    @classmethod
+    def train(cls, matrix, embedding_dim=3, regularization_coeff=.1, gravity_coeff=1.,
+              init_stddev=0.1, holdout_fraction=0.1, max_iterations=50, patience=3,
+              num_threads=None, seed=None, verbose=True):
+        """Trains a model on a users x games rating matrix.
+        Args:
+            matrix: the users x games scipy.sparse.csr_matrix of ratings.
+            embedding_dim: the dimension of the embedding space.
+            regularization_coeff: the regularization coefficient lambda.
+            gravity_coeff: the gravity regularization coefficient lambda_g.
+            init_stddev: the standard deviation of the random initial embeddings.
+            holdout_fraction: fraction of the ratings held out for early
+                stopping. With 0, max_iterations are run.
+            max_iterations: maximum number of ALS iterations.
+            patience: number of iterations without improvement of the test
+                error before stopping. The best embeddings are kept.
+            num_threads: number of threads, defaults to the number of cores.
+            seed: optional seed of the split and of the initial embeddings.
+        Returns:
+            An MFModel.
+        """
+        rng = np.random.default_rng(seed)
+        if holdout_fraction > 0:
+            train_ratings, test_ratings = split_ratings(matrix, holdout_fraction, seed)
+        else:
+            train_ratings, test_ratings = matrix, None
+        train_ratings_by_game = train_ratings.T.tocsr()
+
+        num_users, num_games = matrix.shape
+        num_ratings = max(train_ratings.nnz, 1)
+        U = rng.normal(scale=init_stddev, size=(num_users, embedding_dim)).astype(np.float32)
+        V = rng.normal(scale=init_stddev, size=(num_games, embedding_dim)).astype(np.float32)
+
+        # Coefficients of the objective multiplied by num_ratings, so that the
+        # per-row problems have the plain squared error of their ratings
+        user_reg = regularization_coeff * num_ratings / num_users
+        game_reg = regularization_coeff * num_ratings / num_games
+        grav = gravity_coeff * num_ratings / (num_users * num_games)
+
+        history = []
+        best = None
+        start_time = time.time()
+        with ThreadPoolExecutor(num_threads or os.cpu_count()) as executor:
+            for iteration in range(1, max_iterations + 1):
+                als_step(train_ratings, U, V, user_reg, grav, executor)
+                als_step(train_ratings_by_game, V, U, game_reg, grav, executor)
+
+                metrics = {
+                    'iteration': iteration,
+                    'train_error': sparse_mse(train_ratings, U, V),
+                    'regularization_loss': regularization_coeff * (
+                        float(np.sum(U * U)) / num_users + float(np.sum(V * V)) / num_games),
+                    'gravity_loss': gravity_coeff * gravity(U, V),
+                }
+                if test_ratings is not None:
+                    metrics['test_error'] = sparse_mse(test_ratings, U, V)
+                history.append(metrics)
+                if verbose:
+                    print(f"\r iteration {iteration}: " + ", ".join(
+                        f"{k}={v:f}" for k, v in metrics.items() if k != 'iteration'), end='')
+
+                if test_ratings is None:
+                    continue
+                if best is None or metrics['test_error'] < best[0]['test_error']:
+                    best = (metrics, U.copy(), V.copy())
+                elif iteration - best[0]['iteration'] >= patience:
+                    if verbose:
+                        print(f"\nNo improvement for {patience} iterations, stopping.", end='')
+                    break
+        if verbose:
+            print(f"\nFinished in {time.time() - start_time} seconds.")
+
+        if best is not None:
+            _, U, V = best
+        meta = {
+            'embedding_dim': embedding_dim,
+            'regularization_coeff': regularization_coeff,
+            'gravity_coeff': gravity_coeff,
+            'history': history,
+        }
+        return cls({'steam_id': U, 'app_id': V}, meta)
+
+    def save(self, name, path=models_path):
+        """Writes the embeddings and the training metadata to path/name."""
+        directory = os.path.join(path, name)
+        os.makedirs(directory, exist_ok=True)
+        for key, embeddings in self._embeddings.items():
+            tmp_path = os.path.join(directory, f"{key}.npy.tmp")
+            with open(tmp_path, 'wb') as f:
+                np.save(f, embeddings)
+            os.replace(tmp_path, os.path.join(directory, f"{key}.npy"))
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        return directory
+
+    @classmethod
+    def load(cls, name, path=models_path, mmap=True):
+        """Loads a saved model, memory-mapping its embeddings by default."""
+        directory = os.path.join(path, name)
+        embeddings = {key: np.load(os.path.join(directory, f"{key}.npy"), mmap_mode='r' if mmap else None)
+                      for key in ('steam_id', 'app_id')}
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(embeddings, meta)
+
+def train_and_save(name, **kwargs):
+    """Trains a model on the current artifacts and saves it as name."""
+    interactions = Interactions.open()
+    model = MFModel.train(interactions.matrix, **kwargs)
+    # The embeddings are only valid with the ids of the artifacts they were
+    # trained on
+    model.meta['artifacts'] = os.path.basename(interactions.directory)
+    directory = model.save(name)
+    print(f"Successfully written to '{directory}'")
+    return model
+
+if __name__ == '__main__':
+    import sys
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'train':
+        # Same settings as the regularized model of the notebook
+        name = args[1] if len(args) > 1 else 'regularized'
+        embedding_dim = int(args[2]) if len(args) > 2 else 80
+        train_and_save(name, embedding_dim=embedding_dim, regularization_coeff=0.5,
+                       gravity_coeff=1.0, init_stddev=0.5)
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from data.cache import cache, cached
+
+@pytest.fixture
+def response_cache(tmp_path):
+    path = cache.path
+    cache.use(str(tmp_path / 'http_cache.sqlite'))
+    cache.enabled = True
+    yield cache
+    cache.use(path)
+
+def is_successful(response):
+    return response.get('success') == 1
+
+def test_failed_response_is_fetched_again(response_cache):
+    responses = [{'success': 2}, {'success': 1, 'reviews': []}]
+    calls = []
+
+    @cached('appreviews', is_valid=is_successful)
+    def get_reviews(app_id):
+        calls.append(app_id)
+        return responses[len(calls) - 1]
+
+    assert get_reviews('10') == {'success': 2}
+    assert get_reviews('10') == {'success': 1, 'reviews': []}
+    # Only the successful response was cached
+    assert get_reviews('10') == {'success': 1, 'reviews': []}
+    assert calls == ['10', '10']
+
+def test_failed_response_is_fetched_again_async(response_cache):
+    responses = [{'10': {'success': False}}, {'10': {'success': True, 'data': {}}}]
+    calls = []
+
+    @cached('appdetails', ignore=('session',), is_valid=lambda response: response['10']['success'])
+    async def get_details(session, app_id):
+        calls.append(app_id)
+        return responses[len(calls) - 1]
+
+    async def fetch_three_times():
+        return [await get_details(None, '10') for _ in range(3)]
+
+    assert asyncio.run(fetch_three_times()) == responses[:1] + responses[1:] * 2
+    assert calls == ['10', '10']
+
+def test_none_is_not_cached_by_default(response_cache):
+    calls = []
+
+    @cached('appdetails')
+    def get_details(app_id):
+        calls.append(app_id)
+        return None if len(calls) == 1 else {'ok': 1}
+
+    assert get_details('10') is None
+    assert get_details('10') == {'ok': 1}
+    assert get_details('10') == {'ok': 1}
+    assert len(calls) == 2
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from data import collector
+from data.checkpoint import CheckpointStore
+
+class ListSink(object):
+    def __init__(self):
+        self.batches = []
+
+    def write_batch(self, batch):
+        self.batches.append(batch)
+
+    def sync(self):
+        pass
+
+class ListQueue(list):
+    put = list.append
+
+def first_page_then_errors(app_id, cursor):
+    if cursor == '*':
+        return {'success': 1, 'cursor': 'next', 'reviews': []}
+    raise ConnectionError("Connection reset")
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(collector.ratelimit, 'backoff', lambda attempt: 0)
+
+def test_exhausted_retries_are_not_done(monkeypatch):
+    queue = ListQueue()
+    monkeypatch.setattr(collector, 'pages_queue', queue)
+    monkeypatch.setattr(collector, 'existing_recommendations', set())
+    monkeypatch.setattr(collector, 'get_app_reviews', first_page_then_errors)
+
+    collector.process_game_reviews(('10', '*', 0))
+
+    assert [message[5] for message in queue] == ['started', 'page', 'failed']
+    # The last cursor is sent, so that a resumed run continues from it
+    assert queue[-1][2] == 'next'
+
+def test_exhausted_retries_are_not_done_async(monkeypatch, tmp_path):
+    async def get_app_reviews_async(session, app_id, cursor):
+        return first_page_then_errors(app_id, cursor)
+
+    monkeypatch.setattr(collector, 'get_app_reviews_async', get_app_reviews_async)
+    checkpoints = CheckpointStore(str(tmp_path / 'checkpoints.sqlite'))
+    try:
+        asyncio.run(collector.harvest_reviews([('10', '*', 0)], set(), ListSink(), checkpoints, concurrency=1))
+        assert checkpoints.load() == {'10': ('next', 1, False)}
+    finally:
+        checkpoints.close()
@@ -0,0 +1,38 @@
+import os
+
+from data import listing
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def read_fixture(file_name, mode='r'):
+    with open(os.path.join(FIXTURES_DIR, file_name), mode) as f:
+        return f.read()
+
+def test_parse_app_ids_of_category_page():
+    # Links to the same app are counted once, bundles and packages are not apps
+    html = read_fixture('category_page.html')
+    assert listing.parse_app_ids(html) == ['730', '1172470', '578080']
+
+def test_parse_app_ids_without_games():
+    assert listing.parse_app_ids('<div class="no_results">No results</div>') == []
+
+def test_parse_listing():
+    body = read_fixture('listing_page.json', 'rb')
+    assert listing.parse_listing(body) == ['1245620', '1091500', '292030']
+    assert listing.parse_listing(body.decode('utf-8')) == ['1245620', '1091500', '292030']
+
+def test_parse_listing_with_bom():
+    body = b'\xef\xbb\xbf' + read_fixture('listing_page.json', 'rb')
+    assert listing.parse_listing(body) == ['1245620', '1091500', '292030']
+
+def test_parse_listing_past_last_page():
+    assert listing.parse_listing(read_fixture('listing_last_page.json')) == []
+
+def test_parse_listing_failures():
+    # These have to fall back to the browser rather than count as 0 games
+    assert listing.parse_listing(read_fixture('listing_failure.json')) is None
+    assert listing.parse_listing('{"success": 1}') is None
+    assert listing.parse_listing(b'null') is None
+    assert listing.parse_listing(b'[]') is None
+    assert listing.parse_listing(b'<html>Access Denied</html>') is None
+    assert listing.parse_listing(b'') is None
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+import numpy as np
+import pandas as pd
+from aiohttp.test_utils import TestClient, TestServer
+
+from model import artifacts
+from model.ann import IVFIndex, index_path
+from model.recommender import COSINE
+from model.service import RecommendationService
+from model.trainer import MFModel
+
+NAMES = ['Counter-Strike 2', 'Counter-Strike', 'Portal', 'Portal 2', 'Half-Life', 'Dota 2']
+
+def save_model(tmp_path, num_games=len(NAMES)):
+    rng = np.random.default_rng(0)
+    games = pd.DataFrame({'app_id': np.arange(10, 10 + num_games), 'name': (NAMES * num_games)[:num_games]})
+    ratings = pd.DataFrame({'steam_id': [0, 1], 'app_id': [0, 1], 'pseudo_ratings': [1.0, 1.0]})
+    artifacts_path = str(tmp_path / 'artifacts')
+    artifacts.save(ratings, [100, 101], games, artifacts_path)
+    models_path = str(tmp_path / 'models')
+    model = MFModel({'steam_id': rng.normal(size=(2, 4)).astype(np.float32),
+                     'app_id': rng.normal(size=(num_games, 4)).astype(np.float32)}, {})
+    model.save('test', models_path)
+    return models_path, artifacts_path, model
+
+def get_json(service, *urls):
+    async def get():
+        results = []
+        async with TestClient(TestServer(service.app())) as client:
+            for url in urls:
+                response = await client.get(url)
+                assert response.status == 200
+                results.append(await response.json())
+        return results
+    return asyncio.run(get())
+
+def test_neighbors_use_the_index_of_the_model(tmp_path):
+    models_path, artifacts_path, model = save_model(tmp_path, 200)
+    embeddings = model.embeddings['app_id']
+    # One probe of many small lists misses some of the exact neighbours
+    IVFIndex.build(embeddings, COSINE, num_lists=50, seed=0).save(index_path('test', 'app_id', COSINE, models_path))
+    service = RecommendationService('test', models_path, artifacts_path, num_probes=1)
+    _, _, _, indices = service._model
+    assert list(indices) == [COSINE]
+
+    urls = [f"/games/{app_id}/neighbors?measure={COSINE}&k=10" for app_id in range(10, 210)]
+    responses = get_json(service, *urls, *(url + "&exact=1" for url in urls))
+    approximate = [[game['app_id'] for game in response['neighbors']] for response in responses[:200]]
+    exact = [[game['app_id'] for game in response['neighbors']] for response in responses[200:]]
+    expected, _ = indices[COSINE].search(embeddings, 10, 1)
+    assert approximate == [[10 + i for i in row if i >= 0] for row in expected]
+    expected, _ = service._model[0].neighbors(np.arange(200), 10, COSINE)
+    assert exact == [[10 + i for i in row] for row in expected]
+    assert approximate != exact
+
+def test_neighbors_skip_an_index_older_than_the_model(tmp_path):
+    models_path, artifacts_path, model = save_model(tmp_path)
+    index = IVFIndex.build(model.embeddings['app_id'], COSINE, seed=0)
+    index.save(index_path('test', 'app_id', COSINE, models_path))
+    meta_path = os.path.join(models_path, 'test', 'meta.json')
+    os.utime(meta_path, (os.path.getmtime(meta_path) + 10,) * 2)
+    service = RecommendationService('test', models_path, artifacts_path)
+    assert service._model[3] == {}
+
+def test_find_games_by_name(tmp_path):
+    models_path, artifacts_path, _ = save_model(tmp_path)
+    service = RecommendationService('test', models_path, artifacts_path)
+    exact, prefix, substring = get_json(service, "/games?name=portal", "/games?name=counter", "/games?name=2")
+    assert exact['games'] == [{'app_id': 12, 'name': 'Portal'}]
+    assert [game['name'] for game in prefix['games']] == ['Counter-Strike 2', 'Counter-Strike']
+    assert [game['name'] for game in substring['games']] == ['Counter-Strike 2', 'Portal 2', 'Dota 2']
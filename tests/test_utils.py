@@ -0,0 +1,43 @@
+import csv
+
+import numpy as np
+
+from common import utils
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerows([['key', 'value']] + rows)
+
+def read_csv(path):
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))[1:]
+
+ROWS = [['b', '1'], ['a', '2'], ['b', '3'], ['c', '4'], ['a', '5']]
+
+def test_drop_duplicates_keep_first(tmp_path):
+    path = tmp_path / 'table.csv'
+    write_csv(path, ROWS)
+    utils.drop_duplicates_in_csv(path, 0, keep='first', chunk_size=2)
+    assert read_csv(path) == [['b', '1'], ['a', '2'], ['c', '4']]
+
+def test_drop_duplicates_keep_last(tmp_path):
+    path = tmp_path / 'table.csv'
+    write_csv(path, ROWS)
+    utils.drop_duplicates_in_csv(path, 0, keep='last', chunk_size=2)
+    assert read_csv(path) == [['b', '3'], ['c', '4'], ['a', '5']]
+
+def test_drop_duplicates_as_number(tmp_path):
+    path = tmp_path / 'table.csv'
+    write_csv(path, [['10', 'x'], ['9', 'y'], ['10', 'z']])
+    utils.drop_duplicates_in_csv(path, 0, keep='last', as_number=True)
+    assert read_csv(path) == [['9', 'y'], ['10', 'z']]
+
+def test_drop_duplicates_hash_collision(tmp_path, monkeypatch):
+    # Every key gets the same hash: only the equal values are duplicates
+    def colliding_keys(csv_path, column_index, as_number, chunk_size):
+        return np.zeros(len(ROWS), dtype=np.uint64)
+    monkeypatch.setattr(utils, '_read_keys', colliding_keys)
+    path = tmp_path / 'table.csv'
+    write_csv(path, ROWS)
+    utils.drop_duplicates_in_csv(path, 0, keep='first', chunk_size=2)
+    assert read_csv(path) == [['b', '1'], ['a', '2'], ['c', '4']]